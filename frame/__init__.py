@@ -48,12 +48,14 @@ from _routes import routes
 from _config import config
 from _logger import logger
 from controller import Controller
+from response import flush
 from errors import *
 from pkg_resources import iter_entry_points
 
 
 start_http = app.start_http
 start_fcgi = app.start_fcgi
+start_async = app.start_async
 
 
 # Module registry
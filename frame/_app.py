@@ -8,6 +8,8 @@ from threading import RLock
 from pkg_resources import iter_entry_points
 from threaddata import ThreadData
 from renderer import Renderer
+from microcache import MicroCache
+from loadshedding import LoadShedder
 
 # For template toolset
 from toolset import toolset
@@ -25,6 +27,27 @@ from util import truncate, Singleton
 
 import driverdatabase
 import contextlib
+import gc
+import pkgutil
+from importlib import import_module
+
+
+def import_package(name):
+  '''
+  Import a module or, for a package, the package and every module in it.
+
+  :return: The number of modules imported
+  '''
+  module = import_module(name)
+  if not hasattr(module, '__path__'):
+    return 1
+
+  count = 1
+  for loader, module_name, is_package in pkgutil.walk_packages(module.__path__,
+      name + '.'):
+    import_module(module_name)
+    count += 1
+  return count
 
 
 class App(Singleton):
@@ -64,12 +87,25 @@ class App(Singleton):
     # Setup pre and post processor lists
     self.preprocessors = []
     self.postprocessors = []
-    
+
+    # Checks run before accepting the body of an Expect: 100-continue request; see
+    # expect_continue()
+    self.continue_hooks = []
+
+    # Called with the application by preload(), e.g. to fill caches before forking
+    self.preload_hooks = []
+
     self.config = config
 
     # A global lock for the application
     self.lock = RLock()
     
+    # The MicroCache in front of __call__, if config.micro_cache is enabled
+    self.micro_cache = None
+
+    # The LoadShedder in front of that, if config.load_shedding is enabled
+    self.load_shedder = None
+
     # A variable to store whether or not _prep_start has been run
     self._prepped = False
 
@@ -195,24 +231,183 @@ class App(Singleton):
     
     :param environ: WSGI environment
     :param start_response: The start_response function passed by the WSGI server
-    :yield: Response body
+    :return: An iterable over the response body; see :meth:`frame.renderer.Renderer.respond`
     '''
-    
+
+    if self.load_shedder is not None and self.load_shedder.should_shed(environ):
+      return self.load_shedder.reject(start_response)
+
+    if self.micro_cache is not None:
+      return self.micro_cache(environ, start_response, self.respond)
+    return self.respond(environ, start_response)
+
+  def respond(self, environ, start_response):
+    '''
+    Dispatch and render a request, bypassing the micro-cache; see :meth:`__call__`.
+    '''
+
+    response = self.dispatch(environ)
+    return Renderer(self, response, start_response).respond()
+
+  def dispatch(self, environ):
+    '''
+    Prepare the application (if that hasn't happened yet) and dispatch the request.
+    Errors are turned into the corresponding error response.
+
+    :param environ: WSGI environment
+    :return: The :class:`frame.response.Response` to render
+    '''
+
     if not self._prepped:
       self.lock.acquire()
       self._prep_start()
       self.lock.release()
     
     try:
-      response = self._dispatch(environ)
+      return self._dispatch(environ)
     except HTTPError, e:
-      response = e.response
+      return e.response
     except Exception, e:
-      response = Error500().response
-      
-    for i in Renderer(self, response, start_response):
-      yield i
-    
+      return Error500().response
+
+  def expect_continue(self, environ):
+    '''
+    Vet a request sent with ``Expect: 100-continue`` before its body is received; the
+    built-in HTTP server calls this from its event loop, so it must be quick. Requests
+    that don't match a route are refused with ``404 Not Found``; after that, each of
+    :attr:`continue_hooks` is called with the environ and may refuse the request by
+    returning a status line (e.g., ``'401 Unauthorized'`` or
+    ``'413 Request Entity Too Large'``).
+
+    :param environ: WSGI environment; ``wsgi.input`` must not be read
+    :return: ``None`` to accept the body, otherwise the status line to refuse it with
+    '''
+
+    if not self._prepped:
+      self.lock.acquire()
+      self._prep_start()
+      self.lock.release()
+
+    path = environ.get('PATH_INFO', '')
+    if config.application.strip_trailing_slash and path != '/':
+      path = path.rstrip('/')
+
+    # Only look the route up; matching through self.routes would build the controller
+    if not self.routes.mapper.match(path, environ=environ):
+      return '404 Not Found'
+
+    for hook in self.continue_hooks:
+      status = hook(environ)
+      if status:
+        return status
+
+    return None
+
+  def priority_class(self, environ):
+    '''
+    The priority class the route of a request declares (see
+    :meth:`frame._routes.Routes.connect`), if any; the built-in servers call this from
+    their event loop to choose where the request waits for a worker (see
+    :mod:`frame.server.worker`). Nothing is looked up unless a route declares one.
+
+    :param environ: WSGI environment; ``wsgi.input`` must not be read
+    :return: The name of the class, or ``None``
+    '''
+
+    if not self.routes.prioritised:
+      return None
+
+    if not self._prepped:
+      self.lock.acquire()
+      self._prep_start()
+      self.lock.release()
+
+    path = environ.get('PATH_INFO', '')
+    if config.application.strip_trailing_slash and path != '/':
+      path = path.rstrip('/')
+
+    result = self.routes.mapper.routematch(path, environ=environ)
+    return getattr(result[1], 'priority', None) if result else None
+
+  def metrics(self):
+    '''
+    The application's own counters, for the server's metrics (see
+    :mod:`frame.server.metrics`): the micro-cache's, the load shedder's and the
+    sessions', when they are in use.
+
+    :return: A dictionary of ``{section: {name: value}}``
+    '''
+    metrics = {}
+
+    if self.micro_cache is not None:
+      metrics['cache'] = {
+        'hits': self.micro_cache.hits,
+        'misses': self.micro_cache.misses,
+        'coalesced': self.micro_cache.coalesced,
+      }
+
+    if self.load_shedder is not None:
+      metrics['load_shedding'] = {
+        'admitted': self.load_shedder.admitted,
+        'shed': self.load_shedder.shed,
+      }
+
+    sessions = self.drivers.interfaces.get('session')
+    if sessions is not None and hasattr(sessions, 'hits'):
+      metrics['sessions'] = {
+        'hits': sessions.hits.value,
+        'misses': sessions.misses.value,
+        'created': sessions.created.value,
+      }
+
+    return metrics
+
+  def preload(self):
+    '''
+    Load everything a request could otherwise load on demand, so that server processes
+    forked afterwards share it copy-on-write instead of each building its own: the
+    modules named in ``config.preload.modules`` (packages with all of their modules,
+    e.g. the application's controllers), the route table's regular expressions and
+    every template. :attr:`preload_hooks` are called next, to warm the application's
+    own caches. Finally a full garbage collection leaves the heap as compact as it
+    gets; on Pythons that have :func:`gc.freeze` the survivors are frozen, so that
+    later collections in the workers don't touch (and copy) the pages they live on.
+
+    Called by :meth:`start_http` and :meth:`start_fcgi` before forking worker
+    processes, unless ``config.preload.enabled`` is off.
+    '''
+    if not self._prepped:
+      self.lock.acquire()
+      self._prep_start()
+      self.lock.release()
+
+    modules = 0
+    for name in config.preload.modules:
+      modules += import_package(name)
+
+    self.routes.mapper.create_regs()
+
+    templates = 0
+    environment = getattr(getattr(self, 'template_engine', None), 'environment', None)
+    if environment is not None:
+      for name in environment.list_templates():
+        try:
+          environment.get_template(name)
+        except Exception, e:
+          logger.log_warning("Could not preload template '%s': %s" % (name, e))
+        else:
+          templates += 1
+
+    for hook in self.preload_hooks:
+      hook(self)
+
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+      gc.freeze()
+
+    logger.log_info("Preloaded %s modules and %s templates; %s objects on the heap" % (
+      modules, templates, len(gc.get_objects())))
+
   def _prep_start(self):
     '''
     Populate data gathered from global config.
@@ -245,24 +440,77 @@ class App(Singleton):
     # Initialize dispatcher
     self.dispatcher = self.drivers.dispatcher.current(self)
 
+    if config.micro_cache.enabled and self.micro_cache is None:
+      self.micro_cache = MicroCache()
+
+    if config.load_shedding.enabled and self.load_shedder is None:
+      self.load_shedder = LoadShedder()
+
     for i, init_hook in self.drivers.init_hook.iteritems():
       init_hook(self)
     
     # Signal that the application has been prepped
     self._prepped = True
       
-  def start_fcgi(self, *args, **kwargs):
+  def start_fcgi(self, host=None, port=9000, path=None, *args, **kwargs):
     '''
-    Start the Flup FastCGI/WSGIServer interface. Any options passed to this method are
-    automatically passed to the Flup WSGIServer.
+    Start the FastCGI server (:class:`frame.server.fastcgi.FastCGIServer`), on the
+    built-in server's event loop and worker pool. It listens on the unix socket
+    ``path``, or on ``host:port``; with neither, it uses the socket the web server
+    passed it on standard input. Flup's ``bindAddress`` option is understood as well.
+
+    Like :meth:`start_http`, passing ``workers=N`` (or setting
+    ``config.fastcgi.processes``) forks N server processes.
+
+    Setting ``config.fastcgi.server`` to ``'flup'`` starts the Flup WSGIServer
+    instead, with any options passed to this method.
+
+    :param host: Listen host/address
+    :param port: Listen port
+    :param path: Path of a unix socket to listen on
     '''
-    
-    from flup.server.fcgi import WSGIServer
-    
+
     self.server_type = 'fcgi'
+
+    if config.fastcgi.server == 'flup':
+      from flup.server.fcgi import WSGIServer
+
+      if host is not None or path is not None:
+        kwargs.setdefault('bindAddress', path if host is None else (host, port))
+
+      self._prep_start()
+      logger.log_info("Starting FLUP WSGI Server...")
+      WSGIServer(self, *args, **kwargs).run()
+      return
+
+    from frame.server.fastcgi import FastCGIServer
+
+    bind_address = kwargs.pop('bindAddress', None)
+    if isinstance(bind_address, tuple):
+      host, port = bind_address
+    elif bind_address is not None:
+      path = bind_address
+
+    processes = kwargs.pop('workers', config.fastcgi.processes)
+
     self._prep_start()
-    logger.log_info("Starting FLUP WSGI Server...")
-    WSGIServer(self, *args, **kwargs).run()
+    logger.log_info("Starting Frame FastCGI Server on %s..." % (
+      path or ('%s:%s' % (host, port) if host else 'the socket passed by the web server')))
+
+    if processes > 1:
+      from frame.server.prefork import Supervisor
+
+      if args:
+        raise TypeError("Server options must be passed as keyword arguments when "
+          "forking worker processes")
+
+      if config.preload.enabled:
+        self.preload()
+
+      Supervisor(self, FastCGIServer, host=host, port=port, path=path,
+        processes=processes, **kwargs).run()
+    else:
+      FastCGIServer(self, host=host, port=port, path=path, *args, **kwargs).run()
 
   def start_http(self, host='127.0.0.1', port=8080, *args, **kwargs):
     '''
@@ -272,6 +520,11 @@ class App(Singleton):
     
     Like :meth:`start_fcgi`, options are all passed to the HTTP Server. For additional
     parameters, please reference :mod:`frame.server.http.HTTPServer`.
+
+    Passing ``workers=N`` (or setting ``config.http_server.processes``) forks N server
+    processes after the application has been prepared and preloaded (see
+    :meth:`preload`); see :mod:`frame.server.prefork`.
+    ``reuse_port=True`` makes each of them bind its own ``SO_REUSEPORT`` socket.
     
     :param host: Listen host/address
     :param port: Listen port
@@ -279,10 +532,52 @@ class App(Singleton):
     
     from frame.server.http import HTTPServer
     
+    processes = kwargs.pop('workers', config.http_server.processes)
+
     self.server_type = 'http'
     self._prep_start()
     logger.log_info("Starting Frame HTTP Server on %s:%s..." % (host, port))
-    HTTPServer(self, host=host, port=port, *args, **kwargs).run()
+
+    if processes > 1:
+      from frame.server.prefork import Supervisor
+
+      if args:
+        raise TypeError("Server options must be passed as keyword arguments when "
+          "forking worker processes")
+
+      if config.preload.enabled:
+        self.preload()
+
+      Supervisor(self, HTTPServer, host=host, port=port, processes=processes,
+        **kwargs).run()
+    else:
+      HTTPServer(self, host=host, port=port, *args, **kwargs).run()
+
+
+  def start_async(self, host='127.0.0.1', port=8080, **kwargs):
+    '''
+    Start the asynchronous HTTP Server (requires ``trollius``, the Python 2 port of
+    :mod:`asyncio`). Controller actions may be coroutines, which are run on the event
+    loop; plain actions are run in a thread pool as usual::
+
+      class Root(frame.Controller):
+        @asyncio.coroutine
+        def index(self):
+          data = yield From(fetch_upstream())
+          raise Return(data)
+
+    Options are passed on to :class:`frame.server.asyncio_http.AsyncHTTPServer`.
+
+    :param host: Listen host/address
+    :param port: Listen port
+    '''
+
+    from frame.server.asyncio_http import AsyncHTTPServer
+
+    self.server_type = 'async'
+    self._prep_start()
+    logger.log_info("Starting Frame asynchronous HTTP Server on %s:%s..." % (host, port))
+    AsyncHTTPServer(self, host=host, port=port, **kwargs).run()
 
 
 app = App()
\ No newline at end of file
@@ -72,7 +72,75 @@ config = DotDict({
 	},
 	
 	'http_server': {
+		'processes': 1,
 		'num_workers': 10,
+		'queue_size': 100,
+		'retry_after': 1,
+		'poller': 'auto',
+		'keep_alive': True,
+		'max_header_size': 65536,
+		'max_body_size': None,
+		'spool_threshold': 1048576,
+		'buffer_size': 65536,
+		'header_timeout': 10,
+		'body_timeout': 30,
+		'keep_alive_timeout': 5,
+		'write_timeout': 30,
+		'max_connections': 1024,
+		'max_requests': None,
+		'recycle_requests': None,
+		'recycle_rss': None,
+		'recycle_jitter': 0.1,
+		'shutdown_timeout': 10,
+		'graceful_shutdown': True,
+		'graceful_reload': True,
+		'reload_timeout': 30,
+		'reload_watcher': 'auto',
+		'reload_debounce': 0.5,
+		'metrics_path': None,
+		'shared_metrics': True,
+	},
+	
+	'fastcgi': {
+		'server': 'frame',
+		'processes': 1,
+		'socket_mode': None,
+	},
+	
+	'load_shedding': {
+		'enabled': False,
+		'target': 0.1,
+		'interval': 1.0,
+		'retry_after': 1,
+		'request_start_header': 'HTTP_X_REQUEST_START',
+		'exempt_paths': [],
+	},
+	
+	'priority': {
+		'classes': [('high', 8), ('normal', 4), ('low', 1)],
+		'default': 'normal',
+		'scheduler': 'weighted',
+		'header': None,
+		'paths': {},
+		'limits': {},
+	},
+	
+	'preload': {
+		'enabled': True,
+		'modules': [],
+		'gc_thresholds': None,
+	},
+	
+	'micro_cache': {
+		'enabled': False,
+		'ttl': 1,
+		'max_entries': 1000,
+		'max_body_size': 1048576,
+		'vary': ['HTTP_ACCEPT_ENCODING'],
+		'bypass_cookies': ['FrameSession'],
+		'strip_cookies': ['FrameSession'],
+		'statuses': [200, 203, 300, 301, 404, 410],
+		'wait_timeout': 10,
 	},
 	
 	'response': {
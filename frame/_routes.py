@@ -109,6 +109,9 @@ class Routes(Singleton):
 		self.controllers = {}
 		self.resources = {}
 
+		# Whether any route declares a priority class; see connect()
+		self.prioritised = False
+
 		# Setup to use sub domains by default
 		self.mapper.sub_domains = True
 		
@@ -166,19 +169,29 @@ class Routes(Singleton):
 		
 	def connect(self, path, controller=None, *args, **kwargs):
 		'''
-		Connect a URI pattern to a controller.
+		Connect a URI pattern to a controller. A ``priority`` keyword names the priority
+		class the route's requests wait for a worker in (see :mod:`frame.server.worker`),
+		e.g., ``priority='low'`` for slow report pages.
 		
 		:param path: The URI path to match with
 		:param controller: A string containing the controller and action
 		'''
 		name = uuid4()
 
+		# Kept on the route rather than among its defaults, which would clash with a URL
+		# variable of the same name
+		priority = kwargs.pop('priority', None)
+
 		if '#' in controller:
 			controller, action = controller.split('#', 1)
 		else:
 			action = 'index'
 
 		self.mapper.connect(name, path, controller=controller, action=action, *args, **kwargs)
+
+		if priority is not None:
+			self.mapper.matchlist[-1].priority = priority
+			self.prioritised = True
 		
 	def parse_mount_point(self, mount_point):
 		regex = re.compile("(/{.*?})")
@@ -0,0 +1,597 @@
+'''
+A load generator for Frame's built-in HTTP server, so that the effect of server changes
+on throughput and latency can be measured (and compared from release to release)
+without any outside tools or services.
+
+By default a small application is started on :meth:`frame._app.App.start_http` in a
+separate process. It has these routes:
+
+* ``/hello``: a short plain text response
+* ``/bytes/{size}``: a response of ``size`` bytes
+* ``/sleep/{ms}``: answers after sleeping for ``ms`` milliseconds
+
+It is then driven over loopback by a number of concurrent clients, with or without
+keep-alive, and the request rate, latency percentiles and errors are reported::
+
+  python -m frame.benchmark --concurrency 100 --duration 10 --path /hello
+  python -m frame.benchmark --no-keep-alive --path /bytes/100000 -o num_workers=20
+  python -m frame.benchmark --url http://127.0.0.1:8080/ --json
+
+The clients run on an event loop of their own (see :class:`LoadGenerator`); use
+``--processes`` to spread them over several processes when a single one can't keep the
+server busy.
+'''
+
+
+import os
+import sys
+import time
+import json
+import math
+import errno
+import socket
+import signal
+import cPickle as pickle
+from optparse import OptionParser
+from urlparse import urlparse
+from ast import literal_eval
+from frame.server import poller
+
+
+class ResponseReader(object):
+  '''
+  Incrementally parses one HTTP response; delimited by Content-Length, chunked
+  encoding or the connection closing.
+  '''
+
+  def __init__(self):
+    self.data = ''
+    self.status = None
+    self.keep_alive = True
+    self.length = None
+    self.chunked = False
+    self.complete = False
+
+    # Position of the body (or the next chunk) in data, and the body size so far
+    self.position = None
+    self.size = 0
+
+  def feed(self, data):
+    '''
+    :return: Whether the response is complete
+    '''
+    self.data += data
+
+    if self.position is None:
+      end = self.data.find('\r\n\r\n')
+      if end == -1:
+        return False
+      self.parse_head(self.data[:end])
+      self.position = end + 4
+
+    if self.chunked:
+      self.read_chunks()
+    elif self.length is not None:
+      self.complete = len(self.data) - self.position >= self.length
+      if self.complete:
+        self.size = self.length
+
+    return self.complete
+
+  def parse_head(self, head):
+    lines = head.split('\r\n')
+    self.status = int(lines[0].split()[1])
+
+    for line in lines[1:]:
+      name, value = line.split(':', 1)
+      name, value = name.strip().lower(), value.strip()
+      if name == 'content-length':
+        self.length = int(value)
+      elif name == 'transfer-encoding' and 'chunked' in value.lower():
+        self.chunked = True
+      elif name == 'connection' and 'close' in value.lower():
+        self.keep_alive = False
+
+    if self.length is None and not self.chunked:
+      # Delimited by the connection closing
+      self.keep_alive = False
+
+  def read_chunks(self):
+    while True:
+      end = self.data.find('\r\n', self.position)
+      if end == -1:
+        return
+
+      length = int(self.data[self.position:end].split(';')[0], 16)
+      if length == 0:
+        self.complete = self.data.find('\r\n', end + 2) != -1
+        return
+
+      if len(self.data) < end + 2 + length + 2:
+        return
+
+      self.size += length
+      self.position = end + 2 + length + 2
+
+      # Don't keep the whole body around
+      self.data = self.data[self.position:]
+      self.position = 0
+
+  def eof(self):
+    '''
+    The connection was closed; a close-delimited response is complete now.
+    '''
+    if self.position is not None and self.length is None and not self.chunked:
+      self.size = len(self.data) - self.position
+      self.complete = True
+    return self.complete
+
+
+class Results(object):
+  '''
+  What a benchmark run measured.
+  '''
+
+  def __init__(self):
+    self.latencies = []
+    self.statuses = {}
+    self.errors = {}
+    self.bytes = 0
+    self.duration = 0.0
+
+  @property
+  def requests(self):
+    return len(self.latencies)
+
+  def error(self, kind):
+    self.errors[kind] = self.errors.get(kind, 0) + 1
+
+  def merge(self, other):
+    self.latencies.extend(other.latencies)
+    for mine, theirs in ((self.statuses, other.statuses), (self.errors, other.errors)):
+      for key, value in theirs.items():
+        mine[key] = mine.get(key, 0) + value
+    self.bytes += other.bytes
+    self.duration = max(self.duration, other.duration)
+
+  def percentile(self, percent, ordered=None):
+    ordered = sorted(self.latencies) if ordered is None else ordered
+    if not ordered:
+      return 0.0
+    # Nearest rank
+    index = int(math.ceil(percent / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(index, len(ordered) - 1))]
+
+  def summary(self):
+    ordered = sorted(self.latencies)
+    duration = self.duration or 1e-9
+
+    return {
+      'requests': self.requests,
+      'duration': self.duration,
+      'requests_per_second': self.requests / duration,
+      'bytes': self.bytes,
+      'bytes_per_second': self.bytes / duration,
+      'errors': sum(self.errors.values()) + sum(v for k, v in self.statuses.items()
+        if k >= 500),
+      'error_kinds': self.errors,
+      'statuses': self.statuses,
+      'latency': {
+        'mean': sum(ordered) / len(ordered) if ordered else 0.0,
+        'p50': self.percentile(50, ordered),
+        'p95': self.percentile(95, ordered),
+        'p99': self.percentile(99, ordered),
+        'max': ordered[-1] if ordered else 0.0,
+      },
+    }
+
+
+class Client(object):
+  '''
+  One simulated client connection.
+  '''
+
+  def __init__(self):
+    self.socket = None
+    self.fd = None
+    self.reader = None
+    self.outgoing = ''
+    self.started = None
+    self.connected = False
+
+
+class LoadGenerator(object):
+  def __init__(self, host, port, path='/', concurrency=10, keep_alive=True, method='GET',
+      body='', headers=None, timeout=10):
+    '''
+    :param concurrency: Number of simultaneous connections
+    :param keep_alive: Send every request of a client on the same connection, instead of
+      a new connection per request
+    :param timeout: Requests that take longer than this many seconds count as errors
+    '''
+    self.address = (host, port)
+    self.concurrency = concurrency
+    self.keep_alive = keep_alive
+    self.timeout = timeout
+
+    lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s:%s' % (host, port)]
+    if not keep_alive:
+      lines.append('Connection: close')
+    if body:
+      lines.append('Content-Length: %s' % len(body))
+    for name, value in (headers or {}).items():
+      lines.append('%s: %s' % (name, value))
+    self.request = '\r\n'.join(lines) + '\r\n\r\n' + body
+
+    self.poller = None
+    self.clients = {}
+    self.results = None
+
+  def run(self, duration=None, requests=None):
+    '''
+    Generate load until ``duration`` seconds have passed or ``requests`` requests have
+    been answered, whichever comes first.
+
+    :return: :class:`Results`
+    '''
+    if duration is None and requests is None:
+      raise ValueError("Either a duration or a number of requests is required")
+
+    self.poller = poller.create_poller()
+    self.results = results = Results()
+    self.remaining = requests
+
+    start = time.time()
+    deadline = start + duration if duration is not None else None
+
+    try:
+      for i in xrange(self.concurrency):
+        self.connect(Client())
+
+      while self.clients:
+        now = time.time()
+        if deadline is not None and now >= deadline:
+          break
+
+        for fd, event in self.poller.poll(0.1):
+          client = self.clients.get(fd)
+          if client is None:
+            continue
+          if event & poller.WRITE:
+            self.handle_write(client)
+          if event & (poller.READ | poller.ERROR) and fd in self.clients:
+            self.handle_read(client)
+
+        self.check_timeouts(time.time())
+    finally:
+      results.duration = time.time() - start
+      for client in self.clients.values():
+        self.close(client)
+      self.poller.close()
+
+    return results
+
+  def connect(self, client):
+    if self.remaining is not None and self.remaining <= 0:
+      return
+
+    client.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    client.socket.setblocking(0)
+    client.fd = client.socket.fileno()
+    client.connected = False
+
+    error = client.socket.connect_ex(self.address)
+    if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+      self.results.error('connect')
+      client.socket.close()
+      return
+
+    self.clients[client.fd] = client
+    self.poller.register(client.fd, poller.WRITE)
+    self.start_request(client)
+
+  def start_request(self, client):
+    if self.remaining is not None:
+      self.remaining -= 1
+    client.reader = ResponseReader()
+    client.outgoing = self.request
+    client.started = time.time()
+
+  def handle_write(self, client):
+    if not client.connected:
+      error = client.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if error:
+        self.fail(client, 'connect')
+        return
+      client.connected = True
+
+    try:
+      sent = client.socket.send(client.outgoing)
+    except socket.error, e:
+      if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        self.fail(client, 'write')
+      return
+
+    client.outgoing = client.outgoing[sent:]
+    if not client.outgoing:
+      self.poller.modify(client.fd, poller.READ)
+
+  def handle_read(self, client):
+    try:
+      data = client.socket.recv(65536)
+    except socket.error, e:
+      if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        self.fail(client, 'read')
+      return
+
+    reader = client.reader
+    if not data:
+      if reader.eof():
+        self.finish(client, reopen=True)
+      else:
+        self.fail(client, 'closed')
+      return
+
+    if reader.feed(data):
+      self.finish(client, reopen=not (self.keep_alive and reader.keep_alive))
+
+  def finish(self, client, reopen):
+    results = self.results
+    reader = client.reader
+
+    results.latencies.append(time.time() - client.started)
+    results.statuses[reader.status] = results.statuses.get(reader.status, 0) + 1
+    results.bytes += reader.size
+
+    if reopen:
+      self.close(client)
+      self.connect(client)
+    elif self.remaining is not None and self.remaining <= 0:
+      self.close(client)
+    else:
+      self.start_request(client)
+      self.poller.modify(client.fd, poller.WRITE)
+
+  def fail(self, client, kind):
+    self.results.error(kind)
+    self.close(client)
+    self.connect(client)
+
+  def check_timeouts(self, now):
+    for client in self.clients.values():
+      if now - client.started > self.timeout:
+        self.fail(client, 'timeout')
+
+  def close(self, client):
+    if self.clients.pop(client.fd, None) is not None:
+      self.poller.unregister(client.fd)
+    client.socket.close()
+
+
+def run_clients(processes, host, port, duration=None, requests=None, **options):
+  '''
+  Run :class:`LoadGenerator` in ``processes`` processes at once, dividing the
+  concurrency (and the number of requests) between them.
+
+  :return: The combined :class:`Results`
+  '''
+  concurrency = options.pop('concurrency', 10)
+  if processes <= 1:
+    return LoadGenerator(host, port, concurrency=concurrency, **options).run(duration,
+      requests)
+
+  children = []
+  for i in xrange(processes):
+    share = concurrency // processes + (1 if i < concurrency % processes else 0)
+    count = None
+    if requests is not None:
+      count = requests // processes + (1 if i < requests % processes else 0)
+
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if not pid:
+      os.close(reader)
+      try:
+        results = LoadGenerator(host, port, concurrency=max(share, 1), **options).run(
+          duration, count)
+        with os.fdopen(writer, 'wb') as f:
+          pickle.dump(results.__dict__, f, pickle.HIGHEST_PROTOCOL)
+      finally:
+        os._exit(0)
+
+    os.close(writer)
+    children.append((pid, reader))
+
+  results = Results()
+  for pid, reader in children:
+    with os.fdopen(reader, 'rb') as f:
+      data = f.read()
+    os.waitpid(pid, 0)
+
+    if data:
+      child = Results()
+      child.__dict__.update(pickle.loads(data))
+      results.merge(child)
+    else:
+      results.error('client process')
+
+  return results
+
+
+def setup_app():
+  '''
+  Define the benchmark application's controller and routes.
+  '''
+  import frame
+
+  class Benchmark(frame.Controller):
+    def hello(self):
+      self.response.headers['Content-Type'] = 'text/plain'
+      return 'Hello, world!'
+
+    def data(self, size):
+      self.response.headers['Content-Type'] = 'application/octet-stream'
+      return 'x' * int(size)
+
+    def sleep(self, ms):
+      time.sleep(int(ms) / 1000.0)
+      self.response.headers['Content-Type'] = 'text/plain'
+      return 'Slept %sms' % ms
+
+  frame.routes.connect('/hello', 'benchmark#hello')
+  frame.routes.connect('/bytes/{size}', 'benchmark#data')
+  frame.routes.connect('/sleep/{ms}', 'benchmark#sleep')
+  return frame.app
+
+
+def start_server(host, port, log=False, **options):
+  '''
+  Start the benchmark application with :meth:`frame._app.App.start_http` in a child
+  process and wait for it to accept connections.
+
+  :param options: Passed on to ``start_http``
+  :return: The child's pid
+  '''
+  pid = os.fork()
+  if not pid:
+    exit_code = 0
+    try:
+      from frame._config import config
+      if not log:
+        config.logger.driver = 'null'
+      options.setdefault('auto_reload', False)
+      setup_app().start_http(host, port, **options)
+    except BaseException:
+      exit_code = 1
+    finally:
+      os._exit(exit_code)
+
+  deadline = time.time() + 10
+  while time.time() < deadline:
+    try:
+      socket.create_connection((host, port), 1).close()
+      return pid
+    except socket.error:
+      if os.waitpid(pid, os.WNOHANG)[0]:
+        break
+      time.sleep(0.05)
+
+  stop_server(pid)
+  raise RuntimeError("The benchmark server did not start")
+
+
+def stop_server(pid):
+  try:
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+  except OSError:
+    pass
+
+
+def free_port(host):
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  try:
+    sock.bind((host, 0))
+    return sock.getsockname()[1]
+  finally:
+    sock.close()
+
+
+def format_summary(summary, description):
+  latency = summary['latency']
+  ms = lambda i: '%.2fms' % (i * 1000)
+
+  lines = [
+    description,
+    '  Requests:  %s (%.1f/s)' % (summary['requests'], summary['requests_per_second']),
+    '  Errors:    %s%s' % (summary['errors'], ''.join(' %s=%s' % i for i in
+      sorted(summary['error_kinds'].items()))),
+    '  Transfer:  %.2f MB (%.2f MB/s)' % (summary['bytes'] / 1048576.0,
+      summary['bytes_per_second'] / 1048576.0),
+    '  Latency:   mean %s  p50 %s  p95 %s  p99 %s  max %s' % (ms(latency['mean']),
+      ms(latency['p50']), ms(latency['p95']), ms(latency['p99']), ms(latency['max'])),
+    '  Statuses:  %s' % ', '.join('%s=%s' % i for i in sorted(summary['statuses'].items())),
+  ]
+  return '\n'.join(lines)
+
+
+def parse_option(option):
+  name, value = option.split('=', 1)
+  try:
+    value = literal_eval(value)
+  except (ValueError, SyntaxError):
+    pass
+  return name, value
+
+
+def main(args=None):
+  parser = OptionParser(usage="python -m frame.benchmark [options]")
+  parser.add_option('-c', '--concurrency', type='int', default=50,
+    help="Simultaneous connections [%default]")
+  parser.add_option('-d', '--duration', type='float', default=10,
+    help="Seconds to run for [%default]")
+  parser.add_option('-n', '--requests', type='int',
+    help="Stop after this many requests instead")
+  parser.add_option('-p', '--path', default='/hello',
+    help="Path to request: /hello, /bytes/{size} or /sleep/{ms} [%default]")
+  parser.add_option('-k', '--no-keep-alive', action='store_false', dest='keep_alive',
+    default=True, help="Open a new connection for every request")
+  parser.add_option('-m', '--method', default='GET', help="Request method [%default]")
+  parser.add_option('-b', '--body-size', type='int', default=0,
+    help="Send a request body of this many bytes")
+  parser.add_option('-P', '--processes', type='int', default=1,
+    help="Client processes to spread the connections over [%default]")
+  parser.add_option('-w', '--workers', type='int',
+    help="Server processes (see frame.server.prefork)")
+  parser.add_option('-o', '--server-option', action='append', default=[],
+    metavar='NAME=VALUE', help="Option for start_http, e.g. num_workers=20")
+  parser.add_option('-u', '--url',
+    help="Benchmark an already running server instead of starting one")
+  parser.add_option('--log', action='store_true', help="Keep the server's logging")
+  parser.add_option('--json', action='store_true', help="Print the results as JSON")
+  options, args = parser.parse_args(args)
+
+  server_pid = None
+  if options.url:
+    url = urlparse(options.url)
+    host, port = url.hostname, url.port or 80
+    path = url.path or '/'
+    if url.query:
+      path += '?' + url.query
+  else:
+    host, port, path = '127.0.0.1', free_port('127.0.0.1'), options.path
+    server_options = dict(parse_option(i) for i in options.server_option)
+    if options.workers:
+      server_options['workers'] = options.workers
+    server_pid = start_server(host, port, options.log, **server_options)
+
+  try:
+    duration = None if options.requests else options.duration
+    results = run_clients(options.processes, host, port, duration, options.requests,
+      path=path, concurrency=options.concurrency, keep_alive=options.keep_alive,
+      method=options.method, body='x' * options.body_size)
+  finally:
+    if server_pid is not None:
+      stop_server(server_pid)
+
+  summary = results.summary()
+  summary.update({
+    'path': path,
+    'method': options.method,
+    'concurrency': options.concurrency,
+    'keep_alive': options.keep_alive,
+  })
+
+  if options.json:
+    print json.dumps(summary, sort_keys=True, indent=2)
+  else:
+    print format_summary(summary, '%s %s: %s connections, %s, %.1fs' % (options.method,
+      path, options.concurrency, 'keep-alive' if options.keep_alive else 'no keep-alive',
+      summary['duration']))
+
+  return 1 if summary['errors'] else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
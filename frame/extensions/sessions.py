@@ -16,7 +16,7 @@ import os
 from .._logger import logger
 from ..driverinterface import DriverInterface
 from threading import RLock
-from ..util import Hook
+from ..util import Hook, AtomicCounter
 
 
 sessions_config = DotDict({
@@ -87,7 +87,10 @@ class Session(object):
 
     self.init()
     
-    if key_name in app.request.cookies and not force:
+    # Whether the session was just created rather than loaded
+    self.is_new = force or key_name not in app.request.cookies
+
+    if not self.is_new:
       self._key = app.request.cookies[key_name]
       self._data = self.load(self._key)
     else:
@@ -502,11 +505,24 @@ class SessionInterface(DriverInterface):
       'mysql': MysqlSession
     })
     
+    # Sessions loaded, not found in the backend (expired or unknown) and created for
+    # new visitors; see frame._app.App.metrics
+    self.hits = AtomicCounter()
+    self.misses = AtomicCounter()
+    self.created = AtomicCounter()
+
   def init(self, driver):
     try:
-      return driver(self.database.app, self)
+      session = driver(self.database.app, self)
     except SessionLoadError:
+      self.misses.inc()
       return driver(self.database.app, self, force=True)
+
+    if session.is_new:
+      self.created.inc()
+    else:
+      self.hits.inc()
+    return session
       
   # Alias to match old session interface
   get_session = DriverInterface.load_current
@@ -0,0 +1,184 @@
+'''
+Admission control in front of :meth:`frame._app.App.__call__`. When traffic spikes,
+every request waits in line for a worker and, left alone, all of them end up answered
+too late to matter. It is better to turn some away at once with a cheap
+``503 Service Unavailable`` so that the rest are answered in time.
+
+How long a request waited is measured from when the server received it (the
+``frame.request_start`` key that Frame's servers put in the environ) or from the
+``X-Request-Start`` header set by the proxy in front, whichever is earlier. The header
+may hold seconds (``t=1408621526.123``, as nginx's ``$msec``), milliseconds or
+microseconds since the epoch.
+
+Requests are shed the way CoDel (Nichols and Jacobson, "Controlling Queue Delay")
+drops packets. Waiting times over ``target`` are tolerated for a while, since bursts
+come and go. Once they have stayed over it for a whole ``interval``, a request is
+shed, then more and more often (every ``interval / sqrt(n)`` seconds) for as long as
+the line stays long. As soon as a request is found to have waited less than
+``target``, shedding stops.
+
+It is off by default; enable it with ``config.load_shedding.enabled = True``. Requests
+for paths under ``config.load_shedding.exempt_paths``, and requests in the ``'high'``
+priority class (``frame.priority`` in the environ; see :mod:`frame.server.worker`),
+are never shed.
+'''
+
+
+import time
+import math
+import threading
+from _config import config
+
+
+#: ``X-Request-Start`` values further in the past than this are taken to be bogus
+max_queue_time = 3600
+
+
+def parse_request_start(value):
+  '''
+  The time in an ``X-Request-Start`` header, in seconds since the epoch, or ``None``.
+  '''
+  value = value.strip()
+  if value.startswith('t='):
+    value = value[2:]
+
+  try:
+    start = float(value)
+  except ValueError:
+    return None
+
+  # Milliseconds and microseconds since the epoch
+  if start > 1e14:
+    start /= 1e6
+  elif start > 1e11:
+    start /= 1e3
+  return start
+
+
+class LoadShedder(object):
+  '''
+  Decides which requests to shed; see the module documentation. Options default to
+  ``config.load_shedding``.
+  '''
+
+  status = '503 Service Unavailable'
+
+  def __init__(self, target=None, interval=None, retry_after=None, header=None,
+      exempt_paths=None, clock=time.time):
+    options = config.load_shedding
+    self.target = options.target if target is None else target
+    self.interval = options.interval if interval is None else interval
+    self.header = options.request_start_header if header is None else header
+    self.exempt_paths = tuple(options.exempt_paths if exempt_paths is None
+      else exempt_paths)
+
+    # Paths only match whole segments: '/health' covers '/health/db' but not '/healthy'
+    self.exempt_directories = tuple(i.rstrip('/') + '/' for i in self.exempt_paths)
+    self.clock = clock
+
+    retry_after = options.retry_after if retry_after is None else retry_after
+
+    # Rendered once; shedding has to be cheap
+    self.body = '<h1>%s</h1>' % self.status
+    self.headers = [('Content-Type', 'text/html'), ('Content-Length', str(len(self.body))),
+      ('Retry-After', str(retry_after)), ('Cache-Control', 'no-store')]
+
+    self.lock = threading.Lock()
+
+    # When waiting times will have been over target for a whole interval, if they are
+    # over it now
+    self.first_above = None
+
+    # While shedding: when to shed the next request and how many have been shed
+    self.dropping = False
+    self.drop_next = 0
+    self.count = 0
+    self.last_count = 0
+
+    self.admitted = 0
+    self.shed = 0
+
+  def queue_time(self, environ, now):
+    '''
+    How long a request has been waiting, or ``None`` if there is no telling.
+    '''
+    start = environ.get('frame.request_start')
+
+    header = environ.get(self.header) if self.header else None
+    if header:
+      proxy_start = parse_request_start(header)
+      if proxy_start is not None and now - max_queue_time < proxy_start and \
+          (start is None or proxy_start < start):
+        start = proxy_start
+
+    if start is None:
+      return None
+    return max(0.0, now - start)
+
+  def exempt(self, environ):
+    if environ.get('frame.priority') == 'high':
+      return True
+
+    path = environ.get('PATH_INFO', '')
+    return path in self.exempt_paths or path.startswith(self.exempt_directories)
+
+  def should_shed(self, environ):
+    now = self.clock()
+    waited = self.queue_time(environ, now)
+    if waited is None:
+      return False
+
+    sheddable = not self.exempt(environ)
+    with self.lock:
+      shed = self.update(waited, now, sheddable)
+      if shed:
+        self.shed += 1
+      else:
+        self.admitted += 1
+    return shed
+
+  def control_law(self, when):
+    return when + self.interval / math.sqrt(self.count)
+
+  def update(self, waited, now, sheddable):
+    '''
+    CoDel's state machine, run for every request; returns whether to shed it. Must be
+    called with the lock held.
+    '''
+    if waited < self.target:
+      self.first_above = None
+      ok_to_drop = False
+    elif self.first_above is None:
+      self.first_above = now + self.interval
+      ok_to_drop = False
+    else:
+      ok_to_drop = now >= self.first_above
+
+    if self.dropping:
+      if not ok_to_drop:
+        self.dropping = False
+      elif sheddable and now >= self.drop_next:
+        self.count += 1
+        self.drop_next = self.control_law(self.drop_next)
+        return True
+      return False
+
+    if not (ok_to_drop and sheddable):
+      return False
+
+    self.dropping = True
+
+    # If the last bout of shedding ended recently, start at about the rate it had
+    # reached rather than from scratch
+    delta = self.count - self.last_count
+    if delta > 1 and now - self.drop_next < 16 * self.interval:
+      self.count = delta
+    else:
+      self.count = 1
+    self.last_count = self.count
+    self.drop_next = self.control_law(now)
+    return True
+
+  def reject(self, start_response):
+    start_response(self.status, list(self.headers))
+    return [self.body]
@@ -0,0 +1,300 @@
+'''
+A micro-cache for whole responses, in front of :meth:`frame._app.App.__call__`. Pages
+that look the same for every anonymous visitor are rendered once and then served from
+memory for a short time (a second, by default): even that is enough to turn thousands
+of renders per second into one. While a page is being rendered, other requests for it
+wait for that render rather than starting their own.
+
+It is off by default; enable it with ``config.micro_cache.enabled = True``. Only
+``GET`` and ``HEAD`` requests without an ``Authorization`` header or any of
+``config.micro_cache.bypass_cookies`` (the session cookie, by default) are cached,
+keyed on the method, host, path, query string and the request headers named in
+``config.micro_cache.vary``. Responses are stored unless they set a cookie, say
+``Cache-Control: private``, have a status outside of
+``config.micro_cache.statuses``, or are streamed, files or too large. Frame's default
+``Cache-Control: no-store`` is meant for browsers and doesn't keep a response out of
+the micro-cache; per-user pages served to anonymous requests should be marked
+``private``.
+
+Since the session hook hands every new visitor a session cookie, the cookies named in
+``config.micro_cache.strip_cookies`` (the session cookie, by default) don't count:
+they are left out of the stored response, so visitors served from the cache get their
+session on the first page that isn't. A page that puts something in a new visitor's
+session (a CSRF token, say) must be marked ``private``.
+
+Under the asynchronous server (:mod:`frame.server.asyncio_http`), the responses of
+coroutine actions are not cached.
+'''
+
+
+import time
+import threading
+import itertools
+from collections import OrderedDict
+from staticdispatcher import StaticFile
+from _config import config
+
+
+class Entry(object):
+  '''
+  A stored response. An entry without a body records that the response couldn't be
+  cached, so that requests for it skip waiting on each other until it expires.
+  '''
+
+  __slots__ = ('status', 'headers', 'body', 'created', 'expires')
+
+  def __init__(self, status, headers, body, created, expires):
+    self.status = status
+    self.headers = headers
+    self.body = body
+    self.created = created
+    self.expires = expires
+
+
+class MicroCache(object):
+  '''
+  Caches the responses of a WSGI application for ``ttl`` seconds; see the module
+  documentation. Options default to ``config.micro_cache``.
+  '''
+
+  methods = ('GET', 'HEAD')
+
+  def __init__(self, ttl=None, max_entries=None, max_body_size=None, vary=None,
+      bypass_cookies=None, strip_cookies=None, statuses=None, wait_timeout=None,
+      clock=time.time):
+    options = config.micro_cache
+    self.ttl = options.ttl if ttl is None else ttl
+    self.max_entries = options.max_entries if max_entries is None else max_entries
+    self.max_body_size = options.max_body_size if max_body_size is None else max_body_size
+    self.vary = tuple(options.vary if vary is None else vary)
+    self.bypass_cookies = frozenset(options.bypass_cookies if bypass_cookies is None
+      else bypass_cookies)
+    self.strip_cookies = tuple('%s=' % i for i in (options.strip_cookies
+      if strip_cookies is None else strip_cookies))
+    self.statuses = frozenset(options.statuses if statuses is None else statuses)
+    self.wait_timeout = options.wait_timeout if wait_timeout is None else wait_timeout
+    self.clock = clock
+
+    # Entries in the order they were stored, so the oldest go first when it is full
+    self.entries = OrderedDict()
+
+    # Renders in progress, keyed like the entries: an Event set once each is done
+    self.pending = {}
+
+    self.lock = threading.Lock()
+
+    self.hits = 0
+    self.misses = 0
+    self.coalesced = 0
+
+  def key(self, environ):
+    '''
+    The cache key for a request, or ``None`` if it must not be served from the cache.
+    '''
+    method = environ.get('REQUEST_METHOD')
+    if method not in self.methods or 'HTTP_AUTHORIZATION' in environ:
+      return None
+
+    cookies = environ.get('HTTP_COOKIE')
+    if cookies and self.bypass_cookies:
+      for i in cookies.split(';'):
+        if i.split('=', 1)[0].strip() in self.bypass_cookies:
+          return None
+
+    return (method, environ.get('HTTP_HOST') or environ.get('SERVER_NAME'),
+      environ.get('SCRIPT_NAME', ''), environ.get('PATH_INFO', ''),
+      environ.get('QUERY_STRING', '')) + tuple(environ.get(i) for i in self.vary)
+
+  def stored_headers(self, status, headers):
+    '''
+    The headers to store a response with, or ``None`` if it can't be stored, judging
+    by its status and headers.
+    '''
+    try:
+      code = int(status.split(None, 1)[0])
+    except (ValueError, IndexError):
+      return None
+    if code not in self.statuses:
+      return None
+
+    stored = []
+    for name, value in headers:
+      lower = name.lower()
+      if lower == 'set-cookie':
+        if value.lstrip().startswith(self.strip_cookies):
+          continue
+        return None
+      if lower == 'cache-control' and 'private' in value.lower():
+        return None
+      stored.append((name, value))
+
+    return stored
+
+  def get(self, key):
+    '''
+    The fresh entry for ``key``, if there is one. Must be called with the lock held.
+    '''
+    entry = self.entries.get(key)
+    if entry is not None and entry.expires <= self.clock():
+      del self.entries[key]
+      entry = None
+    return entry
+
+  def store(self, key, entry):
+    '''
+    Must be called with the lock held.
+    '''
+    self.entries.pop(key, None)
+
+    if len(self.entries) >= self.max_entries:
+      now = self.clock()
+      for i in [k for k, v in self.entries.iteritems() if v.expires <= now]:
+        del self.entries[i]
+      while len(self.entries) >= self.max_entries:
+        self.entries.popitem(last=False)
+
+    self.entries[key] = entry
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def __call__(self, environ, start_response, app):
+    '''
+    Answer a request from the cache, or have ``app`` (a WSGI application) answer it.
+    '''
+    key = self.key(environ)
+    if key is None:
+      return app(environ, start_response)
+
+    with self.lock:
+      entry = self.get(key)
+      if entry is None:
+        done = self.pending.get(key)
+        leader = done is None
+        if leader:
+          done = self.pending[key] = threading.Event()
+
+    if entry is None and not leader:
+      # Someone else is rendering this page; use what they get
+      done.wait(self.wait_timeout)
+      with self.lock:
+        self.coalesced += 1
+        entry = self.get(key)
+      if entry is None:
+        # The render failed, or is taking too long
+        return app(environ, start_response)
+
+    if entry is not None:
+      if entry.body is None:
+        return app(environ, start_response)
+      with self.lock:
+        self.hits += 1
+      return self.serve(entry, start_response)
+
+    with self.lock:
+      self.misses += 1
+
+    try:
+      return self.render(key, environ, start_response, app)
+    finally:
+      with self.lock:
+        self.pending.pop(key, None)
+      done.set()
+
+  def serve(self, entry, start_response):
+    age = int(self.clock() - entry.created)
+    start_response(entry.status, entry.headers + [('Age', str(age))])
+    return [entry.body]
+
+  def render(self, key, environ, start_response, app):
+    '''
+    Run the application and store its response if it can be cached. The whole body
+    is collected first; a response that turns out to be streamed (it yields a flush
+    point), a file or too large is passed on without being stored.
+    '''
+    response = {}
+
+    def capture(status, headers, exc_info=None):
+      if 'forward' in response:
+        # Given up on caching before the application started its response
+        return start_response(status, headers, exc_info)
+      response['status'] = status
+      response['headers'] = list(headers)
+      response['exc_info'] = exc_info
+      return lambda data: chunks.append(data)
+
+    chunks = []
+    result = app(environ, capture)
+    now = self.clock()
+
+    if isinstance(result, StaticFile) or hasattr(result, 'filelike'):
+      # From wsgi.file_wrapper: best left to the server
+      return self.give_up(key, now, result, response, start_response, [], None)
+
+    iterator = iter(result)
+    size = 0
+    try:
+      for chunk in iterator:
+        # An empty chunk after some data is a flush point: the response is streamed
+        if isinstance(chunk, StaticFile) or (size and not chunk):
+          chunks.append(chunk)
+          return self.give_up(key, now, result, response, start_response, chunks,
+            iterator)
+
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > self.max_body_size:
+          return self.give_up(key, now, result, response, start_response, chunks,
+            iterator)
+    except:
+      if hasattr(result, 'close'):
+        result.close()
+      raise
+
+    if hasattr(result, 'close'):
+      result.close()
+
+    status, headers = response['status'], response['headers']
+    body = ''.join(chunks)
+
+    stored = self.stored_headers(status, headers)
+    with self.lock:
+      self.store(key, Entry(status, stored, body if stored is not None else None, now,
+        now + self.ttl))
+
+    start_response(status, headers, response['exc_info'])
+    return [body]
+
+  def give_up(self, key, now, result, response, start_response, chunks, iterator):
+    '''
+    Pass on a response that can't be cached, from wherever collecting it stopped.
+    '''
+    with self.lock:
+      self.store(key, Entry(None, None, None, now, now + self.ttl))
+
+    if 'status' in response:
+      start_response(response['status'], response['headers'], response['exc_info'])
+    else:
+      response['forward'] = True
+    if iterator is None:
+      return result
+
+    return ClosingIterator(itertools.chain(chunks, iterator), getattr(result, 'close', None))
+
+
+class ClosingIterator(object):
+  '''
+  An iterator that passes ``close`` on to the original response, as WSGI requires.
+  '''
+
+  def __init__(self, iterator, close):
+    self.iterator = iterator
+    self._close = close
+
+  def __iter__(self):
+    return self.iterator
+
+  def close(self):
+    if self._close is not None:
+      self._close()
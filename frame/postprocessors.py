@@ -15,7 +15,8 @@ from util import format_date, get_gmt_now
 def deflate(request, response):
 	'''
 	Sets response content-encoding to 'deflate' and uses zlib compression to compress the
-	response body.
+	response body. Files (:class:`frame.staticdispatcher.StaticFile` bodies) are left
+	for the server to send as they are.
 	
 	:param request: The current :mod:`frame.request.Request` object
 	:param response: The current :mod:`frame.response.Response` object
@@ -23,7 +24,7 @@ def deflate(request, response):
 	
 	if 'accept_encoding' in request.headers:
 		if 'deflate' in request.headers.accept_encoding.split(','):
-			if response.body:
+			if response.body and isinstance(response.body, basestring):
 				compressed = zlib.compress(response.body)
 				response.headers['Content-Encoding'] = 'deflate'
 				response.headers['Content-Length'] = str(len(compressed))
@@ -8,7 +8,10 @@ from _logger import logger
 from _config import config
 from errors import Error500, HTTPError
 from response import Response
+from staticdispatcher import StaticFile
 import types
+import os
+import itertools
 import contextlib
 
 
@@ -18,15 +21,31 @@ class Renderer(object):
     self.request = app.request
     self.response = response
     self.start_response = start_response
+
+    # Whether to yield StaticFile bodies as they are; see respond()
+    self.keep_files = False
     
-  def _render_response(self, response):
-    # Apply pre processors, then render the response
+  def prepare(self, response):
+    '''
+    Apply pre processors, then call the controller action.
+    '''
     for i in self.app.preprocessors:
       i(self.request, response)
     response.render()
-    
-    # Need to do something more elegant to handle generators/chunked encoding...
-    # Also need to come up with a better way to log chunked encodings
+
+  def _render_response(self, response):
+    self.prepare(response)
+    for i in self.deliver(response):
+      yield i
+
+  def deliver(self, response):
+    '''
+    Apply post processors, start the WSGI response and yield the body of a response
+    that has been prepared with :meth:`prepare`.
+    '''
+    # Generator bodies are streamed; the server takes care of the framing (chunked
+    # encoding in the built-in server) and sends whatever has been produced whenever a
+    # frame.flush is yielded. Need to come up with a better way to log these.
     if type(response.body) is types.GeneratorType:
       self.start_response(response.status, response.headers.items())
       response_length = 0
@@ -52,15 +71,29 @@ class Renderer(object):
       
       # Deliver the goods
       self.start_response(response.status, response.headers.items())
-      yield str(response.body)
+
+      if isinstance(response.body, StaticFile):
+        # Servers that can sendfile() (or wrap files, see respond()) take the file
+        # itself; everyone else reads it
+        if self.keep_files or self.request.environ.get('frame.sendfile'):
+          yield response.body
+        else:
+          for i in response.body:
+            yield i
+      else:
+        yield str(response.body)
       try:
         logger.log_request(self.request, response, len(response.body) if response.body else 0)
       except Exception:
         pass
     
-  def render(self):
-    response = self.response
-    
+  def load_hooks(self, response):
+    '''
+    Load the hooks (context managers) to run the response in.
+
+    :return: A tuple of ``(hooks, response)``; the response is replaced with an error if
+      the hooks could not be loaded
+    '''
     if 'match' in self.app.thread_data:
       hooks = map(
         lambda x: self.app.drivers.hook.load_driver(x, self.app,
@@ -74,6 +107,38 @@ class Renderer(object):
 
     else:
       hooks = []
+
+    return hooks, response
+
+  def respond(self):
+    '''
+    The WSGI response: normally a generator that renders the response as it is
+    iterated (see :meth:`render`). A response for a static file is rendered right away instead and the
+    file handed to the server's ``wsgi.file_wrapper``, if it provides one, so that the
+    server can send it however it sends files best (e.g., with ``sendfile``).
+    '''
+    file_wrapper = self.request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is None or not isinstance(self.response.body, StaticFile):
+      return self.render()
+
+    self.keep_files = True
+    chunks = list(self.render())
+
+    if len(chunks) == 1 and isinstance(chunks[0], StaticFile):
+      body = chunks[0]
+      # A file wrapper sends everything from the current position on, so only a region
+      # that runs to the end of the file can be wrapped
+      if body.offset + body.length == os.fstat(body.fileno()).st_size:
+        body.file.seek(body.offset)
+        return file_wrapper(body.file, body.block_size)
+
+    if self.request.environ.get('frame.sendfile'):
+      return chunks
+    return itertools.chain.from_iterable(i if isinstance(i, StaticFile) else [i]
+      for i in chunks)
+
+  def render(self):
+    hooks, response = self.load_hooks(self.response)
       
     def wrap_response(response):
       with contextlib.nested(*hooks):
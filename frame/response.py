@@ -5,6 +5,12 @@ from headersdict import HeadersDict
 import errors
 
 
+#: Yield this from a generator action to have everything produced so far sent to the
+#: client right away (e.g., the top of a page before a slow query runs). It is simply an
+#: empty block, which WSGI servers must not hold back.
+flush = ''
+
+
 class Response(object):
   '''
   The :class:`Response` class stores a collection of data about the HTTP response. It is
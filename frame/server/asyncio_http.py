@@ -0,0 +1,431 @@
+'''
+An asynchronous HTTP server for Frame built on :mod:`asyncio` (``trollius`` on
+Python 2). Requests are dispatched on the event loop. Controller actions that are
+coroutines run right there, so an action that mostly waits on upstream I/O costs no more
+than a suspended task; ordinary actions are run in a thread pool, just as they would be by
+:mod:`frame.server.http`. The server is normally started through
+:meth:`frame._app.App.start_async`.
+
+Every request is handled by its own task, and :class:`frame.threaddata.ThreadData`
+keys request data on that task. Tasks started on its behalf (which includes every
+coroutine awaited with ``yield From``) and pool threads working for it share the
+request's data, so ``self.request`` and ``self.response`` work in coroutine actions just
+like they do in synchronous ones.
+
+Requests go through the application's load shedder and micro-cache (see
+:mod:`frame.loadshedding` and :mod:`frame.microcache`) as they do under the other
+servers, except that the responses of coroutine actions are never cached: the
+micro-cache may block, so it is only consulted in the thread pool.
+'''
+
+
+import os
+import sys
+import signal
+import socket
+import threading
+import traceback
+import contextlib
+import weakref
+from frame import logger
+from frame import threaddata
+from frame._config import config
+from frame.errors import HTTPError, Error500
+from frame.renderer import Renderer
+from parser import RequestParser, ParseError
+from http import make_environ, make_socket, keep_alive_requested, response_has_body
+import modulemonitor
+
+try:
+  import trollius as asyncio
+  from trollius import From, Return
+  from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+  raise ImportError("The asynchronous server requires trollius (pip install trollius)")
+
+
+class HTTPProtocol(asyncio.Protocol):
+  '''
+  One client connection. Requests are answered one at a time; reading is paused while
+  a request is being handled, so pipelined requests simply wait their turn.
+  '''
+
+  def __init__(self, server):
+    self.server = server
+    self.transport = None
+    self.addr = None
+    self.parser = None
+    self.task = None
+    self.closed = False
+
+    # Set while the transport's write buffer is above its high-water mark
+    self.drained = None
+
+  def connection_made(self, transport):
+    self.transport = transport
+    self.addr = transport.get_extra_info('peername')
+    self.server.connections.add(self)
+    self.reset()
+
+  def connection_lost(self, exc):
+    self.closed = True
+    self.server.connections.discard(self)
+
+    if self.parser.body is not None:
+      self.parser.body.abort()
+      self.parser.body.close()
+
+    if self.task is not None:
+      self.task.cancel()
+    self.resume_writing()
+
+  def reset(self):
+    server = self.server
+    self.parser = RequestParser(server.max_header_size, server.max_body_size,
+      server.spool_threshold)
+
+  def data_received(self, data):
+    try:
+      self.parser.feed(data)
+    except ParseError, e:
+      self.send_error(e.status)
+      return
+
+    if self.parser.complete and self.task is None:
+      self.transport.pause_reading()
+      self.task = self.server.loop.create_task(self.handle_request())
+
+  def pause_writing(self):
+    self.drained = asyncio.Future(loop=self.server.loop)
+
+  def resume_writing(self):
+    if self.drained is not None:
+      if not self.drained.done():
+        self.drained.set_result(None)
+      self.drained = None
+
+  @asyncio.coroutine
+  def handle_request(self):
+    environ = make_environ(self.parser, self.server, self.addr)
+    keep_alive = self.server.keep_alive and keep_alive_requested(environ)
+
+    try:
+      status, headers, body = yield From(self.server.run_application(environ))
+    except asyncio.CancelledError:
+      return
+
+    if self.closed:
+      return
+
+    keep_alive = self.send_response(status, headers, body, keep_alive,
+      environ['SERVER_PROTOCOL'], environ['REQUEST_METHOD'] == 'HEAD')
+
+    # Don't read the next request until the client has taken most of this response
+    if self.drained is not None:
+      try:
+        yield From(self.drained)
+      except asyncio.CancelledError:
+        return
+
+    self.task = None
+    if self.closed:
+      return
+
+    if not keep_alive or not self.server.running:
+      self.transport.close()
+      return
+
+    leftover = self.parser.leftover
+    self.parser.body.close()
+    self.reset()
+    self.transport.resume_reading()
+
+    if leftover:
+      self.data_received(leftover)
+
+  def send_error(self, status):
+    self.send_response(status, [('Content-Type', 'text/html')], ['<h1>%s</h1>' % status],
+      False, 'HTTP/1.1')
+    self.transport.close()
+
+  def send_response(self, status, headers, body, keep_alive, protocol, head=False):
+    '''
+    Write a complete response; for a HEAD request (``head``), only its headers.
+
+    :return: Whether or not the connection should be kept open
+    '''
+    headers = list(headers)
+    header_names = dict((k.lower(), v) for k, v in headers)
+
+    if 'close' in header_names.get('connection', '').lower():
+      keep_alive = False
+
+    if 'content-length' not in header_names and response_has_body(status):
+      headers.append(('Content-Length', str(sum(len(i) for i in body))))
+
+    if 'connection' not in header_names:
+      if not keep_alive:
+        headers.append(('Connection', 'close'))
+      elif protocol == 'HTTP/1.0':
+        headers.append(('Connection', 'keep-alive'))
+
+    lines = ["HTTP/1.1 %s" % status]
+    lines.extend("%s: %s" % (k, v) for k, v in headers)
+    lines.append("\r\n")
+
+    # Anything after the headers of a HEAD response would be taken for the start of the
+    # next response
+    if head:
+      body = []
+
+    self.transport.writelines(["\r\n".join(lines)] + [i for i in body if i])
+    return keep_alive
+
+
+class AsyncHTTPServer(object):
+  def __init__(self, app, host='localhost', port=8080, listen=128, auto_reload=True,
+      keep_alive=None, num_workers=None, max_header_size=None, max_body_size=None,
+      spool_threshold=None):
+    '''
+    :param app: The WSGI application; coroutine actions are only recognized if this is
+      the Frame application itself
+    :param num_workers: Size of the thread pool that runs synchronous actions
+    '''
+    from frame._app import App
+
+    self.app = app
+    self.frame_app = isinstance(app, App)
+    self.host = host
+    self.port = port
+    self.listen = listen
+    self.auto_reload = auto_reload
+
+    http_config = config.http_server
+    self.keep_alive = http_config.keep_alive if keep_alive is None else keep_alive
+    self.num_workers = http_config.num_workers if num_workers is None else num_workers
+    self.max_header_size = http_config.max_header_size if max_header_size is None \
+      else max_header_size
+    self.max_body_size = http_config.max_body_size if max_body_size is None \
+      else max_body_size
+    self.spool_threshold = http_config.spool_threshold if spool_threshold is None \
+      else spool_threshold
+
+    # Constant parts of every WSGI environ
+    self.script_filename = os.path.abspath(sys.argv[0])
+    self.document_root = os.getcwd() + '/'
+
+    self.loop = asyncio.new_event_loop()
+    self.loop.set_default_executor(ThreadPoolExecutor(max(self.num_workers, 1)))
+    self.loop.set_task_factory(self.create_task)
+    self.loop_thread = None
+
+    # The request task each task was (directly or indirectly) started by
+    self.task_contexts = weakref.WeakKeyDictionary()
+
+    self.socket = None
+    self.listener = None
+    self.connections = set()
+    self.running = True
+
+    if self.auto_reload:
+      self.module_monitor = modulemonitor.ModuleMonitor(self)
+
+  def bind_socket(self):
+    self.socket = make_socket()
+    self.socket.bind((self.host, self.port))
+    self.socket.listen(self.listen)
+    self.socket.setblocking(0)
+
+  def setup_signal_handlers(self):
+    for signum in (signal.SIGTERM, signal.SIGINT):
+      self.loop.add_signal_handler(signum, self.stop, True)
+
+  def create_task(self, loop, coro):
+    '''
+    Task factory for the event loop: a task inherits the context of the task that
+    started it.
+    '''
+    parent = self.current_context()
+    task = asyncio.Task(coro, loop=loop)
+    self.task_contexts[task] = parent if parent is not None else task
+    return task
+
+  def current_context(self):
+    '''
+    Context provider for :mod:`frame.threaddata`: the request task on whose behalf the
+    event loop is currently running.
+    '''
+    if threading.current_thread() is self.loop_thread:
+      task = asyncio.Task.current_task(self.loop)
+      if task is not None:
+        return self.task_contexts.get(task, task)
+
+  def run(self):
+    try:
+      self.bind_socket()
+    except socket.error, e:
+      logger.log_error("Could not start HTTP Server: %s" % e.args[1])
+      sys.exit(1)
+
+    self.setup_signal_handlers()
+
+    if self.auto_reload:
+      self.module_monitor.start()
+
+    logger.log_info("Frame asynchronous HTTP Server is now ready")
+    self.serve_forever()
+
+  def serve_forever(self):
+    '''
+    Run the event loop until :meth:`stop` is called. The socket must already be bound.
+    '''
+    asyncio.set_event_loop(self.loop)
+    self.loop_thread = threading.current_thread()
+    threaddata.context_providers.append(self.current_context)
+
+    try:
+      self.listener = self.loop.run_until_complete(self.loop.create_server(
+        lambda: HTTPProtocol(self), sock=self.socket))
+      if self.running:
+        self.loop.run_forever()
+    finally:
+      threaddata.context_providers.remove(self.current_context)
+
+      if self.listener is not None:
+        self.listener.close()
+        for i in list(self.connections):
+          i.transport.close()
+        self.loop.run_until_complete(self.listener.wait_closed())
+
+      self.loop.close()
+
+  def stop(self, stop_monitor=False):
+    '''
+    Tell the event loop to exit. Safe to call from any thread.
+    '''
+    logger.log_info("Shutting down Frame asynchronous HTTP Server...")
+    self.running = False
+
+    if not self.loop.is_closed():
+      self.loop.call_soon_threadsafe(self.loop.stop)
+
+    if stop_monitor and self.auto_reload:
+      self.module_monitor.stop()
+      self.module_monitor.join()
+
+  @asyncio.coroutine
+  def run_application(self, environ):
+    '''
+    Run the application for one request, in the request's task.
+
+    :return: A tuple of ``(status, headers, body_chunks)``
+    '''
+    context = self.current_context()
+    result = {}
+
+    # Taken by the pool thread when it starts on the request; if it never does, the
+    # request's data is cleaned up here instead
+    claim = threading.Lock()
+
+    def start_response(status, headers, exc_info=None):
+      result['status'] = status
+      result['headers'] = headers
+
+    try:
+      if not self.frame_app:
+        body = yield From(self.loop.run_in_executor(None, self.run_wsgi, context, environ,
+          start_response))
+
+      elif self.app.load_shedder is not None and \
+          self.app.load_shedder.should_shed(environ):
+        # As App.__call__ does; deciding is cheap enough to do right here
+        body = self.app.load_shedder.reject(start_response)
+
+      else:
+        # Routing is cheap enough to do right here
+        response = self.app.dispatch(environ)
+        action = getattr(response, 'action', None)
+
+        if action is not None and asyncio.iscoroutinefunction(action):
+          body = yield From(self.render(response, start_response))
+        else:
+          body = yield From(self.loop.run_in_executor(None, self.run_renderer, claim,
+            context, response, environ, start_response))
+
+    except asyncio.CancelledError:
+      # E.g., the client went away; a pool thread already at work cleans up after itself
+      if claim.acquire(False):
+        self.app.thread_data.clean()
+      raise
+    except Exception:
+      logger.log_exception(traceback.format_exc())
+      result['status'] = '500 Internal Server Error'
+      result['headers'] = [('Content-Type', 'text/html')]
+      body = ['<h1>500 Internal Server Error</h1>']
+
+    raise Return((result['status'], result['headers'], body))
+
+  def run_wsgi(self, context, environ, start_response):
+    # Runs in the thread pool
+    with threaddata.bind(context):
+      response = self.app(environ, start_response)
+      try:
+        return [str(i) for i in response]
+      finally:
+        if hasattr(response, 'close'):
+          response.close()
+
+  def run_renderer(self, claim, context, response, environ, start_response):
+    # Runs in the thread pool
+    if not claim.acquire(False):
+      # Cancelled before it got here
+      return []
+
+    def respond(environ, start_response):
+      return Renderer(self.app, response, start_response)
+
+    with threaddata.bind(context):
+      try:
+        # The micro-cache may wait on another render of the same page, so it is only
+        # consulted here, off the event loop
+        micro_cache = self.app.micro_cache
+        if micro_cache is None:
+          return [str(i) for i in respond(environ, start_response)]
+
+        body = micro_cache(environ, start_response, respond)
+        try:
+          return [str(i) for i in body]
+        finally:
+          if hasattr(body, 'close'):
+            body.close()
+      finally:
+        self.app.thread_data.clean()
+
+  @asyncio.coroutine
+  def render(self, response, start_response):
+    '''
+    The asynchronous counterpart of iterating a :class:`frame.renderer.Renderer`: the
+    coroutine returned by the action is awaited before the response is delivered.
+    '''
+    renderer = Renderer(self.app, response, start_response)
+
+    try:
+      hooks, response = renderer.load_hooks(response)
+      with contextlib.nested(*hooks):
+        renderer.prepare(response)
+        if asyncio.iscoroutine(response.body):
+          result = yield From(response.body)
+          response.body = '' if result is None else result
+        body = [str(i) for i in renderer.deliver(response)]
+
+    except asyncio.CancelledError:
+      raise
+    except HTTPError, e:
+      body = [str(i) for i in Renderer(self.app, e.response, start_response)]
+    except Exception:
+      body = [str(i) for i in Renderer(self.app, Error500().response, start_response)]
+    finally:
+      # Also when the task is cancelled, or the request's data would stay behind
+      self.app.thread_data.clean()
+
+    raise Return(body)
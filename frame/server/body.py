@@ -0,0 +1,117 @@
+'''
+The ``wsgi.input`` object used by the built-in server. The request body is written to
+it by the event loop as it arrives off of the socket while the application reads from
+it in a worker thread, blocking until enough of the body is available. Bodies larger
+than the spool threshold are kept in a temporary file rather than in memory.
+'''
+
+
+from threading import Condition
+from tempfile import SpooledTemporaryFile
+
+
+class RequestBody(object):
+  def __init__(self, length, spool_threshold=1048576):
+    '''
+    :param length: The length of the body (from Content-Length)
+    :param spool_threshold: Bodies larger than this many bytes are spooled to disk
+    '''
+    self.length = length
+    self.received = 0
+    self.position = 0
+    self.aborted = False
+
+    self._file = SpooledTemporaryFile(max_size=spool_threshold)
+    self._condition = Condition()
+
+  def __repr__(self):
+    return "<RequestBody(%s/%s)>" % (self.received, self.length)
+
+  def __iter__(self):
+    while True:
+      line = self.readline()
+      if not line:
+        return
+      yield line
+
+  @property
+  def complete(self):
+    return self.received >= self.length
+
+  def write(self, data):
+    '''
+    Append received data; called by the event loop.
+    '''
+    self._condition.acquire()
+    try:
+      self._file.seek(self.received)
+      self._file.write(data)
+      self.received += len(data)
+      self._condition.notify_all()
+    finally:
+      self._condition.release()
+
+  def abort(self):
+    '''
+    The client went away; wake up any reader so that it fails instead of waiting
+    forever.
+    '''
+    self._condition.acquire()
+    try:
+      self.aborted = True
+      self._condition.notify_all()
+    finally:
+      self._condition.release()
+
+  def _wait(self, size):
+    # Must be called with the condition held
+    while self.received - self.position < size and not self.complete:
+      if self.aborted:
+        raise IOError("Client disconnected before sending the whole request body")
+      self._condition.wait()
+
+  def read(self, size=-1):
+    remaining = self.length - self.position
+    if size is None or size < 0 or size > remaining:
+      size = remaining
+
+    self._condition.acquire()
+    try:
+      self._wait(size)
+      self._file.seek(self.position)
+      data = self._file.read(size)
+      self.position += len(data)
+      return data
+    finally:
+      self._condition.release()
+
+  def readline(self, size=-1):
+    line = []
+    wanted = size if size is not None and size >= 0 else self.length
+
+    while wanted > 0 and self.position < self.length:
+      self._condition.acquire()
+      try:
+        self._wait(1)
+        self._file.seek(self.position)
+        data = self._file.readline(min(wanted, self.received - self.position))
+        self.position += len(data)
+      finally:
+        self._condition.release()
+
+      line.append(data)
+      wanted -= len(data)
+      if data.endswith('\n'):
+        break
+
+    return ''.join(line)
+
+  def readlines(self, hint=None):
+    return list(self)
+
+  def close(self):
+    self._condition.acquire()
+    try:
+      self._file.close()
+    finally:
+      self._condition.release()
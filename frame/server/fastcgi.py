@@ -0,0 +1,790 @@
+'''
+Frame's own FastCGI responder, on the same event loop, worker pool and prefork
+machinery as :mod:`frame.server.http`. It listens on a TCP port, on a Unix socket or on
+the socket the web server passed as standard input (the way ``spawn-fcgi`` and
+``mod_fcgid`` start responders). It is normally started through
+:meth:`frame._app.App.start_fcgi`::
+
+  frame.start_fcgi(path='/run/myapp.sock')
+
+Records are parsed as they arrive. Several requests may be multiplexed over one
+connection, and connections are kept open for further requests when the web server asks
+for it (``FCGI_KEEP_CONN``). The request body (``FCGI_STDIN``) is streamed into
+``wsgi.input`` while the application is already running, and the response goes out as
+``FCGI_STDOUT`` records as it is produced.
+
+Apart from ``metrics_path`` and ``expect_continue``, every option of
+:class:`frame.server.http.HTTPServer` applies, with the same defaults from
+``config.http_server``.
+'''
+
+
+import os
+import sys
+import stat
+import socket
+import struct
+import time
+import errno
+from collections import deque
+from frame import logger
+from frame._config import config
+from frame.staticdispatcher import StaticFile
+from http import HTTPServer, Connection, FileWrapper, run_application
+from body import RequestBody
+from stream import ResponseStream, IteratorStream
+import poller
+import handoff
+
+
+FCGI_VERSION_1 = 1
+
+FCGI_BEGIN_REQUEST = 1
+FCGI_ABORT_REQUEST = 2
+FCGI_END_REQUEST = 3
+FCGI_PARAMS = 4
+FCGI_STDIN = 5
+FCGI_STDOUT = 6
+FCGI_STDERR = 7
+FCGI_DATA = 8
+FCGI_GET_VALUES = 9
+FCGI_GET_VALUES_RESULT = 10
+FCGI_UNKNOWN_TYPE = 11
+
+FCGI_RESPONDER = 1
+FCGI_KEEP_CONN = 1
+
+FCGI_REQUEST_COMPLETE = 0
+FCGI_CANT_MPX_CONN = 1
+FCGI_OVERLOADED = 2
+FCGI_UNKNOWN_ROLE = 3
+
+#: The descriptor of the listening socket passed by the web server
+FCGI_LISTENSOCK_FILENO = 0
+
+header = struct.Struct('!BBHHBx')
+begin_request_body = struct.Struct('!HB5x')
+end_request_body = struct.Struct('!LB3x')
+unknown_type_body = struct.Struct('!B7x')
+
+#: Largest record content written; a multiple of 8, so records need no padding
+max_content = 65528
+
+
+class ProtocolError(Exception):
+  pass
+
+
+def encode_record(record_type, request_id, content=''):
+  '''
+  :return: A list of strings making up the record (the header, the content and any
+    padding), so that the content doesn't have to be copied
+  '''
+  length = len(content)
+  padding = -length % 8
+  parts = [header.pack(FCGI_VERSION_1, record_type, request_id, length, padding)]
+  if length:
+    parts.append(content)
+  if padding:
+    parts.append('\0' * padding)
+  return parts
+
+
+def encode_stream(record_type, request_id, data):
+  '''
+  Split stream data into as many records as it takes.
+  '''
+  parts = []
+  for i in xrange(0, len(data), max_content):
+    parts.extend(encode_record(record_type, request_id, data[i:i + max_content]))
+  return parts
+
+
+def _length(data, offset):
+  length = ord(data[offset])
+  if length < 128:
+    return length, offset + 1
+  return struct.unpack_from('!L', data, offset)[0] & 0x7fffffff, offset + 4
+
+
+def decode_params(data):
+  '''
+  Decode a stream of FastCGI name-value pairs.
+
+  :raise ProtocolError: If the data is truncated
+  '''
+  params = {}
+  offset = 0
+  end = len(data)
+
+  try:
+    while offset < end:
+      name_length, offset = _length(data, offset)
+      value_length, offset = _length(data, offset)
+      name = data[offset:offset + name_length]
+      offset += name_length
+      value = data[offset:offset + value_length]
+      offset += value_length
+
+      if offset > end:
+        raise ProtocolError("Truncated name-value pair")
+      params[name] = value
+  except (IndexError, struct.error):
+    raise ProtocolError("Truncated name-value pair")
+
+  return params
+
+
+def encode_params(params):
+  parts = []
+  for name, value in params:
+    for i in (name, value):
+      length = len(i)
+      parts.append(chr(length) if length < 128 else struct.pack('!L', length | 0x80000000))
+    parts.append(name)
+    parts.append(value)
+  return ''.join(parts)
+
+
+def file_wrapper(filelike, block_size=StaticFile.block_size):
+  '''
+  The FastCGI server's ``wsgi.file_wrapper``; files have to be read to be framed, so
+  there is nothing to gain over reading them in blocks.
+  '''
+  return FileWrapper(filelike, block_size)
+
+
+class RecordParser(object):
+  '''
+  Splits the data received on a connection into records.
+  '''
+
+  #: Connections are never in the middle of an HTTP request head
+  headers_complete = False
+
+  #: The request bodies belong to the requests
+  body = None
+
+  def __init__(self):
+    self.buffer = ''
+
+  @property
+  def started(self):
+    '''
+    Whether part of a record has been received.
+    '''
+    return bool(self.buffer)
+
+  def feed(self, data):
+    '''
+    :return: A list of ``(type, request_id, content)`` tuples for the complete records
+    :raise ProtocolError: If the data isn't FastCGI
+    '''
+    buffer = self.buffer + data if self.buffer else data
+    records = []
+    offset = 0
+    available = len(buffer)
+
+    while available - offset >= header.size:
+      version, record_type, request_id, length, padding = header.unpack_from(buffer, offset)
+      if version != FCGI_VERSION_1:
+        raise ProtocolError("Unsupported FastCGI version %s" % version)
+
+      start = offset + header.size
+      end = start + length + padding
+      if end > available:
+        break
+
+      records.append((record_type, request_id, buffer[start:start + length]))
+      offset = end
+
+    self.buffer = buffer[offset:]
+    return records
+
+
+class Request(object):
+  '''
+  One FastCGI request on a connection.
+  '''
+
+  def __init__(self, request_id, keep_conn):
+    self.id = request_id
+    self.keep_conn = keep_conn
+
+    # FCGI_PARAMS records until the empty one that ends them
+    self.params = []
+    self.environ = None
+
+    self.body = None
+    self.stdin_complete = False
+
+    # Set once the request has been handed to the application
+    self.started = False
+    self.aborted = False
+
+    # The rest of the response, if it is streamed
+    self.stream = None
+
+    # See ServerMetrics
+    self.request_start = None
+    self.app_start = None
+    self.app_end = None
+
+  def __repr__(self):
+    return "<Request(%s)>" % self.id
+
+
+class FastCGIConnection(Connection):
+  '''
+  A connection from the web server. The write buffer holds encoded records; the
+  end of every request is marked by a ``None``, as the end of every response is for
+  :class:`frame.server.http.Connection`.
+  '''
+
+  def __init__(self, server, accept):
+    Connection.__init__(self, server, accept)
+
+    # Unix sockets have no peer address; the web server passes the client's in the
+    # request parameters anyway
+    if not isinstance(self.addr, tuple):
+      self.addr = ('unix', 0)
+
+  def reset(self):
+    '''
+    Set up the connection's state. Unlike HTTP connections, FastCGI connections are
+    not reset between requests: several may be in progress at once.
+    '''
+    self.parser = RecordParser()
+
+    # Requests in progress, by request id
+    self.requests = {}
+
+    # The requests whose end is marked in the write buffer, in order
+    self.ending = deque()
+
+    # Cleared as soon as one request doesn't ask to keep the connection open
+    self.keep_conn = True
+
+  @property
+  def in_flight(self):
+    return bool(self.requests)
+
+  def pending_requests(self):
+    # Requests whose end is in the write buffer are in self.ending
+    return len(self.requests) + len(self.ending)
+
+  @property
+  def reading_body(self):
+    return any(not i.stdin_complete for i in self.requests.values())
+
+  def update_interest(self):
+    if self.closed:
+      return
+
+    # Always read: more requests, or aborts, may arrive on the connection at any time
+    events = poller.READ
+    if self.write_buffer and not self.write_paused:
+      events |= poller.WRITE
+
+    if events != self.events:
+      self.events = events
+      self.server.poller.modify(self.fd, events)
+
+    self.update_timeout()
+
+  def receive(self, data):
+    try:
+      records = self.parser.feed(data)
+      for record_type, request_id, content in records:
+        if self.closed:
+          return
+        self.handle_record(record_type, request_id, content)
+    except ProtocolError, e:
+      logger.log_warning("Closing FastCGI connection: %s" % e)
+      self.close()
+      return
+
+    if self.timeout_phase == 'keep_alive':
+      self.update_timeout()
+
+  def handle_record(self, record_type, request_id, content):
+    if request_id == 0:
+      if record_type == FCGI_GET_VALUES:
+        self.get_values(content)
+      else:
+        self.send_records(encode_record(FCGI_UNKNOWN_TYPE, 0,
+          unknown_type_body.pack(record_type)))
+      return
+
+    if record_type == FCGI_BEGIN_REQUEST:
+      self.begin_request(request_id, content)
+      return
+
+    request = self.requests.get(request_id)
+    if request is None:
+      # Records for a request that was aborted or already answered
+      return
+
+    if record_type == FCGI_PARAMS:
+      self.receive_params(request, content)
+    elif record_type == FCGI_STDIN:
+      self.receive_stdin(request, content)
+    elif record_type == FCGI_ABORT_REQUEST:
+      self.abort_request(request)
+    elif record_type != FCGI_DATA:
+      self.send_records(encode_record(FCGI_UNKNOWN_TYPE, 0,
+        unknown_type_body.pack(record_type)))
+
+  def get_values(self, content):
+    '''
+    Tell the web server about the server's limits.
+    '''
+    server = self.server
+    known = {
+      'FCGI_MAX_CONNS': str(server.max_connections or 1024),
+      'FCGI_MAX_REQS': str((server.num_workers + server.queue_size) or 1),
+      'FCGI_MPXS_CONNS': '1',
+    }
+    names = decode_params(content)
+    values = [(i, known[i]) for i in sorted(names) if i in known]
+    self.send_records(encode_record(FCGI_GET_VALUES_RESULT, 0, encode_params(values)))
+
+  def begin_request(self, request_id, content):
+    try:
+      role, flags = begin_request_body.unpack(content)
+    except struct.error:
+      raise ProtocolError("Malformed FCGI_BEGIN_REQUEST")
+
+    if request_id in self.requests:
+      raise ProtocolError("Request %s began twice" % request_id)
+
+    request = Request(request_id, bool(flags & FCGI_KEEP_CONN))
+    request.request_start = time.time()
+    self.requests[request_id] = request
+
+    if not request.keep_conn:
+      self.keep_conn = False
+
+    max_requests = self.server.max_requests
+    if max_requests and self.requests_handled + len(self.requests) >= max_requests:
+      self.keep_conn = False
+
+    if role != FCGI_RESPONDER:
+      self.end_request(request, FCGI_UNKNOWN_ROLE, output=False)
+
+    self.update_interest()
+
+  def receive_params(self, request, content):
+    if request.environ is not None:
+      return
+    if content:
+      request.params.append(content)
+      return
+
+    request.environ = make_environ(request, self.server)
+    request.params = None
+
+    try:
+      length = int(request.environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+      length = -1
+
+    if length < 0:
+      self.send_error_response(request, '400 Bad Request')
+      return
+
+    max_body_size = self.server.max_body_size
+    if max_body_size is not None and length > max_body_size:
+      self.send_error_response(request, '413 Request Entity Too Large')
+      return
+
+    request.body = RequestBody(length, self.server.spool_threshold)
+    request.environ['wsgi.input'] = request.body
+    if not length:
+      request.stdin_complete = True
+
+    # With a worker pool the application starts on the request while the body is still
+    # arriving; in the event loop it must wait for all of it
+    if request.stdin_complete or self.server.worker_queue is not None:
+      self.handle_request(request)
+    else:
+      self.update_interest()
+
+  def receive_stdin(self, request, content):
+    if request.stdin_complete:
+      return
+
+    body = request.body
+    if body is None:
+      raise ProtocolError("FCGI_STDIN before the end of FCGI_PARAMS")
+
+    if content:
+      remaining = body.length - body.received
+      if remaining > 0:
+        body.write(content[:remaining])
+      return
+
+    if not body.complete:
+      # The web server gave up on the request body; so does the application
+      body.abort()
+    request.stdin_complete = True
+
+    if not request.started:
+      self.handle_request(request)
+    else:
+      self.update_interest()
+
+  def abort_request(self, request):
+    '''
+    The client went away. Whatever the application is still producing is thrown away.
+    '''
+    request.aborted = True
+    if request.body is not None:
+      request.body.abort()
+
+    stream = request.stream
+    if stream is not None:
+      stream.close()
+      if self.write_buffer[0] is stream:
+        self.write_paused = False
+      self.write_buffer.remove(stream)
+      request.stream = None
+
+    self.end_request(request, output=request.started)
+    self.update_interest()
+
+  def handle_request(self, request):
+    '''
+    Run the application for a request whose parameters have arrived (in the worker
+    pool, if there is one).
+    '''
+    request.started = True
+    self.server.metrics.requests.mark()
+    environ = request.environ
+    priority = environ['frame.priority'] = self.server.classify(environ)
+
+    worker_queue = self.server.worker_queue
+
+    if worker_queue is None:
+      request.app_start = time.time()
+      status, headers, body, rest = run_application(self.server.app, environ,
+        self.server.buffer_size)
+      request.app_end = time.time()
+      stream = None
+      if rest is not None:
+        stream = IteratorStream(*rest, max_buffered=self.server.buffer_size)
+      self.send_response(request, status, headers, body, stream)
+    elif not worker_queue.put(self.process_request, request, environ, priority=priority):
+      self.server.metrics.rejected.inc()
+      self.send_response(request, '503 Service Unavailable',
+        [('Content-Type', 'text/html'), ('Retry-After', str(self.server.retry_after))],
+        ['<h1>503 Service Unavailable</h1>'])
+    else:
+      self.update_interest()
+
+  def process_request(self, request, environ):
+    '''
+    Runs in a worker thread; see :meth:`frame.server.http.Connection.process_request`.
+    '''
+    request.app_start = time.time()
+    status, headers, body, rest = run_application(self.server.app, environ,
+      self.server.buffer_size)
+    request.app_end = time.time()
+
+    if rest is None:
+      self.server.call_from_thread(self.send_response, request, status, headers, body)
+      return
+
+    stream = ResponseStream(*rest, notify=lambda: self.server.call_from_thread(
+      self.resume_writing), max_buffered=self.server.buffer_size)
+    self.server.call_from_thread(self.send_response, request, status, headers, body,
+      stream)
+    stream.produce()
+
+  def send_error_response(self, request, status):
+    request.started = True
+    request.stdin_complete = True
+    self.send_response(request, status, [('Content-Type', 'text/html')],
+      ['<h1>%s</h1>' % status])
+
+  def send_response(self, request, status, headers, body, stream=None):
+    '''
+    Queue the response as ``FCGI_STDOUT`` records. Must be called from the event loop.
+    '''
+    if self.closed or request.aborted:
+      if stream is not None:
+        stream.close()
+      return
+
+    metrics = self.server.metrics
+    metrics.response(status)
+    if request.app_end is not None:
+      metrics.timings['queued'].observe(request.app_start - request.request_start)
+      metrics.timings['app'].observe(request.app_end - request.app_start)
+
+    head = ['Status: %s\r\n' % status]
+    head.extend('%s: %s\r\n' % i for i in headers)
+    head.append('\r\n')
+    self.send_records(self.stdout(request, head + list(body)), False)
+
+    if stream is not None:
+      stream.request = request
+      request.stream = stream
+      self.write_buffer.append(stream)
+    else:
+      self.end_request(request)
+
+    self.update_interest()
+
+  def stdout(self, request, chunks):
+    data = []
+    for i in chunks:
+      if isinstance(i, StaticFile):
+        # Only ever returned by applications that bypass wsgi.file_wrapper
+        data.extend(i)
+        i.close()
+      else:
+        data.append(i)
+    return encode_stream(FCGI_STDOUT, request.id, ''.join(data))
+
+  def pull(self, stream):
+    '''
+    Move the chunks the response stream at the head of the write buffer has ready in
+    front of it, as records.
+    '''
+    chunks = stream.take()
+    request = stream.request
+
+    if chunks is None:
+      self.write_buffer.popleft()
+      if stream.failed:
+        # A truncated response must not look complete to the web server
+        self.close()
+        return False
+      request.stream = None
+      self.end_request(request, front=True)
+      return True
+
+    if not chunks:
+      self.write_paused = True
+      self.update_interest()
+      return False
+
+    self.write_buffer.extendleft(reversed(self.stdout(request, chunks)))
+    return True
+
+  def end_request(self, request, protocol_status=FCGI_REQUEST_COMPLETE, output=True,
+      front=False):
+    '''
+    Queue the records that end a request (the end of its output and
+    ``FCGI_END_REQUEST``), followed by the marker for :meth:`finish_response`.
+
+    :param front: Queue them at the head of the write buffer
+    '''
+    if self.requests.get(request.id) is request:
+      del self.requests[request.id]
+
+    records = []
+    if output:
+      records.extend(encode_record(FCGI_STDOUT, request.id))
+    records.extend(encode_record(FCGI_END_REQUEST, request.id,
+      end_request_body.pack(0, protocol_status)))
+    records.append(None)
+
+    if front:
+      self.write_buffer.extendleft(reversed(records))
+      self.ending.appendleft(request)
+    else:
+      self.write_buffer.extend(records)
+      self.ending.append(request)
+
+  def send_records(self, records, update=True):
+    self.write_buffer.extend(i for i in records if i)
+    if update:
+      self.update_interest()
+
+  def finish_response(self):
+    '''
+    Called once the end of a request has been written.
+    '''
+    request = self.ending.popleft()
+    self.requests_handled += 1
+    if self.server.drain_deadline is not None:
+      self.server.metrics.drained.inc()
+
+    if request.app_end is not None:
+      now = time.time()
+      timings = self.server.metrics.timings
+      timings['writing'].observe(now - request.app_end)
+      timings['total'].observe(now - request.request_start)
+
+    if request.body is not None:
+      request.body.close()
+
+    if not self.requests and not self.write_buffer and \
+        (not self.keep_conn or not self.server.running):
+      self.close()
+      return
+
+    self.update_interest()
+
+  def send_error(self, status):
+    # Only used for timeouts part way through a record; there is no request to answer
+    self.close()
+
+  def close(self):
+    if self.closed:
+      return
+
+    for request in self.requests.values():
+      request.aborted = True
+      if request.body is not None:
+        request.body.abort()
+        request.body.close()
+
+    Connection.close(self)
+
+
+def make_environ(request, server):
+  '''
+  Build the WSGI environ from a request's parameters. Like flup, ``PATH_INFO`` and
+  ``QUERY_STRING`` are taken from ``REQUEST_URI`` if the web server leaves them empty.
+  '''
+  environ = decode_params(''.join(request.params))
+
+  request_uri = environ.get('REQUEST_URI')
+  if request_uri is not None:
+    path, _, query = request_uri.partition('?')
+    if not environ.get('PATH_INFO'):
+      environ['PATH_INFO'] = path
+    if not environ.get('QUERY_STRING'):
+      environ['QUERY_STRING'] = query
+
+  environ.setdefault('PATH_INFO', '')
+  environ.setdefault('QUERY_STRING', '')
+  environ.setdefault('SCRIPT_NAME', '')
+  environ.setdefault('REQUEST_METHOD', 'GET')
+  environ.setdefault('SERVER_PROTOCOL', 'HTTP/1.1')
+
+  https = environ.get('HTTPS', 'off').lower() in ('on', '1')
+
+  environ.update({
+    'wsgi.version': (1, 0),
+    'wsgi.url_scheme': 'https' if https else 'http',
+    'wsgi.input': None,
+    'wsgi.errors': sys.stderr,
+    'wsgi.multithread': server.worker_queue is not None,
+    'wsgi.multiprocess': False,
+    'wsgi.run_once': False,
+    'wsgi.file_wrapper': file_wrapper,
+    'frame.sendfile': False,
+    'frame.request_start': request.request_start,
+  })
+
+  return environ
+
+
+def bind_unix_socket(path, listen=128, mode=None, sock=None):
+  '''
+  Create a listening Unix socket at ``path``, replacing a stale one.
+
+  :param mode: Permissions for the socket file (e.g., ``0660`` to let the web server's
+    group connect)
+  :param sock: An unbound Unix socket to use
+  '''
+  try:
+    if stat.S_ISSOCK(os.stat(path).st_mode):
+      os.unlink(path)
+  except OSError, e:
+    if e.errno != errno.ENOENT:
+      raise
+
+  if sock is None:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.bind(path)
+  if mode is not None:
+    os.chmod(path, mode)
+  sock.listen(listen)
+  return sock
+
+
+def passed_socket():
+  '''
+  The listening socket the web server passed as standard input, if it did.
+  '''
+  try:
+    sock = handoff.socket_from_fd(os.dup(FCGI_LISTENSOCK_FILENO))
+  except (OSError, socket.error):
+    return None
+
+  try:
+    sock.getpeername()
+  except socket.error, e:
+    # A listening socket has no peer
+    if e.args[0] == errno.ENOTCONN:
+      return sock
+
+  sock.close()
+  return None
+
+
+class FastCGIServer(HTTPServer):
+  '''
+  Serves a WSGI application over FastCGI; see the module documentation.
+
+  :param path: Listen on this Unix socket instead of ``host:port``
+  :param socket_mode: Permissions of the Unix socket file; see :func:`bind_unix_socket`
+  '''
+
+  connection_class = FastCGIConnection
+  protocol = 'FastCGI'
+
+  def __init__(self, app, host='localhost', port=9000, path=None, socket_mode=None,
+      sock=None, auto_reload=False, **options):
+    self.path = path
+    self.socket_mode = config.fastcgi.socket_mode if socket_mode is None else socket_mode
+
+    # The base class takes a socket it is given to be bound already
+    unbound = False
+    if sock is None and path is not None:
+      sock = handoff.inherited_socket()
+      if sock is None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        unbound = True
+    elif sock is None and host is None:
+      sock = handoff.inherited_socket() or passed_socket()
+      if sock is None:
+        raise ValueError("No address to listen on, and no socket was passed by the "
+          "web server")
+
+    options.pop('metrics_path', None)
+    HTTPServer.__init__(self, app, host=host, port=port, sock=sock,
+      auto_reload=auto_reload, metrics_path=False, expect_continue=False, **options)
+
+    if unbound:
+      self.inherited_socket = False
+
+  @classmethod
+  def make_listener(cls, host, port, listen=128, path=None, socket_mode=None, **options):
+    if path is not None:
+      if socket_mode is None:
+        socket_mode = config.fastcgi.socket_mode
+      return bind_unix_socket(path, listen, socket_mode)
+
+    if host is None:
+      sock = passed_socket()
+      if sock is None:
+        raise ValueError("No address to listen on, and no socket was passed by the "
+          "web server")
+      return sock
+
+    return HTTPServer.make_listener(host, port, listen)
+
+  def bind_socket(self):
+    if self.path is not None and not self.inherited_socket:
+      bind_unix_socket(self.path, self.listen, self.socket_mode, self.socket)
+      # Bound and listening now, like an inherited socket
+      self.inherited_socket = True
+
+    HTTPServer.bind_socket(self)
+
@@ -0,0 +1,150 @@
+'''
+Hands the listening socket over to a new generation of the server so that code can be
+reloaded without refusing a single connection. The running process re-executes the
+program as a child that inherits the listening socket's descriptor (it is named in the
+environment, together with a pipe to report back on). Once the new generation is
+ready to accept connections it says so through the pipe and the old one stops
+accepting, finishes the requests it is working on and exits. Connections that arrive
+in the meantime wait in the socket's backlog, which both generations share.
+
+If the new generation fails to start, the old one simply keeps serving.
+'''
+
+
+import os
+import sys
+import socket
+import select
+import errno
+import time
+import signal
+import fcntl
+
+
+#: Environment variable naming the inherited listening socket's descriptor
+LISTEN_FD = 'FRAME_LISTEN_FD'
+
+#: Environment variable naming the descriptor to report readiness on
+READY_FD = 'FRAME_READY_FD'
+
+
+def _inheritable(fd):
+  flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+  fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+
+
+def inherited_socket():
+  '''
+  The listening socket handed down by the previous generation, if there was one. Only
+  the first call returns it.
+  '''
+  fd = os.environ.pop(LISTEN_FD, None)
+  if fd is None:
+    return None
+
+  return socket_from_fd(int(fd))
+
+
+def socket_from_fd(fd):
+  '''
+  Wrap a listening socket's descriptor (TCP or Unix) in a socket object; the descriptor
+  itself is closed.
+  '''
+  # Python 2 can't tell the address family by itself; SO_DOMAIN is Linux only
+  probe = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+  try:
+    family = probe.getsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_DOMAIN', 39))
+  except socket.error:
+    family = socket.AF_INET
+  probe.close()
+
+  sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+  os.close(fd)
+  return sock
+
+
+def notify_ready():
+  '''
+  Tell the previous generation (if any) that this one is accepting connections.
+  '''
+  fd = os.environ.pop(READY_FD, None)
+  if fd is None:
+    return
+
+  try:
+    os.write(int(fd), 'R')
+    os.close(int(fd))
+  except OSError:
+    pass
+
+
+def spawn(sock=None, timeout=30):
+  '''
+  Start a new generation of the program and wait for it to become ready.
+
+  :param sock: The listening socket to hand down; with ``None`` the new generation
+    binds its own (e.g., with ``SO_REUSEPORT``)
+  :param timeout: Seconds to wait for the new generation
+  :return: The new generation's pid, or ``None`` if it didn't come up in time
+  '''
+  reader, writer = os.pipe()
+  keep = [writer]
+
+  env = dict(os.environ)
+  env[READY_FD] = str(writer)
+  env.pop(LISTEN_FD, None)
+  if sock is not None:
+    env[LISTEN_FD] = str(sock.fileno())
+    keep.append(sock.fileno())
+
+  python = sys.executable
+  args = [python] + sys.argv
+
+  pid = os.fork()
+  if not pid:
+    # Nothing but the listening socket and the pipe may leak into the new generation,
+    # or closing a connection here would not actually hang up on the client
+    try:
+      last = 3
+      for fd in sorted(keep):
+        _inheritable(fd)
+        os.closerange(last, fd)
+        last = fd + 1
+      os.closerange(last, os.sysconf('SC_OPEN_MAX'))
+      os.execve(python, args, env)
+    finally:
+      os._exit(1)
+
+  os.close(writer)
+  try:
+    ready = _wait(reader, timeout)
+  finally:
+    os.close(reader)
+
+  if not ready:
+    try:
+      os.kill(pid, signal.SIGKILL)
+      os.waitpid(pid, 0)
+    except OSError:
+      pass
+    return None
+
+  return pid
+
+
+def _wait(fd, timeout):
+  # True once the child reports in; False if it exits (closing the pipe) or times out
+  deadline = time.time() + timeout
+
+  while True:
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      return False
+
+    try:
+      if not select.select([fd], [], [], remaining)[0]:
+        return False
+      return bool(os.read(fd, 1))
+    except (select.error, OSError), e:
+      if e.args[0] != errno.EINTR:
+        return False
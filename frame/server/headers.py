@@ -62,6 +62,7 @@ class RequestLine(Headers, RequestMixin):
 		query_string = uri_split[1] if len(uri_split) > 1 else ''
 
 		return {
+			'SERVER_PROTOCOL': 'HTTP/%s' % match.group(3),
 			'REQUEST_METHOD': match.group(1),
 			'REQUEST_URI': match.group(2),
 			'PATH_INFO': path_info,
@@ -2,7 +2,7 @@
 
 import socket
 import threading
-from headers import RequestHeaders, RequestLine
+from parser import RequestParser, ParseError
 import modulemonitor
 import signal
 import sys
@@ -13,62 +13,420 @@ from jinja2 import Environment, PackageLoader, ChoiceLoader, FileSystemLoader
 from StringIO import StringIO
 
 # Needed for asynchronous server
-import select
+import errno
+import poller
+from timers import TimerWheel
+import handoff
 
 # Logger stuff
 from frame import logger
-from frame.server.worker import HTTPQueue
+from frame.server.worker import HTTPQueue, PriorityClassifier
 
 # Import config
 from frame._config import config
 
-# Import necessary exceptions
-from frame.errors import InvalidFD
+# Static file bodies can be sent with sendfile(), everything else with writev()
+from frame.staticdispatcher import StaticFile
+import sendfile
+import writev
+from stream import ResponseStream, IteratorStream
+from metrics import ServerMetrics, resident_memory
+
 import time
+import random
+from collections import deque
+
+
+def response_has_body(status):
+  '''
+  Informational, ``204 No Content`` and ``304 Not Modified`` responses never carry a
+  body (and so never get a Content-Length).
+  '''
+  code = status[:3]
+  return not (code.startswith('1') or code in ('204', '304'))
+
+
+def keep_alive_requested(environ):
+  '''
+  Decide whether the client expects the connection to stay open once the response has
+  been sent. HTTP/1.1 connections are persistent unless ``Connection: close`` is sent;
+  HTTP/1.0 connections only persist when ``Connection: keep-alive`` is sent.
+  '''
+  tokens = [i.strip().lower() for i in environ.get('HTTP_CONNECTION', '').split(',')]
+
+  if environ['SERVER_PROTOCOL'] == 'HTTP/1.0':
+    return 'keep-alive' in tokens
+  return 'close' not in tokens
+
+
+class FileWrapper(object):
+  '''
+  What :func:`file_wrapper` returns for file-like objects that aren't real files.
+  '''
+
+  def __init__(self, filelike, block_size):
+    self.filelike = filelike
+    self.block_size = block_size
 
+  def __iter__(self):
+    while True:
+      data = self.filelike.read(self.block_size)
+      if not data:
+        return
+      yield data
 
-def parse_body(request):
+  def close(self):
+    if hasattr(self.filelike, 'close'):
+      self.filelike.close()
+
+
+def file_wrapper(filelike, block_size=StaticFile.block_size):
+  '''
+  The servers' ``wsgi.file_wrapper``. A real file becomes a
+  :class:`frame.staticdispatcher.StaticFile` for the rest of the file (from its current
+  position on), which is sent with ``sendfile`` where possible; anything else is read
+  in ``block_size`` chunks.
+  '''
   try:
-    return request.split('\r\n\r\n', 1)[1]
-  except IndexError:
-    return ''
+    filelike.fileno()
+    position = filelike.tell()
+  except (AttributeError, EnvironmentError, ValueError):
+    return FileWrapper(filelike, block_size)
+
+  body = StaticFile(filelike, position)
+  body.block_size = block_size
+  return body
+
+
+def make_environ(request, server, addr, sendfile=False):
+  '''
+  Build the WSGI environ for a request whose headers have been parsed.
+
+  :param request: A :class:`frame.server.parser.RequestParser`
+  :param server: The server; provides ``host``, ``port``, ``script_filename`` and
+    ``document_root``
+  :param addr: The client's address
+  :param sendfile: Whether the server can send
+    :class:`frame.staticdispatcher.StaticFile` bodies with ``sendfile``
+  '''
+  environ = request.environ
+
+  environ.update({
+    'wsgi.multiprocess': False,
+    'wsgi.url_scheme': 'http',
+    'wsgi.input': request.body,
+    'wsgi.multithread': True,
+    'wsgi.version': (1, 0),
+    'wsgi.run_once': False,
+    'wsgi.errors': '',
+    'wsgi.file_wrapper': file_wrapper,
+    'frame.sendfile': sendfile,
+    # When the request arrived, to tell how long it waited for a worker
+    'frame.request_start': time.time()
+  })
+
+  environ.update({
+    'SERVER_ADDR': server.host,
+    'SERVER_PORT': server.port,
+    'SERVER_NAME': server.host,
+    'SERVER_SOFTWARE': 'Frame/0.1a',
+    'REMOTE_ADDR': addr[0],
+    'REMOTE_PORT': addr[1],
+    'GATEWAY_INTERFACE': 'CGI/1.1',
+    'SCRIPT_FILENAME': server.script_filename,
+    'DOCUMENT_ROOT': server.document_root,
+    'PATH_TRANSLATED': server.document_root + environ['PATH_INFO'],
+    'SCRIPT_NAME': '',
+    'REDIRECT_STATUS': 200
+  })
+
+  return environ
+
+
+def chunked(chunks):
+  '''
+  Frame body chunks for ``Transfer-Encoding: chunked``. Consecutive strings are sent
+  as a single chunk.
+
+  :return: A list of strings and :class:`frame.staticdispatcher.StaticFile` objects
+  '''
+  result = []
+  strings = []
+
+  def add_strings():
+    size = sum(len(i) for i in strings)
+    if size:
+      result.append('%x\r\n' % size)
+      result.extend(strings)
+      result.append('\r\n')
+    del strings[:]
+
+  for i in chunks:
+    if isinstance(i, StaticFile):
+      add_strings()
+      if len(i):
+        result.extend(('%x\r\n' % len(i), i, '\r\n'))
+    elif i:
+      strings.append(i)
+
+  add_strings()
+  return result
+
+
+def run_application(app, environ, buffer_size):
+  '''
+  Call a WSGI application and buffer the start of its response. Most responses fit in
+  ``buffer_size`` entirely, so that a Content-Length can be sent.
+
+  :return: A tuple of ``(status, headers, body_chunks, rest)``; ``rest`` is ``None``
+    if the whole body was buffered, otherwise ``(iterator, close)`` for the remainder
+  '''
+  started = {}
+
+  def start_response(status, headers, exc_info=None):
+    started['status'] = status
+    started['headers'] = headers
+
+  response = None
+  try:
+    # start_response may only be called once the application's iterator has been
+    # started, so nothing can be sent before the first chunk is in
+    response = app(environ, start_response)
+    if isinstance(response, StaticFile) and sendfile.available:
+      # From wsgi.file_wrapper; sent straight from disk
+      return started['status'], started['headers'], [response], None
+
+    iterator = iter(response)
+    body = []
+    size = 0
+
+    while True:
+      try:
+        chunk = next(iterator)
+      except StopIteration:
+        break
+
+      if not isinstance(chunk, StaticFile):
+        chunk = str(chunk)
+        size += len(chunk)
+      body.append(chunk)
+
+      # Stop buffering once there is too much, or at a flush point (an empty chunk)
+      if size >= buffer_size or not len(chunk):
+        return started['status'], started['headers'], body, (iterator,
+          getattr(response, 'close', None))
+
+    status, headers = started['status'], started['headers']
+
+  except Exception, e:
+    status = '500 Internal Server Error'
+    headers = [('Content-Type', 'text/html')]
+    body = ['<h1>500 Internal Server Error</h1>']
+
+  if hasattr(response, 'close'):
+    response.close()
+
+  return status, headers, body, None
+
+
+def make_socket(reuse_port=False):
+  '''
+  Create an unbound TCP socket suitable for listening on.
+
+  :param reuse_port: Set ``SO_REUSEPORT`` so that several processes can each bind their
+    own socket to the same address and let the kernel balance connections between them
+  '''
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+  if reuse_port:
+    # Python 2 does not export the constant; 15 is its value on Linux
+    sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+
+  return sock
 
 
 class Connection(object):
+  #: Maximum number of bytes handed to sendfile() per writable event, so that one
+  #: large download cannot starve the other connections
+  sendfile_chunk = 1048576
+
+  #: Maximum number of bytes of buffered response data passed to one send call
+  max_write = 262144
+
   def __init__(self, server, accept):
     self.server = server
     self.socket, self.addr = accept
+    self.socket.setblocking(0)
+
+    # The descriptor is looked up once; it stays valid until close()
+    self.fd = self.socket.fileno()
+    self.closed = False
+
+    # Response data waiting to be written: strings, StaticFiles, streams and a None
+    # marking the end of each response. The first string may be partially sent already,
+    # up to write_offset.
+    self.write_buffer = deque()
+    self.write_offset = 0
+
+    # True while the response stream at the head of write_buffer has nothing to give
+    self.write_paused = False
 
-    self.read_buffer = []
-    self.write_buffer = []
+    # The events currently registered with the poller
+    self.events = poller.READ
     
     self.total_received = 0
-    self.request_body_received = 0
-    self.request_body_length = None
-    self.request_headers = None
+    self.requests_handled = 0
+
+    # Timeout bookkeeping; see update_timeout()
+    self.timer = None
+    self.timeout_phase = None
+    self.timeout = None
+    self.timeout_start = time.time()
+    self.last_activity = self.timeout_start
+
+    # Per-request state; see reset()
+    self.reset()
+    self.update_timeout()
     
     # Track number of failures for socket
     self.failures = 0
 
-  def fileno(self):
-    if os.name == 'posix':
-      try:
-        os.fstat(self.socket.fileno())
-      except Exception:
-        raise InvalidFD(self)
-      else: 
-        return self.socket.fileno()
+  def reset(self):
+    '''
+    Forget about the request that was just answered so that the connection can be
+    re-used for the next one (HTTP keep-alive).
+    '''
+    self.parser = RequestParser(self.server.max_header_size, self.server.max_body_size,
+      self.server.spool_threshold)
+    self.request_protocol = None
+    self.keep_alive = False
+
+    # True if the request is a HEAD: the response gets its headers but no body
+    self.head_request = False
+
+    # True from the moment a request has been parsed until its response is written
+    self.in_flight = False
+
+    # True while the body of the in-flight request is still arriving
+    self.reading_body = False
+
+    # True if the response is being sent with chunked transfer encoding
+    self.chunked = False
+
+    # True once the request's Expect header has been dealt with
+    self.expectation_checked = False
+
+    # When the request was handed to the application, when the application started
+    # on it and when the start of its response was ready; see ServerMetrics
+    self.request_start = None
+    self.app_start = None
+    self.app_end = None
+
+  def update_interest(self):
+    '''
+    Tell the poller which events this connection currently cares about: writability
+    whenever there is something to write and readability whenever a request (or the
+    rest of a request body) is expected.
+    '''
+    if self.closed:
+      return
+
+    events = 0
+    if self.write_buffer and not self.write_paused:
+      events |= poller.WRITE
+    if not self.in_flight or self.reading_body:
+      events |= poller.READ
+
+    if events != self.events:
+      self.events = events
+      self.server.poller.modify(self.fd, events)
+
+    self.update_timeout()
+
+  def update_timeout(self):
+    '''
+    Arm the timeout for whatever the connection is waiting on:
+
+    * ``keep_alive``: the next request on a persistent connection
+    * ``headers``: the rest of the request headers; counted from the first byte (or
+      the connection being accepted), so trickling the headers in doesn't help
+    * ``body``: more of the request body; the clock restarts whenever data arrives
+    * ``write``: the client to take more of the response; restarts on every write
+
+    Nothing is timed while the application is working on a request.
+    '''
+    if self.closed:
+      return
+
+    server = self.server
+
+    if self.write_buffer and not self.write_paused:
+      phase, timeout = 'write', server.write_timeout
+    elif self.reading_body or (not self.in_flight and self.parser.headers_complete):
+      phase, timeout = 'body', server.body_timeout
+    elif self.in_flight:
+      phase, timeout = None, None
+    elif self.requests_handled and not self.parser.started:
+      phase, timeout = 'keep_alive', server.keep_alive_timeout
     else:
-      return self.socket.fileno()
+      phase, timeout = 'headers', server.header_timeout
+
+    if phase == self.timeout_phase:
+      return
+
+    self.timeout_phase = phase
+    self.timeout = timeout
+    self.timeout_start = self.last_activity = time.time()
+
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
+    if timeout:
+      self.timer = server.timers.schedule(timeout, self.check_timeout)
+
+  def check_timeout(self):
+    '''
+    Called by the server's timer wheel; the timer is only re-armed lazily, so activity
+    doesn't cost a timer operation.
+    '''
+    self.timer = None
+    if self.closed or not self.timeout:
+      return
+
+    if self.timeout_phase in ('body', 'write'):
+      start = self.last_activity
+    else:
+      start = self.timeout_start
+
+    remaining = start + self.timeout - time.time()
+    if remaining > 0:
+      self.timer = self.server.timers.schedule(remaining, self.check_timeout)
+      return
+
+    logger.log_info("Closing connection from %s: %s timeout" % (self.addr[0],
+      self.timeout_phase))
+    self.server.metrics.timeouts.inc()
+
+    if self.timeout_phase == 'headers' and self.parser.started:
+      self.send_error('408 Request Timeout')
+    else:
+      self.close()
+
+  def fileno(self):
+    return self.fd
 
   def handle_connect(self):
     pass
 
   def handle_read(self):
+    self.last_activity = time.time()
+
     try:
-      data = self.socket.recv(self.server.chunk_size)
-    except socket.error:
-      self.fail()
+      data = self.socket.recv(self.server.max_read)
+    except socket.error, e:
+      if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        self.fail()
       return
       
     if not data:
@@ -76,153 +434,461 @@ class Connection(object):
       return
       
     self.total_received += len(data)
-    self.read_buffer.append(data)
-    last_two_chunks = ''.join(self.read_buffer[-2:])
-    
-    if '\r\n\r\n' in last_two_chunks and not self.request_headers:
-      raw_request = ''.join(self.read_buffer).split('\r\n\r\n', 1)
-      self.request_body_received += len(raw_request[1])
-      self.request_headers = RequestHeaders(raw_request[0])
-      
+    self.server.metrics.bytes_in.inc(len(data))
+    self.receive(data)
+
+  def receive(self, data):
+    '''
+    Feed received data to the request parser and hand the request off once it is
+    complete. Data that arrives while a request is being answered is kept by the
+    parser for the next request.
+    '''
+    try:
+      self.parser.feed(data)
+    except ParseError, e:
+      self.send_error(e.status)
+      return
+
+    if self.timeout_phase == 'keep_alive':
+      self.update_timeout()
+
+    if self.parser.headers_complete and not self.expectation_checked:
+      self.expectation_checked = True
+      if not self.check_expectation():
+        return
+
+    if self.in_flight:
+      if self.reading_body and self.parser.complete:
+        self.reading_body = False
+        self.update_interest()
+
+    elif self.parser.complete:
+      self.handle_request(self.parser)
+
+    elif self.parser.headers_complete and self.server.worker_queue is not None:
+      # Let the application start on the request while the body is still arriving
+      self.reading_body = True
+      self.handle_request(self.parser)
+
+  def check_expectation(self):
+    '''
+    Deal with the ``Expect`` header of a request whose headers just arrived. A client
+    sending ``Expect: 100-continue`` waits for ``100 Continue`` before it sends the
+    body, so the request is vetted first (see :attr:`HTTPServer.expect_continue`); one
+    that would be refused anyway is answered right away, and its body is never read.
+    Any other expectation is refused with 417. Bodies over ``max_body_size`` have been
+    refused with 413 by the parser already.
+
+    :return: Whether to go on with the request
+    '''
+    parser = self.parser
+    expect = parser.environ.get('HTTP_EXPECT')
+    if expect is None:
+      return True
+
+    if expect.strip().lower() != '100-continue':
+      self.send_error('417 Expectation Failed')
+      return False
+
+    # Nothing to wait for if there is no body or the client didn't wait; HTTP/1.0
+    # clients don't know about 1xx responses
+    if parser.complete or parser.body_received or \
+        parser.environ['SERVER_PROTOCOL'] != 'HTTP/1.1':
+      return True
+
+    check = self.server.expect_continue
+    if check is not None:
+      environ = make_environ(parser, self.server, self.addr, sendfile.available)
       try:
-        self.request_body_length = int(self.request_headers['HTTP_CONTENT_LENGTH'])
-      except (KeyError, ValueError):
-        self.request_body_length = 0
-      finally:
-        if self.request_body_received >= self.request_body_length:
-          if self in self.server.r_list:
-            self.server.r_list.remove(self)
-          request = ''.join(self.read_buffer)
-          
-          self.handle_request(request)
-          #self.server.worker_queue.put(self, request)
-          
-    elif self.request_headers:
-      self.request_body_received += len(data)
-      if self.request_body_received >= self.request_body_length:
-        if self in self.server.r_list:
-          self.server.r_list.remove(self)
-        request = ''.join(self.read_buffer)
-        
-        self.handle_request(request)
-        #self.server.worker_queue.put(self, request)
+        status = check(environ)
+      except Exception:
+        logger.log_exception(traceback.format_exc())
+        status = '500 Internal Server Error'
+
+      if status:
+        self.server.metrics.rejected.inc()
+        self.send_error(status)
+        return False
+
+    self.send('HTTP/1.1 100 Continue\r\n\r\n')
+    self.update_interest()
+    return True
 
   def handle_write(self):
-    data = self.write_buffer.pop(0)
-    
-    if data is None:
+    '''
+    Write as much of the queued response data as the socket will take.
+    '''
+    self.last_activity = time.time()
+
+    while self.write_buffer and not self.closed:
+      item = self.write_buffer[0]
+
+      if item is None:
+        self.write_buffer.popleft()
+        self.finish_response()
+        return
+
+      if isinstance(item, str):
+        done = self.send_buffers()
+      elif isinstance(item, StaticFile):
+        done = self.send_file(item)
+      else:
+        done = self.pull(item)
+
+      if not done:
+        return
+
+  def send_buffers(self):
+    '''
+    Send the strings at the head of the write buffer, coalesced into a single system
+    call.
+
+    :return: ``True`` if everything that was attempted got sent
+    '''
+    buffers = []
+    size = -self.write_offset
+    for item in self.write_buffer:
+      if not isinstance(item, str) or len(buffers) == writev.max_buffers or \
+          size >= self.max_write:
+        break
+      buffers.append(item)
+      size += len(item)
+
+    try:
+      if len(buffers) > 1 and writev.available:
+        sent = writev.writev(self.fd, buffers, self.write_offset)
+      elif len(buffers) > 1 and not self.write_offset:
+        sent = self.socket.send(''.join(buffers))
+      else:
+        size = len(buffers[0]) - self.write_offset
+        sent = self.socket.send(memoryview(buffers[0])[self.write_offset:])
+    except (socket.error, OSError), e:
+      if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        self.fail()
+      return False
+
+    self.server.metrics.bytes_out.inc(sent)
+
+    # Drop whatever was sent completely and remember how far into the next string we got
+    offset = self.write_offset + sent
+    while offset and offset >= len(self.write_buffer[0]):
+      offset -= len(self.write_buffer.popleft())
+    self.write_offset = offset
+
+    return sent == size
+
+  def send_file(self, body):
+    '''
+    Send (part of) a :class:`frame.staticdispatcher.StaticFile` with ``sendfile``.
+
+    :return: ``True`` once the whole file has been sent
+    '''
+    try:
+      sent = sendfile.sendfile(self.fd, body.fileno(), body.offset,
+        min(body.length, self.sendfile_chunk))
+    except (OSError, IOError), e:
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+        self.close()
+      return False
+
+    if not sent:
+      # The file shrank underneath us; the promised Content-Length can't be honoured
+      self.close()
+      return False
+
+    self.server.metrics.bytes_out.inc(sent)
+    body.offset += sent
+    body.length -= sent
+
+    if body.length > 0:
+      # Give the other connections a turn
+      return False
+
+    self.write_buffer.popleft()
+    body.close()
+    return True
+
+  def pull(self, stream):
+    '''
+    Move the chunks the response stream at the head of the write buffer has ready in
+    front of it.
+
+    :return: ``True`` if there is something new to write
+    '''
+    chunks = stream.take()
+
+    if chunks is None:
+      self.write_buffer.popleft()
+      if stream.failed:
+        # A truncated response must not look complete to the client
+        self.close()
+        return False
+      if self.chunked:
+        self.write_buffer.appendleft('0\r\n\r\n')
+      return True
+
+    if not chunks:
+      # Wait for the worker to produce more; see resume_writing()
+      self.write_paused = True
+      self.update_interest()
+      return False
+
+    if self.chunked:
+      chunks = chunked(chunks)
+    self.write_buffer.extendleft(reversed([i for i in chunks if i]))
+    return True
+
+  def resume_writing(self):
+    '''
+    Called (through the event loop) when a paused response stream has more data.
+    '''
+    if self.write_paused:
+      self.write_paused = False
+      self.update_interest()
+
+  def finish_response(self):
+    '''
+    Called once the whole response has been written. Either closes the connection or
+    re-arms it for the next request, processing any request that was pipelined behind
+    the one just answered.
+    '''
+    self.requests_handled += 1
+    if self.server.drain_deadline is not None:
+      self.server.metrics.drained.inc()
+
+    if self.app_end is not None:
+      now = time.time()
+      timings = self.server.metrics.timings
+      timings['writing'].observe(now - self.app_end)
+      timings['total'].observe(now - self.request_start)
+
+    # A body the application didn't wait for would have to be skipped; just hang up
+    if not self.keep_alive or not self.server.running or not self.parser.complete:
       self.close()
       return
-    
-    try:
-      self.socket.send(data)
-    except socket.error:
-      self.fail()
 
-    #if not self.write_buffer:
-    #  self.close()
+    if self.parser.body is not None:
+      self.parser.body.close()
+
+    leftover = self.parser.leftover
+    self.reset()
+    self.update_interest()
+
+    if leftover:
+      self.receive(leftover)
+
+  def pending_requests(self):
+    '''
+    The number of requests on this connection that have been started (at least their
+    head has arrived) but not completely answered.
+    '''
+    return int(bool(self.in_flight or self.write_buffer or self.parser.headers_complete))
+
+  def wants_keep_alive(self, environ):
+    '''
+    Whether to keep the connection open after answering; see
+    :func:`keep_alive_requested`.
+    '''
+    return self.server.keep_alive and keep_alive_requested(environ)
 
   def handle_request(self, request):
-    if not request:
-      self.close()
+    '''
+    Build the WSGI environ for a parsed request and run the application (in the worker
+    pool, if there is one).
+
+    :param request: A complete :class:`frame.server.parser.RequestParser`
+    '''
+    all_headers = make_environ(request, self.server, self.addr, sendfile.available)
+
+    self.in_flight = True
+    self.request_start = time.time()
+    self.server.metrics.requests.mark()
+    self.request_protocol = all_headers['SERVER_PROTOCOL']
+    self.head_request = all_headers['REQUEST_METHOD'] == 'HEAD'
+    self.keep_alive = self.wants_keep_alive(all_headers)
+
+    max_requests = self.server.max_requests
+    if max_requests and self.requests_handled + 1 >= max_requests:
+      self.keep_alive = False
+
+    self.update_interest()
+
+    metrics_path = self.server.metrics_path
+    if metrics_path and all_headers['PATH_INFO'] == metrics_path:
+      self.send_metrics(all_headers)
       return
 
-    request_body = parse_body(request)
-    
-    wsgi_environ = {
-      'wsgi.multiprocess': False,
-      'wsgi.url_scheme': 'http',
-      'wsgi.input': StringIO(request_body),
-      'wsgi.multithread': True,
-      'wsgi.version': (1, 0),
-      'wsgi.run_once': False,
-      'wsgi.errors': ''
-    }
+    priority = all_headers['frame.priority'] = self.server.classify(all_headers)
+    worker_queue = self.server.worker_queue
 
-    try:
-      uri_headers = RequestLine(request)
-    except ValueError:
-      self.close()
+    if worker_queue is None:
+      self.app_start = time.time()
+      status, headers, body, rest = self.run_application(all_headers)
+      self.app_end = time.time()
+      stream = None
+      if rest is not None:
+        stream = IteratorStream(*rest, max_buffered=self.server.buffer_size)
+      self.send_response(status, headers, body, stream)
+    elif not worker_queue.put(self.process_request, all_headers, priority=priority):
+      # Backpressure: the pool (or the priority class) is saturated, so answer right
+      # away rather than let the request wait behind everything that is already queued
+      self.keep_alive = False
+      self.server.metrics.rejected.inc()
+      self.send_response('503 Service Unavailable',
+        [('Content-Type', 'text/html'), ('Retry-After', str(self.server.retry_after))],
+        ['<h1>503 Service Unavailable</h1>'])
+
+  def send_metrics(self, environ):
+    '''
+    Answer a request for the server's metrics; see :mod:`frame.server.metrics`.
+    '''
+    metrics = self.server.metrics
+    query = environ.get('QUERY_STRING', '')
+
+    # Every process sharing metrics with this one, unless asked for this one alone
+    data = metrics.snapshot() if 'scope=process' in query else metrics.aggregate()
+
+    if 'format=json' in query or 'application/json' in environ.get('HTTP_ACCEPT', ''):
+      body, content_type = metrics.json(data), 'application/json'
+    else:
+      body, content_type = metrics.text(data), 'text/plain; version=0.0.4'
+
+    self.send_response('200 OK', [('Content-Type', content_type),
+      ('Cache-Control', 'no-cache')], [body])
+
+  def send_error(self, status):
+    '''
+    Answer with a bare error page and close the connection afterwards.
+    '''
+    self.in_flight = True
+    self.reading_body = False
+    self.keep_alive = False
+    self.send_response(status, [('Content-Type', 'text/html')], ['<h1>%s</h1>' % status])
+
+  def process_request(self, environ):
+    '''
+    Runs in a worker thread: calls the application, then hands the result back to the
+    event loop, which is the only thread allowed to touch the socket. A response too
+    large to buffer is produced from this thread as the loop writes it out.
+    '''
+    self.app_start = time.time()
+    status, headers, body, rest = self.run_application(environ)
+    self.app_end = time.time()
+
+    if rest is None:
+      self.server.call_from_thread(self.send_response, status, headers, body)
       return
 
-    other_headers = {
-      'SERVER_ADDR': self.server.host,
-      'SERVER_PORT': self.server.port,
-      'SERVER_NAME': self.server.host,
-      'SERVER_PROTOCOL': 'HTTP/1.1',
-      'SERVER_SOFTWARE': 'Frame/0.1a',
-      'REMOTE_ADDR': self.addr[0],
-      'REMOTE_PORT': self.addr[1],
-      'GATEWAY_INTERFACE': 'CGI/1.1',
-      'SCRIPT_FILENAME': os.path.abspath(sys.argv[0]),
-      'DOCUMENT_ROOT': os.getcwd() + '/',
-      'PATH_TRANSLATED': os.getcwd() + '/' + uri_headers['PATH_INFO'],
-      'SCRIPT_NAME': '',
-      'REDIRECT_STATUS': 200
-    }
-
-    all_headers = dict(self.request_headers.items() + wsgi_environ.items() +
-      other_headers.items() + uri_headers.items())
+    stream = ResponseStream(*rest, notify=lambda: self.server.call_from_thread(
+      self.resume_writing), max_buffered=self.server.buffer_size)
+    self.server.call_from_thread(self.send_response, status, headers, body, stream)
+    stream.produce()
 
-    try:
-      response = self.server.app(all_headers, self.start_response)
-    except Exception, e:
-      response = []
-      self.status = '500 Internal Server Error'
-      self.headers = [('Content-Type', 'text/html')]
+  def run_application(self, environ):
+    return run_application(self.server.app, environ, self.server.buffer_size)
 
-      response.append('<h1>500 Internal Server Error</h1>')
+  def send_response(self, status, headers, body, stream=None):
+    '''
+    Queue the status line, headers and body for writing. Must be called from the
+    event loop.
 
-    finally:
-      # Send headers
-      headers_sent = False
-      
-      # Send response
-      for i in response:
-        if not headers_sent:
-          self.send_headers(self.status, self.headers)
-          headers_sent = True
-        self.send(i)
-        
-      self.write_buffer.append(None)
-      
-      if self not in self.server.w_list:
-        self.server.w_list.append(self)
+    :param body: A list of chunks
+    :param stream: The rest of the body, as a :mod:`frame.server.stream` stream
+    '''
+    if self.closed:
+      if stream is not None:
+        stream.close()
+      return
 
-  def send_headers(self, status, headers):
-    self.send("HTTP/1.1 %s\r\n" % status)
-    for k, v in headers:
-      self.send("%s: %s\r\n" % (k, v))
-    self.send("\r\n")
+    self.server.metrics.response(status)
+    if self.app_end is not None:
+      timings = self.server.metrics.timings
+      timings['queued'].observe(self.app_start - self.request_start)
+      timings['app'].observe(self.app_end - self.app_start)
 
-  def start_response(self, status, headers, other=None):
-    self.status = status
-    self.headers = headers
-    self.other = other
+    headers = list(headers)
+    header_names = dict((k.lower(), v) for k, v in headers)
 
-  def send(self, data):
-    while data:
-      chunk = data[0:self.server.chunk_size]
-      self.write_buffer.append(chunk)
-      data = data[self.server.chunk_size:]
+    # A retiring server closes every connection after the response in progress
+    if 'close' in header_names.get('connection', '').lower() or not self.server.running:
+      self.keep_alive = False
+
+    if 'content-length' not in header_names and 'transfer-encoding' not in header_names \
+        and response_has_body(status):
+      if stream is None:
+        headers.append(('Content-Length', str(sum(len(i) for i in body))))
+      elif self.head_request:
+        # No body follows, so there is nothing to frame
+        pass
+      elif self.request_protocol == 'HTTP/1.1':
+        headers.append(('Transfer-Encoding', 'chunked'))
+        self.chunked = True
+        body = chunked(body)
+      else:
+        # HTTP/1.0 clients don't know chunked encoding; the end of the body is marked
+        # by closing the connection instead
+        self.keep_alive = False
+
+    if 'connection' not in header_names:
+      if not self.keep_alive:
+        headers.append(('Connection', 'close'))
+      elif self.request_protocol == 'HTTP/1.0':
+        headers.append(('Connection', 'keep-alive'))
+
+    self.send_headers(status, headers)
+
+    if self.head_request:
+      # Whatever follows the headers would be taken for the start of the next response
+      for i in body:
+        if isinstance(i, StaticFile):
+          i.close()
+      if stream is not None:
+        stream.close()
+      body, stream = [], None
+
+    for i in body:
+      self.send(i)
+
+    if stream is not None:
+      self.write_buffer.append(stream)
 
-    # Make sure connection is part of the write list
-    #if self not in self.server.w_list:
-    #  self.server.w_list.append(self)
+    self.write_buffer.append(None)
+    self.update_interest()
+
+  def send_headers(self, status, headers):
+    lines = ["HTTP/1.1 %s" % status]
+    lines.extend("%s: %s" % (k, v) for k, v in headers)
+    lines.append("\r\n")
+    self.send("\r\n".join(lines))
+
+  def send(self, data):
+    if data:
+      self.write_buffer.append(data)
 
   def shutdown(self):
     self.socket.shutdown(socket.SHUT_RDWR)
 
   def close(self):
-    # Deprecated in favor of using e_list
+    if self.closed:
+      return
+    self.closed = True
+
+    self.server.remove_connection(self)
     self.socket.close()
-    
-    if self in self.server.r_list:
-      self.server.r_list.remove(self)
-    if self in self.server.w_list:
-      self.server.w_list.remove(self)
-    if self in self.server.e_list:
-      self.server.e_list.remove(self)
+
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
+
+    # Release open files and stop any worker still producing the response
+    for i in self.write_buffer:
+      if i is not None and not isinstance(i, str):
+        i.close()
+    self.write_buffer.clear()
+
+    if self.parser.body is not None:
+      self.parser.body.abort()
+      self.parser.body.close()
       
   def fail(self):
     self.failures += 1
@@ -230,25 +896,148 @@ class Connection(object):
       self.close()
 
 
+def jittered(limit, jitter):
+  '''
+  ``limit`` lowered by a random fraction of up to ``jitter``; ``None`` (or 0) stays as
+  it is.
+  '''
+  if not limit:
+    return limit
+  return int(limit * (1 - random.SystemRandom().uniform(0, jitter or 0)))
+
+
 class HTTPServer(object):
-  def __init__(self, app, host='localhost', port=8080, listen=5, max_read=8092, chunk_size=1024, auto_reload=True):
+  #: The class handling each accepted connection
+  connection_class = Connection
+
+  #: The protocol's name, for the log
+  protocol = 'HTTP'
+
+  #: Seconds between checks of the recycling limits
+  recycle_interval = 1.0
+
+  #: Seconds between updates of the figures shared with other processes
+  publish_interval = 1.0
+
+  def __init__(self, app, host='localhost', port=8080, listen=128, max_read=8092, chunk_size=1024, auto_reload=True,
+      poller_name=None, poll_interval=1.0, accept_batch=64, keep_alive=None, num_workers=None,
+      queue_size=None, sock=None, reuse_port=False, max_header_size=None, max_body_size=None,
+      spool_threshold=None, buffer_size=None, header_timeout=None, body_timeout=None,
+      keep_alive_timeout=None, write_timeout=None, max_connections=None, max_requests=None,
+      metrics_path=None, expect_continue=None, recycle_requests=None, recycle_rss=None,
+      recycle_jitter=None, classify=None):
     self.app = app
     self.host = host
     self.port = port
     self.listen = listen
+    # No longer used; responses are written in as few system calls as possible
     self.chunk_size = chunk_size
     self.max_read = max_read
     self.auto_reload = auto_reload
 
+    # Maximum time to block in the poller; only matters for noticing stop() calls
+    # made from other threads
+    self.poll_interval = poll_interval
+
+    # Maximum number of pending connections to accept per wakeup
+    self.accept_batch = accept_batch
+
+    # Whether or not to honour HTTP persistent connections
+    self.keep_alive = config.http_server.keep_alive if keep_alive is None else keep_alive
+
+    # Open connections, keyed by file descriptor
+    self.connections = {}
+
+    # Requests with a larger head than this are refused
+    if max_header_size is None:
+      max_header_size = config.http_server.max_header_size
+    self.max_header_size = max_header_size
+
+    # Requests with a larger body are refused with 413; larger bodies than the spool
+    # threshold are buffered in a temporary file instead of memory
+    if max_body_size is None:
+      max_body_size = config.http_server.max_body_size
+    self.max_body_size = max_body_size
+    self.spool_threshold = config.http_server.spool_threshold if spool_threshold is None \
+      else spool_threshold
+
+    # Response bodies up to this size are buffered (and sent with a Content-Length);
+    # larger ones are streamed with at most this much waiting to be written
+    self.buffer_size = config.http_server.buffer_size if buffer_size is None else buffer_size
+
+    # Connection limits; a timeout of None (or 0) disables it
+    http_config = config.http_server
+    self.header_timeout = http_config.header_timeout if header_timeout is None \
+      else header_timeout
+    self.body_timeout = http_config.body_timeout if body_timeout is None else body_timeout
+    self.keep_alive_timeout = http_config.keep_alive_timeout if keep_alive_timeout is None \
+      else keep_alive_timeout
+    self.write_timeout = http_config.write_timeout if write_timeout is None \
+      else write_timeout
+    self.max_connections = http_config.max_connections if max_connections is None \
+      else max_connections
+    self.max_requests = http_config.max_requests if max_requests is None else max_requests
+
+    # Limits on the requests served and the memory used (in bytes) before the process
+    # is replaced by a fresh one; see check_recycle(). Each is lowered by a random
+    # fraction of up to recycle_jitter, so that workers started together don't all
+    # restart together.
+    if recycle_jitter is None:
+      recycle_jitter = http_config.recycle_jitter
+    self.recycle_requests = jittered(http_config.recycle_requests
+      if recycle_requests is None else recycle_requests, recycle_jitter)
+    self.recycle_rss = jittered(http_config.recycle_rss if recycle_rss is None
+      else recycle_rss, recycle_jitter)
+    self.recycling = False
+
+    # Called (with the reason) instead of reload() when the limits are reached; the
+    # prefork supervisor sets it to have the worker replaced
+    self.on_recycle = None
+
+    # Called with the environ of a request sent with Expect: 100-continue before its
+    # body is received; returns a status line to refuse the request with, or None to
+    # accept it. Frame's App provides one (App.expect_continue).
+    if expect_continue is None:
+      expect_continue = getattr(app, 'expect_continue', None)
+    self.expect_continue = expect_continue
+
+    # Called with the environ of every request; returns the priority class it waits for
+    # a worker in (see frame.server.worker). By default, the class named by
+    # config.priority, or by the route if the application tells (App.priority_class).
+    if classify is None:
+      classify = PriorityClassifier(route=getattr(app, 'priority_class', None))
+    self.classify = classify
+
+    # Counters and latency histograms, optionally served from metrics_path
+    self.metrics = ServerMetrics(self)
+    self.metrics_path = http_config.metrics_path if metrics_path is None else metrics_path
+
+    # Drives the connection timeouts; the loop wakes up at least every poll_interval, so
+    # there is no point in a finer resolution
+    self.timers = TimerWheel(resolution=min(1.0, poll_interval))
+
+    # Constant parts of every WSGI environ
+    self.script_filename = os.path.abspath(sys.argv[0])
+    self.document_root = os.getcwd() + '/'
     
-    self.connections = []
-    
-    # Setup worker queue
-    #self.worker_queue = HTTPQueue(self, config.http_server.num_workers)
+    # Worker pool settings; with no workers the application runs inside the event loop
+    self.num_workers = config.http_server.num_workers if num_workers is None else num_workers
+    self.queue_size = config.http_server.queue_size if queue_size is None else queue_size
+    self.retry_after = config.http_server.retry_after
 
-    # Setup socket
-    self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # The pool and the wakeup pipe are created by serve_forever() so that they belong
+    # to the process that actually serves requests
+    self.worker_queue = None
+    self.waker = None
+    self.pending_calls = deque()
+
+    # Setup socket; a socket that is passed in (e.g., by the prefork supervisor) or
+    # handed down by the previous generation is expected to already be bound and listening
+    if sock is None:
+      sock = handoff.inherited_socket()
+    self.inherited_socket = sock is not None
+    self.socket = sock if sock is not None else make_socket(reuse_port)
+    self.socket.setblocking(0)
 
     if self.auto_reload:
       self.module_monitor = modulemonitor.ModuleMonitor(self)
@@ -258,30 +1047,139 @@ class HTTPServer(object):
         FileSystemLoader('templates')]))
 
     self.running = True
+    self.listen_fd = None
+    self.accepting = True
+
+    # Set by retire(): the loop keeps running until this time to let requests finish
+    self.drain_deadline = None
+    self.shutdown_timeout = config.http_server.shutdown_timeout
 
-    # Basic lists needed for select
-    self.r_list = [self.socket]
-    self.w_list = []
-    self.e_list = []
+    # Whether SIGTERM retires the server rather than stopping it right away
+    self.graceful_shutdown = config.http_server.graceful_shutdown
+
+    # How long reload() waits for the new generation to come up
+    self.reload_timeout = config.http_server.reload_timeout
+
+    # Readiness backend (epoll, poll or select)
+    self.poller = poller.create_poller(poller_name or config.http_server.poller)
+
+  @classmethod
+  def make_listener(cls, host, port, listen=128, **options):
+    '''
+    Create the listening socket for several server processes to share; see
+    :mod:`frame.server.prefork`. ``options`` are the server's other options.
+    '''
+    sock = make_socket()
+    sock.bind((host, port))
+    sock.listen(listen)
+    return sock
 
   def bind_socket(self):
-    self.socket.bind((self.host, self.port))
-    self.socket.listen(self.listen)
+    if not self.inherited_socket:
+      self.socket.bind((self.host, self.port))
+      self.socket.listen(self.listen)
+    self.listen_fd = self.socket.fileno()
+    self.poller.register(self.listen_fd, poller.READ)
 
   def _handle_signal(self, signum, frame):
-    if signum in (signal.SIGTERM, signal.SIGINT):
+    if signum == signal.SIGTERM and self.graceful_shutdown and self.drain_deadline is None:
+      self.retire()
+    elif signum in (signal.SIGTERM, signal.SIGINT):
+      # A second SIGTERM (or a SIGINT) while draining cuts it short
+      if self.drain_deadline is not None:
+        self.drain_deadline = 0
       self.stop(True)
 
   def setup_signal_handlers(self):
     signal.signal(signal.SIGTERM, self._handle_signal)
     signal.signal(signal.SIGINT, self._handle_signal)
+    signal.signal(signal.SIGQUIT, lambda signum, frame: self.retire())
+
+  def add_connection(self, connection):
+    self.connections[connection.fd] = connection
+    self.metrics.connections_accepted.inc()
+    self.poller.register(connection.fd, poller.READ)
+    connection.handle_connect()
+
+  def remove_connection(self, connection):
+    if self.connections.get(connection.fd) is connection:
+      del(self.connections[connection.fd])
+      self.metrics.connections_closed.inc()
+      self.poller.unregister(connection.fd)
+
+      if not self.accepting and self.can_accept():
+        self.resume_accepting()
+
+  def can_accept(self):
+    '''
+    Whether there is room for another connection: the worker pool isn't saturated and
+    the connection limit hasn't been reached.
+    '''
+    if not self.running:
+      return False
+    if self.worker_queue is not None and self.worker_queue.full():
+      return False
+    return not self.max_connections or len(self.connections) < self.max_connections
+
+  def pause_accepting(self):
+    '''
+    Leave new connections in the kernel's listen backlog until there is room for them
+    again; see :meth:`can_accept`.
+    '''
+    if self.accepting and self.listen_fd is not None:
+      self.accepting = False
+      self.poller.modify(self.listen_fd, 0)
+
+  def resume_accepting(self):
+    if not self.accepting and self.listen_fd is not None:
+      self.accepting = True
+      self.poller.modify(self.listen_fd, poller.READ)
+
+  def handle_accept(self):
+    for i in xrange(self.accept_batch):
+      if not self.can_accept():
+        self.pause_accepting()
+        return
+
+      try:
+        accepted = self.socket.accept()
+      except socket.error, e:
+        if e.args[0] == errno.ECONNABORTED:
+          continue
+        elif e.args[0] in (errno.EMFILE, errno.ENFILE):
+          # Out of descriptors; wait for a connection to close rather than spin
+          logger.log_warning("Could not accept connection: %s" % e.args[1])
+          if self.connections:
+            self.pause_accepting()
+        elif e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+          raise
+        break
+
+      self.add_connection(self.connection_class(self, accepted))
+
+  def call_from_thread(self, callback, *args):
+    '''
+    Schedule ``callback(*args)`` to be run by the event loop. This is the only safe way
+    for other threads (i.e., the workers) to touch connections.
+    '''
+    self.pending_calls.append((callback, args))
+    self.waker.wake()
+
+  def run_pending_calls(self):
+    self.waker.consume()
+
+    while self.pending_calls:
+      callback, args = self.pending_calls.popleft()
+      callback(*args)
+
+    if not self.accepting and self.can_accept():
+      self.resume_accepting()
 
   def run(self):
     try:
       self.bind_socket()
     except socket.error, e:
-      logger.log_error("Could not start HTTP Server: %s" % e.args[1])
-      #self.worker_queue.stop()
+      logger.log_error("Could not start %s Server: %s" % (self.protocol, e.args[1]))
       sys.exit(1)
       
     self.setup_signal_handlers()
@@ -289,48 +1187,194 @@ class HTTPServer(object):
     if self.auto_reload:
       self.module_monitor.start()
     
-    logger.log_info("Frame HTTP Server is now ready")
+    logger.log_info("Frame %s Server is now ready (%s)" % (self.protocol, self.poller.name))
+    handoff.notify_ready()
+    self.serve_forever()
+
+  def reload(self):
+    '''
+    Replace this process with a fresh one running the current code, without dropping
+    the listening socket or the requests in progress; see :mod:`frame.server.handoff`.
+    Blocks until the new generation is ready, so it must not be called from the event
+    loop.
+
+    :return: Whether the new generation took over
+    '''
+    logger.log_info("Starting a new generation of the server...")
+    pid = handoff.spawn(self.socket, self.reload_timeout)
+    if pid is None:
+      logger.log_error("The new generation failed to start; carrying on")
+      return False
+
+    logger.log_info("Generation %s is ready" % pid)
+    self.retire()
+    return True
+
+  def publish_metrics(self):
+    '''
+    Called every :attr:`publish_interval` seconds when metrics are shared with other
+    processes; see :class:`frame.server.metrics.SharedMetrics`.
+    '''
+    self.metrics.publish()
+    if self.running:
+      self.timers.schedule(self.publish_interval, self.publish_metrics)
+
+  def check_recycle(self):
+    '''
+    Called every :attr:`recycle_interval` seconds if there are recycling limits:
+    recycles the process once it has served ``recycle_requests`` requests or its
+    resident memory exceeds ``recycle_rss`` bytes (as read from ``/proc``).
+    '''
+    if self.recycling or not self.running:
+      return
+
+    reason = None
+    if self.recycle_requests and self.metrics.requests.count >= self.recycle_requests:
+      reason = "served %s requests" % self.metrics.requests.count
+    elif self.recycle_rss:
+      rss = resident_memory()
+      if rss is not None and rss > self.recycle_rss:
+        reason = "using %.1f MB of memory" % (rss / 1048576.0)
+
+    if reason is None:
+      self.timers.schedule(self.recycle_interval, self.check_recycle)
+    else:
+      self.recycle(reason)
+
+  def recycle(self, reason):
+    '''
+    Have this process replaced by a fresh one, which takes over the listening socket
+    while this one drains: by the prefork supervisor (see :attr:`on_recycle`), or by a
+    new generation of the server like a code reload does.
+    '''
+    logger.log_info("Recycling process %s: %s" % (os.getpid(), reason))
+    self.recycling = True
+
+    if self.on_recycle is not None:
+      self.on_recycle(reason)
+    else:
+      # The new generation takes a while to start; the loop keeps serving meanwhile,
+      # and reload() retires this process from the thread once it is ready
+      reloader = threading.Thread(target=self.reload)
+      reloader.daemon = True
+      reloader.start()
+
+  def serve_forever(self):
+    '''
+    Run the event loop until :meth:`stop` is called. The socket must already be bound.
+    '''
+    listen_fd = self.listen_fd
+
+    self.waker = poller.Waker()
+    waker_fd = self.waker.fileno()
+    self.poller.register(waker_fd, poller.READ)
+
+    if self.num_workers:
+      self.worker_queue = HTTPQueue(self, self.num_workers, self.queue_size)
+
+    if self.recycle_requests or self.recycle_rss:
+      self.timers.schedule(self.recycle_interval, self.check_recycle)
+
+    if self.metrics.shared is not None:
+      self.timers.schedule(self.publish_interval, self.publish_metrics)
     
-    while self.running:
+    while self.running or self.draining():
       try:
-        r_ready, w_ready, e_ready = select.select(self.r_list, self.w_list, self.e_list, 0.01)
-      except (select.error, socket.error):
-        r_ready, w_ready, e_ready = [], [], []
-        self.running = False
-      except InvalidFD, e:
-        # In this case, a socket has closed prematurely; handle it gracefully and move on
-        conn = e.args[0]
-        for i in (self.r_list, self.w_list, self.e_list):
-          if conn in i:
-            i.remove(conn)
-        r_ready, w_ready, e_ready = [], [], []
-
-      for i in r_ready:
-        if i is self.socket:
-          connection = Connection(self, self.socket.accept())
-          self.r_list.append(connection)
-          connection.handle_connect()
-
-        elif isinstance(i, Connection):
-          i.handle_read()
-
-      for i in w_ready:
-        i.handle_write()
-
-      for i in e_ready:
-        i.handle_error()
+        events = self.poller.poll(self.poll_interval)
+      except (IOError, OSError, ValueError):
+        # The poller was closed underneath us by stop()
+        break
+
+      self.timers.advance()
+
+      for fd, event in events:
+        if fd == listen_fd:
+          if self.running:
+            self.handle_accept()
+          continue
+
+        elif fd == waker_fd:
+          self.run_pending_calls()
+          continue
+
+        connection = self.connections.get(fd)
+        if connection is None:
+          continue
+
+        if event & (poller.READ | poller.ERROR):
+          connection.handle_read()
+
+        if event & poller.WRITE and not connection.closed:
+          connection.handle_write()
+
+    if self.drain_deadline is not None:
+      aborted = sum(i.pending_requests() for i in self.connections.values())
+      self.metrics.aborted.inc(aborted)
+      logger.log_info("Drained %s requests, aborted %s" % (self.metrics.drained.value,
+        aborted))
+
+    for i in self.connections.values():
+      i.close()
+
+    if self.worker_queue is not None:
+      self.worker_queue.stop()
+
+    # The final figures, for the supervisor to keep once this process has exited
+    self.metrics.publish()
+
+    self.poller.close()
+
+    # stop() may still be called (e.g., after retire()); there is nobody left to wake
+    waker, self.waker = self.waker, None
+    waker.close()
         
   def stop(self, stop_monitor=False):
-    logger.log_info("Shutting down Frame HTTP Server...")
-    
-    for i in self.connections:
-      i.close()
-      i.join()
+    '''
+    Stop accepting connections and tell the event loop to exit. Safe to call from any
+    thread (or a signal handler); the listening socket is released immediately.
+    '''
+    logger.log_info("Shutting down Frame %s Server..." % self.protocol)
+    self.running = False
 
+    if self.listen_fd is not None:
+      self.poller.unregister(self.listen_fd)
+      self.listen_fd = None
     self.socket.close()
 
+    if self.waker is not None:
+      self.waker.wake()
+
     if stop_monitor and self.auto_reload:
       self.module_monitor.stop()
       self.module_monitor.join()
-      
-    #self.worker_queue.stop()
+
+  def retire(self, timeout=None):
+    '''
+    Stop accepting connections, but let the requests in progress finish before the
+    event loop exits (for up to ``timeout`` seconds, :attr:`shutdown_timeout` by
+    default). Idle persistent connections are closed right away. Safe to call from any
+    thread; it is what SIGTERM does unless ``config.http_server.graceful_shutdown`` is
+    off.
+
+    Requests answered in the meantime are counted by ``metrics.drained``; those still
+    unfinished at the deadline, whose connections are closed, by ``metrics.aborted``.
+    '''
+    if timeout is None:
+      timeout = self.shutdown_timeout
+    logger.log_info("Draining requests in progress (for up to %s seconds)..." % timeout)
+    self.drain_deadline = time.time() + timeout
+    self.stop()
+
+  def draining(self):
+    '''
+    Whether the loop should keep going after :meth:`retire`: there are requests left
+    and time to finish them.
+    '''
+    if self.drain_deadline is None:
+      return False
+
+    for i in self.connections.values():
+      if not i.pending_requests():
+        i.close()
+
+    return bool(self.connections) and time.time() < self.drain_deadline
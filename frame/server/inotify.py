@@ -0,0 +1,124 @@
+'''
+A minimal binding to Linux's ``inotify(7)`` through :mod:`ctypes`, used by
+:class:`frame.server.modulemonitor.ModuleMonitor` to be told about changed files
+instead of statting them over and over. Where inotify can't be used :data:`available`
+is ``False``.
+'''
+
+
+import os
+import errno
+import struct
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+#: The events that mean a file in a watched directory was (re)written, replaced or
+#: removed; editors that save by renaming a new file over the old one are covered too
+CHANGES = (IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+  IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = 0o2000000
+
+_event = struct.Struct('iIII')
+
+_libc = None
+
+try:
+  import ctypes
+  import ctypes.util
+
+  _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+  _libc.inotify_init1.argtypes = [ctypes.c_int]
+  _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+except (ImportError, OSError, AttributeError):
+  _libc = None
+
+
+#: Whether or not :class:`Inotify` can be used on this platform
+available = _libc is not None
+
+
+def _check(result):
+  if result == -1:
+    e = ctypes.get_errno()
+    raise OSError(e, os.strerror(e))
+  return result
+
+
+class Inotify(object):
+  '''
+  An inotify instance. :meth:`fileno` becomes readable when events are waiting, which
+  :meth:`read` then collects without blocking.
+  '''
+
+  def __init__(self):
+    if not available:
+      raise OSError(errno.ENOSYS, "inotify is not available on this platform")
+
+    self.fd = _check(_libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC))
+
+    # Watched directories, keyed by watch descriptor
+    self.paths = {}
+
+  def fileno(self):
+    return self.fd
+
+  def add_watch(self, path, mask=CHANGES):
+    '''
+    Watch a directory (or file); watching a path twice just returns its existing watch.
+
+    :return: The watch descriptor
+    '''
+    wd = _check(_libc.inotify_add_watch(self.fd, path, mask))
+    self.paths[wd] = path
+    return wd
+
+  def read(self):
+    '''
+    Collect the waiting events.
+
+    :return: A list of ``(directory, mask, name)`` tuples; ``directory`` is ``None``
+      for :data:`IN_Q_OVERFLOW`, which means events were lost
+    '''
+    try:
+      data = os.read(self.fd, 65536)
+    except OSError, e:
+      if e.errno in (errno.EAGAIN, errno.EINTR):
+        return []
+      raise
+
+    events = []
+    offset = 0
+
+    while offset < len(data):
+      wd, mask, cookie, length = _event.unpack_from(data, offset)
+      offset += _event.size
+      name = data[offset:offset + length].rstrip('\0')
+      offset += length
+
+      if mask & IN_IGNORED:
+        # The watch is gone (e.g., the directory was deleted)
+        self.paths.pop(wd, None)
+        continue
+
+      events.append((self.paths.get(wd), mask, name))
+
+    return events
+
+  def close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
@@ -0,0 +1,567 @@
+'''
+Counters and latency histograms kept by :class:`frame.server.http.HTTPServer`. They
+are meant to stay enabled in production, so recording is just a few integer additions
+and needs no locks: everything is recorded by the event loop thread. The one exception
+is the worker pool's utilisation, which is read off of the workers' own flags.
+
+The figures are available from Python as :meth:`ServerMetrics.snapshot` (the server's
+:attr:`metrics` attribute) and, if ``config.http_server.metrics_path`` is set, over
+HTTP from that path: as text in the Prometheus exposition format, or as JSON with
+``?format=json`` (or ``Accept: application/json``). The endpoint is answered by the
+server itself, without involving the application, so it should be kept away from the
+outside world by the proxy in front of it.
+
+When the server runs in several processes, they share their figures through
+:class:`SharedMetrics` and the endpoint answers for all of them (``?scope=process``
+for just the one answering). The application's own counters (see
+:meth:`frame._app.App.metrics`) are included as well.
+'''
+
+
+import os
+import time
+import json
+import mmap
+import struct
+from bisect import bisect_left
+from frame._config import config
+
+
+#: Default histogram buckets, in seconds
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+  5.0, 10.0)
+
+
+def resident_memory(pid='self'):
+  '''
+  The resident set size of a process in bytes, read from ``/proc``; ``None`` where
+  that isn't available.
+  '''
+  try:
+    with open('/proc/%s/statm' % pid) as statm:
+      return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (EnvironmentError, ValueError, IndexError):
+    return None
+
+
+def memory_usage(pid='self'):
+  '''
+  How much of a process' memory is shared with other processes (e.g., pages inherited
+  from the supervisor and not written to since) and how much is its own, read from
+  ``/proc/<pid>/smaps_rollup`` (or ``smaps`` on older kernels).
+
+  :return: A dictionary of ``rss``, ``pss`` (the process' proportional share), ``shared``
+    and ``private``, in bytes; ``None`` where that isn't available
+  '''
+  fields = {'Rss': 'rss', 'Pss': 'pss', 'Shared_Clean': 'shared',
+    'Shared_Dirty': 'shared', 'Private_Clean': 'private', 'Private_Dirty': 'private'}
+  usage = dict.fromkeys(fields.values(), 0)
+
+  for name in ('smaps_rollup', 'smaps'):
+    try:
+      with open('/proc/%s/%s' % (pid, name)) as smaps:
+        for line in smaps:
+          parts = line.split()
+          if len(parts) == 3 and parts[0][:-1] in fields:
+            usage[fields[parts[0][:-1]]] += int(parts[1]) * 1024
+      return usage
+    except (EnvironmentError, ValueError):
+      continue
+
+  return None
+
+
+class Counter(object):
+  __slots__ = ('value',)
+
+  def __init__(self):
+    self.value = 0
+
+  def inc(self, amount=1):
+    self.value += amount
+
+
+class Meter(object):
+  '''
+  Counts events and keeps their rate over the last ``window`` seconds.
+  '''
+
+  def __init__(self, window=10, clock=time.time):
+    self.window = window
+    self.clock = clock
+    self.count = 0
+
+    # One slot per second, recycled once the second it holds is out of the window
+    self.seconds = [None] * window
+    self.counts = [0] * window
+
+  def mark(self, amount=1):
+    self.count += amount
+
+    second = int(self.clock())
+    i = second % self.window
+    if self.seconds[i] != second:
+      self.seconds[i] = second
+      self.counts[i] = 0
+    self.counts[i] += amount
+
+  def rate(self):
+    '''
+    Events per second over the last complete seconds of the window. Doesn't change
+    anything, so it is safe to call from any thread.
+    '''
+    second = int(self.clock())
+    total = sum(c for s, c in zip(self.seconds, self.counts)
+      if s is not None and second - self.window < s < second)
+    return total / float(self.window - 1)
+
+
+class Histogram(object):
+  '''
+  A histogram with fixed buckets: recording a value is a binary search and an
+  increment.
+  '''
+
+  def __init__(self, buckets=latency_buckets):
+    self.buckets = tuple(buckets)
+    self.counts = [0] * (len(self.buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    self.counts[bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def snapshot(self):
+    '''
+    :return: A dictionary with the ``count``, ``sum`` and cumulative ``buckets`` (a list
+      of ``[upper_bound, count]``, the last bound being ``'+Inf'``)
+    '''
+    buckets = []
+    total = 0
+    for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+      total += count
+      buckets.append([bound, total])
+    return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+def application_metrics(app):
+  '''
+  The counters kept by the application, as ``{section: {name: value}}``; see
+  :meth:`frame._app.App.metrics`.
+  '''
+  metrics = getattr(app, 'metrics', None)
+  return metrics() if callable(metrics) else {}
+
+
+class ServerMetrics(object):
+  '''
+  Everything :class:`frame.server.http.HTTPServer` counts.
+  '''
+
+  #: Request phases with a latency histogram: waiting for a worker, in the
+  #: application (until the start of the response is ready), writing the response out
+  #: and the whole request
+  phases = ('queued', 'app', 'writing', 'total')
+
+  #: Status classes counted
+  status_classes = ('1xx', '2xx', '3xx', '4xx', '5xx')
+
+  #: Fields that describe the present rather than count what happened; they are left
+  #: out when the counts of exited processes are kept (see :class:`SharedMetrics`)
+  gauges = frozenset([('connections', 'active'), ('requests', 'rate'),
+    ('workers', 'total'), ('workers', 'busy'), ('workers', 'queued')])
+
+  #: Figures kept for each priority class of the worker pool (see
+  #: :mod:`frame.server.worker`): requests waiting, queued and refused
+  class_fields = ('queued', 'requests', 'rejected')
+
+  def __init__(self, server):
+    self.server = server
+    self.started = time.time()
+
+    self.connections_accepted = Counter()
+    self.connections_closed = Counter()
+    self.bytes_in = Counter()
+    self.bytes_out = Counter()
+    self.requests = Meter()
+    self.rejected = Counter()
+    self.timeouts = Counter()
+
+    # Requests finished and cut off while shutting down gracefully; see
+    # HTTPServer.retire()
+    self.drained = Counter()
+    self.aborted = Counter()
+
+    # Responses by status class ('2xx', '4xx', ...)
+    self.responses = {}
+
+    self.timings = dict((i, Histogram()) for i in self.phases)
+
+    # Set by share(): where this process publishes its figures for the others
+    self.shared = None
+    self.slot = None
+
+  @classmethod
+  def fields(cls, app=None):
+    '''
+    The figures of a snapshot as a flat list of paths (tuples of keys), in a fixed
+    order; histogram buckets are numbered. Processes running the same application
+    have the same fields, which is what lets :class:`SharedMetrics` add them up.
+    '''
+    fields = [('connections', 'accepted'), ('connections', 'closed'),
+      ('connections', 'active'), ('bytes', 'in'), ('bytes', 'out'),
+      ('requests', 'total'), ('requests', 'rate'), ('requests', 'rejected'),
+      ('requests', 'timeouts'), ('requests', 'drained'), ('requests', 'aborted')]
+    fields.extend(('responses', i) for i in cls.status_classes)
+    fields.extend([('workers', 'total'), ('workers', 'busy'), ('workers', 'queued')])
+
+    for name, weight in config.priority.classes:
+      fields.extend(('priority', name, i) for i in cls.class_fields)
+
+    for phase in cls.phases:
+      fields.extend([('timings', phase, 'count'), ('timings', phase, 'sum')])
+      fields.extend(('timings', phase, 'buckets', i)
+        for i in xrange(len(latency_buckets) + 1))
+
+    for section, values in sorted(application_metrics(app).items()):
+      fields.extend(('application', section, i) for i in sorted(values))
+
+    return fields
+
+  @classmethod
+  def gauge(cls, path):
+    '''
+    Whether a field (see :meth:`fields`) describes the present rather than counts.
+    '''
+    return path in cls.gauges or (path[0] == 'priority' and path[-1] == 'queued')
+
+  def response(self, status):
+    status_class = status[:1] + 'xx'
+    counter = self.responses.get(status_class)
+    if counter is None:
+      counter = self.responses[status_class] = Counter()
+    counter.inc()
+
+  def values(self):
+    '''
+    :return: The current value of each of :meth:`fields`, in the same order
+    '''
+    server = self.server
+    pool = server.worker_queue
+
+    current = {
+      ('connections', 'accepted'): self.connections_accepted.value,
+      ('connections', 'closed'): self.connections_closed.value,
+      ('connections', 'active'): len(server.connections),
+      ('bytes', 'in'): self.bytes_in.value,
+      ('bytes', 'out'): self.bytes_out.value,
+      ('requests', 'total'): self.requests.count,
+      ('requests', 'rate'): self.requests.rate(),
+      ('requests', 'rejected'): self.rejected.value,
+      ('requests', 'timeouts'): self.timeouts.value,
+      ('requests', 'drained'): self.drained.value,
+      ('requests', 'aborted'): self.aborted.value,
+      ('workers', 'total'): pool.num_workers if pool is not None else 0,
+      ('workers', 'busy'): pool.busy() if pool is not None else 0,
+      ('workers', 'queued'): pool.qsize() if pool is not None else 0,
+    }
+
+    for status_class, counter in self.responses.items():
+      current[('responses', status_class)] = counter.value
+
+    if pool is not None:
+      for name, figures in pool.stats().items():
+        for field, value in zip(self.class_fields, figures):
+          current[('priority', name, field)] = value
+
+    for phase, histogram in self.timings.items():
+      current[('timings', phase, 'count')] = histogram.count
+      current[('timings', phase, 'sum')] = histogram.sum
+      for i, count in enumerate(histogram.counts):
+        current[('timings', phase, 'buckets', i)] = count
+
+    for section, values in application_metrics(server.app).items():
+      for name, value in values.items():
+        current[('application', section, name)] = value
+
+    return [current.get(i, 0) for i in self.field_list]
+
+  @property
+  def field_list(self):
+    if self.shared is not None:
+      return self.shared.fields
+    return self.fields(self.server.app)
+
+  def snapshot(self):
+    '''
+    :return: All the figures of this process as a dictionary
+    '''
+    return build_snapshot(self.field_list, self.values(), self.started)
+
+  def share(self, shared, slot):
+    '''
+    Publish this process' figures in ``slot`` of ``shared`` (a :class:`SharedMetrics`);
+    the server calls :meth:`publish` every second and before answering a request for
+    the metrics, which are then those of every process.
+    '''
+    self.shared = shared
+    self.slot = slot
+
+  def publish(self):
+    if self.shared is not None:
+      self.shared.publish(self.slot, self.started, self.values())
+
+  def aggregate(self):
+    '''
+    :return: The figures of every process sharing metrics with this one (see
+      :meth:`share`), or of this one alone
+    '''
+    if self.shared is None:
+      return self.snapshot()
+    self.publish()
+    return self.shared.snapshot()
+
+  def json(self, data=None):
+    return json.dumps(self.snapshot() if data is None else data, sort_keys=True)
+
+  def text(self, data=None):
+    '''
+    The snapshot (or ``data``) in the Prometheus text exposition format.
+    '''
+    return format_text(self.snapshot() if data is None else data)
+
+
+def build_snapshot(fields, values, started, processes=None):
+  '''
+  Turn a list of values for ``fields`` (see :meth:`ServerMetrics.fields`) into the
+  dictionary :meth:`ServerMetrics.snapshot` returns.
+  '''
+  data = {'uptime': time.time() - started, 'responses': {}, 'priority': {},
+    'application': {}}
+  if processes is not None:
+    data['processes'] = processes
+
+  for path, value in zip(fields, values):
+    if path[-1] not in ('rate', 'sum'):
+      value = int(value)
+    if path[0] == 'responses' and not value:
+      continue
+
+    target = data
+    for key in path[:-1]:
+      target = target.setdefault(key, {})
+    target[path[-1]] = value
+
+  for timing in data['timings'].values():
+    buckets = []
+    total = 0
+    for bound, i in zip(latency_buckets + ('+Inf',), sorted(timing['buckets'])):
+      total += timing['buckets'][i]
+      buckets.append([bound, total])
+    timing['buckets'] = buckets
+
+  workers = data['workers']
+  workers['utilisation'] = workers['busy'] / float(workers['total']) \
+    if workers['total'] else 0.0
+
+  return data
+
+
+def format_text(data):
+  '''
+  A snapshot in the Prometheus text exposition format.
+  '''
+  lines = []
+
+  def add(name, kind, value, help, labels=None):
+    if labels is None:
+      lines.append('# HELP frame_%s %s' % (name, help))
+      lines.append('# TYPE frame_%s %s' % (name, kind))
+    label = ''
+    if labels:
+      label = '{%s}' % ','.join('%s="%s"' % i for i in sorted(labels.items()))
+    lines.append('frame_%s%s %s' % (name, label, value))
+
+  add('uptime_seconds', 'gauge', data['uptime'], 'Seconds since the server started')
+  if 'processes' in data:
+    add('processes', 'gauge', data['processes'], 'Server processes')
+
+  for name in ('accepted', 'closed'):
+    add('connections_%s_total' % name, 'counter', data['connections'][name],
+      'Connections %s' % name)
+  add('connections_active', 'gauge', data['connections']['active'], 'Open connections')
+
+  add('received_bytes_total', 'counter', data['bytes']['in'], 'Bytes received')
+  add('sent_bytes_total', 'counter', data['bytes']['out'], 'Bytes sent')
+
+  add('requests_total', 'counter', data['requests']['total'], 'Requests received')
+  add('requests_per_second', 'gauge', data['requests']['rate'],
+    'Recent requests per second')
+  add('requests_rejected_total', 'counter', data['requests']['rejected'],
+    'Requests refused because the worker pool was saturated')
+  add('timeouts_total', 'counter', data['requests']['timeouts'],
+    'Connections closed by a timeout')
+  add('requests_drained_total', 'counter', data['requests']['drained'],
+    'Requests finished while shutting down')
+  add('requests_aborted_total', 'counter', data['requests']['aborted'],
+    'Requests cut off by the shutdown deadline')
+
+  lines.append('# HELP frame_responses_total Responses sent, by status class')
+  lines.append('# TYPE frame_responses_total counter')
+  for status_class, value in sorted(data['responses'].items()):
+    add('responses_total', 'counter', value, None, {'status': status_class})
+
+  add('workers', 'gauge', data['workers']['total'], 'Worker threads')
+  add('workers_busy', 'gauge', data['workers']['busy'], 'Worker threads running a request')
+  add('worker_queue_depth', 'gauge', data['workers']['queued'],
+    'Requests waiting for a worker')
+
+  for field, name, kind, help in (
+      ('queued', 'priority_queue_depth', 'gauge',
+        'Requests waiting for a worker, by priority class'),
+      ('requests', 'priority_requests_total', 'counter',
+        'Requests queued for a worker, by priority class'),
+      ('rejected', 'priority_rejected_total', 'counter',
+        'Requests refused because the worker pool or their priority class was full')):
+    lines.append('# HELP frame_%s %s' % (name, help))
+    lines.append('# TYPE frame_%s %s' % (name, kind))
+    for priority, figures in sorted(data['priority'].items()):
+      add(name, kind, figures[field], None, {'class': priority})
+
+  lines.append('# HELP frame_request_duration_seconds Time spent per request phase')
+  lines.append('# TYPE frame_request_duration_seconds histogram')
+  for phase in ServerMetrics.phases:
+    timing = data['timings'][phase]
+    for bound, count in timing['buckets']:
+      add('request_duration_seconds_bucket', 'histogram', count, None,
+        {'phase': phase, 'le': bound})
+    add('request_duration_seconds_sum', 'histogram', timing['sum'], None,
+      {'phase': phase})
+    add('request_duration_seconds_count', 'histogram', timing['count'], None,
+      {'phase': phase})
+
+  for section, values in sorted(data['application'].items()):
+    for name, value in sorted(values.items()):
+      add('%s_%s_total' % (section, name), 'counter', value,
+        'Application counter: %s %s' % (section, name))
+
+  return '\n'.join(lines) + '\n'
+
+
+class SharedMetrics(object):
+  '''
+  The figures of several processes, in an anonymous shared memory mapping that is
+  created before they are forked (by :class:`frame.server.prefork.Supervisor`). Every
+  process has a slot of its own, which it overwrites with its current figures from
+  time to time (see :meth:`ServerMetrics.publish`); any of them can add the slots up.
+
+  Writing a slot needs no lock: each one is only ever written by one process, and a
+  sequence number that is odd while a write is in progress lets readers retry rather
+  than see half of it. When a process exits, the supervisor adds its counts (but not
+  its gauges) to slot 0, so totals don't go backwards.
+  '''
+
+  # Sequence number, pid and start time of the process, then its values
+  header = struct.Struct('=QQd')
+
+  #: How many times to try reading a slot that is being written before giving up on it:
+  #: a process killed in the middle of a write leaves it that way
+  read_attempts = 100
+
+  def __init__(self, fields, slots):
+    '''
+    :param fields: See :meth:`ServerMetrics.fields`
+    :param slots: The number of processes that can share metrics at once
+    '''
+    self.fields = list(fields)
+    self.slots = slots
+    self.record = struct.Struct('=QQd%dd' % len(self.fields))
+    self.memory = mmap.mmap(-1, self.record.size * (slots + 1))
+
+    # Counts are kept for exited processes; gauges aren't
+    self.cumulative = [not ServerMetrics.gauge(i) for i in self.fields]
+
+    # Slots not in use; only kept up to date in the supervisor
+    self.free = range(1, slots + 1)
+
+  def claim(self):
+    '''
+    Reserve a slot for a process about to be forked; ``None`` if they are all taken.
+    '''
+    return self.free.pop(0) if self.free else None
+
+  def publish(self, slot, started, values):
+    self.write(slot, os.getpid(), started, values)
+
+  def write(self, slot, pid, started, values):
+    offset = slot * self.record.size
+    sequence = self.header.unpack_from(self.memory, offset)[0]
+    if sequence % 2:
+      # The previous owner of the slot died in the middle of a write
+      sequence += 1
+    struct.pack_into('=Q', self.memory, offset, sequence + 1)
+    self.record.pack_into(self.memory, offset, sequence + 1, pid, started, *values)
+    struct.pack_into('=Q', self.memory, offset, sequence + 2)
+
+  def read(self, slot):
+    '''
+    :return: ``(pid, started, values)``; ``pid`` is 0 for a slot not in use, or one that
+      stays in the middle of a write
+    '''
+    offset = slot * self.record.size
+    for i in xrange(self.read_attempts):
+      record = self.record.unpack_from(self.memory, offset)
+      if record[0] % 2 == 0 and \
+          self.header.unpack_from(self.memory, offset)[0] == record[0]:
+        return record[1], record[2], record[3:]
+      time.sleep(0.0001)
+
+    return 0, 0, (0,) * len(self.fields)
+
+  def release(self, slot):
+    '''
+    Add the counts of a process that has exited to slot 0 and free its slot. Called by
+    the supervisor once the process has been reaped, so nothing writes to the slot any
+    more; it is read as it is, even if the process died in the middle of a write.
+    '''
+    record = self.record.unpack_from(self.memory, slot * self.record.size)
+    pid, started, values = record[1], record[2], record[3:]
+    if pid:
+      kept_pid, kept_started, kept = self.read(0)
+      totals = [a + b if cumulative else 0
+        for a, b, cumulative in zip(kept, values, self.cumulative)]
+      self.publish(0, kept_started or started, totals)
+      self.write(slot, 0, 0, [0] * len(self.fields))
+
+    self.free.append(slot)
+
+  def aggregate(self):
+    '''
+    :return: ``(processes, started, values)``: the number of processes publishing, the
+      earliest start time and the figures added up
+    '''
+    totals = [0] * len(self.fields)
+    processes = 0
+    earliest = None
+
+    for slot in xrange(self.slots + 1):
+      pid, started, values = self.read(slot)
+      if not pid:
+        continue
+      if slot:
+        processes += 1
+      if started and (earliest is None or started < earliest):
+        earliest = started
+      totals = [a + b for a, b in zip(totals, values)]
+
+    return processes, earliest or time.time(), totals
+
+  def snapshot(self):
+    '''
+    :return: The figures of every process, added up, as a dictionary like
+      :meth:`ServerMetrics.snapshot` with the number of ``processes`` as well
+    '''
+    processes, started, values = self.aggregate()
+    return build_snapshot(self.fields, values, started, processes)
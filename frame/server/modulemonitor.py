@@ -1,43 +1,103 @@
 import threading
 import sys
-import time
-import datetime
 import os
+import select
+import errno
 from frame import logger
+from frame._config import config
+import inotify
+
+
+def library_paths():
+	'''
+	Directories holding the standard library and installed packages; modules from
+	there are not the application's and aren't watched.
+	'''
+	paths = set()
+	for name in ('prefix', 'exec_prefix', 'real_prefix', 'base_prefix'):
+		path = getattr(sys, name, None)
+		if path:
+			paths.add(os.path.join(os.path.abspath(path), ''))
+
+	for path in sys.path:
+		if os.path.basename(path) in ('site-packages', 'dist-packages'):
+			paths.add(os.path.join(os.path.abspath(path), ''))
+
+	return tuple(paths)
 
 
 class ModuleMonitor(threading.Thread):
 	'''
-	Monitors all of the modules loaded by the current running application. If
-	any of them change (detected via os.stat), reload the running process.
+	Monitors the modules of the current running application, and its templates. If
+	any of them change, reload the running process.
+
+	Only the application's own files are watched: modules from the standard library
+	and installed packages are left out. On Linux the monitor is told about changes by
+	inotify; elsewhere (or with ``config.http_server.reload_watcher = 'poll'``) it
+	falls back to statting the files every ``interval`` seconds. Since saving a file or
+	checking out a branch often changes several files in a row, the reload waits until
+	nothing has changed for ``debounce`` seconds.
+
+	Servers with a ``reload`` method hand their listening socket over to a fresh
+	generation and finish their requests before exiting (see
+	:mod:`frame.server.handoff`); others are stopped and the process is replaced.
 	'''
-	def __init__(self, server, interval=1):
+	def __init__(self, server, interval=1, graceful=None, watcher=None, debounce=None):
 		self.server = server
 		self.interval = interval
+		if graceful is None:
+			graceful = config.http_server.graceful_reload
+		self.graceful = graceful
+		self.watcher = config.http_server.reload_watcher if watcher is None else watcher
+		self.debounce = config.http_server.reload_debounce if debounce is None else debounce
 		self._stop = threading.Event()
 
+		self.library_paths = library_paths()
+
+		# The absolute path of each module file seen so far, or None if it isn't the
+		# application's
+		self._application_files = {}
+		self._module_count = 0
+
+		# Set up by start_watching()
+		self.inotify = None
+		self.watched = set()
+		self.template_dirs = set()
+		self.stats = None
+
 		threading.Thread.__init__(self)
 
 	def run(self):
 		logger.log_info("Starting module reloader...")
-		datetime.datetime.now()
-		last_scan = datetime.datetime.now()
-		
-		old_stats = self.stat_modules()
-
-		while not self.stopped():
-			now = datetime.datetime.now()
-			delta = datetime.timedelta(seconds=self.interval)
-			if now > last_scan + delta:
-				new_stats = self.stat_modules()
-				if not self.compare_stats(old_stats, new_stats):
-					logger.log_info("File changed, reloading server...")
-					self.server.stop()
+		self.start_watching()
+
+		try:
+			while not self.stopped():
+				changed = self.changes(self.interval)
+				if not changed:
+					continue
+
+				while not self.stopped():
+					more = self.changes(self.debounce)
+					if not more:
+						break
+					changed |= more
+
+				if not self.stopped():
+					logger.log_info("File changed (%s), reloading server..." % ', '.join(
+						sorted(changed)[:3]))
 					self.restart_app()
-				old_stats = new_stats
-			time.sleep(1)
-			
+		finally:
+			self.stop_watching()
+
 	def restart_app(self):
+		if self.graceful and hasattr(self.server, 'reload'):
+			# If the new code doesn't start, keep serving the old until the next change
+			if self.server.reload():
+				self.stop()
+			return
+
+		self.server.stop()
 		python = sys.executable
 		os.execl(python, python, *sys.argv)
 
@@ -47,34 +107,196 @@ class ModuleMonitor(threading.Thread):
 	def stop(self):
 		logger.log_info("Stopping module reloader...")
 		self._stop.set()
-		
+
+	def start_watching(self):
+		'''
+		Set up inotify if it is available (or required), otherwise take the initial
+		stats for polling.
+		'''
+		if self.watcher in ('auto', 'inotify'):
+			try:
+				self.inotify = inotify.Inotify()
+				self.watch_directories()
+				return
+			except OSError, e:
+				if self.watcher == 'inotify':
+					raise
+				logger.log_warning("Could not use inotify (%s); polling for changes" % e)
+				self.stop_watching()
+
+		elif self.watcher != 'poll':
+			raise ValueError("Unknown reload watcher '%s'" % self.watcher)
+
+		self.stats = self.stat_modules()
+
+	def stop_watching(self):
+		if self.inotify is not None:
+			self.inotify.close()
+			self.inotify = None
+		self.watched.clear()
+
+	def changes(self, timeout):
+		'''
+		Wait up to ``timeout`` seconds for files to change.
+
+		:return: The set of changed paths, empty if there were none
+		'''
+		if self.inotify is None:
+			if self._stop.wait(timeout):
+				return set()
+			stats = self.stat_modules()
+			changed = self.changed_files(self.stats, stats)
+			self.stats = stats
+			return changed
+
+		try:
+			ready = select.select([self.inotify], [], [], timeout)[0]
+		except select.error, e:
+			if e.args[0] != errno.EINTR:
+				raise
+			ready = False
+
+		changed = set()
+		if ready:
+			for directory, mask, name in self.inotify.read():
+				if directory is None:
+					# The kernel's queue overflowed; something certainly changed
+					changed.add('(many files)')
+				elif self.is_relevant(directory, name, mask):
+					changed.add(os.path.join(directory, name))
+
+		# Pick up the directories of modules imported since the last look
+		try:
+			self.watch_directories()
+		except OSError, e:
+			# Most likely out of watches (fs.inotify.max_user_watches)
+			logger.log_warning("Could not watch for changes (%s); polling instead" % e)
+			self.stop_watching()
+			self.stats = self.stat_modules()
+
+		return changed
+
+	def watch_directories(self):
+		'''
+		Add an inotify watch for every application and template directory that isn't
+		watched yet.
+		'''
+		directories = set()
+
+		if len(sys.modules) != self._module_count or not self.watched:
+			self._module_count = len(sys.modules)
+			directories.update(os.path.dirname(i) for i in self.application_files())
+
+		if not self.template_dirs:
+			for path in self.template_paths():
+				for root, dirs, files in os.walk(path):
+					self.template_dirs.add(root)
+		directories.update(self.template_dirs)
+
+		for path in directories - self.watched:
+			self.add_watch(path)
+
+	def add_watch(self, path):
+		try:
+			self.inotify.add_watch(path)
+		except OSError, e:
+			# Directories can disappear; anything else is a real problem
+			if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+				raise
+		else:
+			self.watched.add(path)
+
+	def is_relevant(self, directory, name, mask):
+		'''
+		Whether an event is worth reloading for. Editors' swap and backup files and the
+		bytecode Python writes itself are ignored.
+		'''
+		if not name:
+			# The watched directory itself was moved or deleted
+			return True
+		if name.startswith('.') or name.endswith(('~', '.swp', '.swx')):
+			return False
+
+		if directory in self.template_dirs:
+			if mask & inotify.IN_ISDIR and mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+				# Watch new template directories too
+				path = os.path.join(directory, name)
+				self.template_dirs.add(path)
+				self.add_watch(path)
+			return True
+
+		return name.endswith('.py')
+
+	def application_path(self, path):
+		try:
+			return self._application_files[path]
+		except KeyError:
+			result = os.path.abspath(path)
+			if result.startswith(self.library_paths):
+				result = None
+			self._application_files[path] = result
+			return result
+
+	def application_files(self):
+		'''
+		The source files of the application's loaded modules.
+		'''
+		files = []
+		for name, module in sys.modules.items():
+			path = getattr(module, '__file__', None)
+			if not path:
+				continue
+
+			if path.endswith(('.pyc', '.pyo')):
+				path = path[:-1]
+
+			path = self.application_path(path)
+			if path is not None:
+				files.append(path)
+
+		return files
+
+	def template_paths(self):
+		'''
+		The application's template directories: ``config.templates.directory`` and
+		those of any file system loaders.
+		'''
+		paths = [config.templates.directory]
+		for loader in config.templates.loaders:
+			paths.extend(getattr(loader, 'searchpath', []))
+
+		paths = set(os.path.abspath(i) for i in paths)
+		return [i for i in paths if os.path.isdir(i) and
+			not i.startswith(self.library_paths)]
+
 	def compare_stats(self, old, new):
 		'''
 		Returns true if the two stat dictionaries don't differ, false
 		if they do.
 		'''
+		return not self.changed_files(old, new)
+
+	def changed_files(self, old, new):
+		'''
+		The paths whose modification time differs between two stat dictionaries.
+		'''
+		changed = set()
 		for key, value in old.iteritems():
 			if key in new and new[key].st_mtime != value.st_mtime:
-				return False
-		return True
-		
+				changed.add(key)
+		return changed
+
 	def stat_modules(self):
 		stats = {}
-		for name, module in sys.modules.items():
-			try:
-				path = module.__file__
-			except AttributeError:
-				continue
-			
-			try:
-				stats[path] = os.stat(path)
-			except EnvironmentError:
-				pass
-			
+		paths = self.application_files()
+		for path in self.template_paths():
+			for root, dirs, files in os.walk(path):
+				paths.extend(os.path.join(root, i) for i in files)
+
+		for path in paths:
 			try:
-				path = path[:-1]
 				stats[path] = os.stat(path)
 			except EnvironmentError:
 				pass
-			
+
 		return stats
@@ -0,0 +1,212 @@
+'''
+An incremental HTTP/1.x request parser for the built-in server. Data is fed to a
+:class:`RequestParser` as it arrives off of the socket; only the newly received bytes
+are scanned for the end of the headers, the head is joined and parsed exactly once,
+and the body is streamed into a :class:`frame.server.body.RequestBody` without
+re-copying the request.
+'''
+
+
+from body import RequestBody
+
+
+class ParseError(Exception):
+  '''
+  The request cannot be parsed. :attr:`status` is the status line that should be sent
+  back to the client before the connection is closed.
+  '''
+
+  def __init__(self, status, message=None):
+    self.status = status
+    Exception.__init__(self, message or status)
+
+
+#: Parser states
+HEADERS, BODY, COMPLETE = range(3)
+
+
+def parse_request_line(line):
+  '''
+  Parse ``METHOD URI HTTP/x.y`` into the corresponding WSGI environ items.
+  '''
+  parts = line.split(' ')
+  if len(parts) != 3 or not parts[2].startswith('HTTP/') or not parts[0].isupper():
+    raise ParseError('400 Bad Request', "Invalid request line.")
+
+  method, uri, protocol = parts
+  path_info, separator, query_string = uri.partition('?')
+
+  return {
+    'REQUEST_METHOD': method,
+    'REQUEST_URI': uri,
+    'PATH_INFO': path_info,
+    'QUERY_STRING': query_string,
+    'SERVER_PROTOCOL': protocol,
+  }
+
+
+def parse_headers(lines):
+  '''
+  Turn header lines into ``HTTP_*`` environ items. Repeated headers are joined with
+  commas and obsolete line folding is unfolded.
+  '''
+  result = {}
+  key = None
+
+  for line in lines:
+    if line[:1] in (' ', '\t'):
+      if key is None:
+        raise ParseError('400 Bad Request', "Invalid header continuation.")
+      result[key] += ' ' + line.strip()
+      continue
+
+    name, separator, value = line.partition(':')
+    name = name.strip()
+    if not separator or not name:
+      raise ParseError('400 Bad Request', "Invalid header line.")
+
+    key = 'HTTP_' + name.upper().replace('-', '_')
+    value = value.strip()
+
+    if key in result:
+      result[key] += ', ' + value
+    else:
+      result[key] = value
+
+  return result
+
+
+class RequestParser(object):
+  '''
+  Parses a single request. Feed it data with :meth:`feed` until :attr:`complete` is
+  true; bytes that belong to the next (pipelined) request are left in :attr:`leftover`.
+  '''
+
+  terminator = '\r\n\r\n'
+
+  def __init__(self, max_header_size=65536, max_body_size=None, spool_threshold=1048576):
+    '''
+    :param max_header_size: Largest request line plus headers accepted, in bytes
+    :param max_body_size: Largest Content-Length accepted; ``None`` for no limit
+    :param spool_threshold: Bodies larger than this are spooled to a temporary file
+    '''
+    self.max_header_size = max_header_size
+    self.max_body_size = max_body_size
+    self.spool_threshold = spool_threshold
+    self.state = HEADERS
+
+    #: Request line and header items for the WSGI environ
+    self.environ = None
+
+    #: The :class:`frame.server.body.RequestBody`, available once the headers are in
+    self.body = None
+
+    self.content_length = 0
+    self.body_received = 0
+    self.leftover = ''
+
+    self._head = []
+    self._head_size = 0
+    self._tail = ''
+
+  @property
+  def started(self):
+    '''
+    Whether any part of the request has been received yet.
+    '''
+    return self.state != HEADERS or self._head_size > 0
+
+  @property
+  def headers_complete(self):
+    return self.state != HEADERS
+
+  @property
+  def complete(self):
+    return self.state == COMPLETE
+
+  def feed(self, data):
+    '''
+    Consume received data.
+
+    :raise ParseError: If the request is malformed or the headers are too large
+    '''
+    if self.state == HEADERS:
+      self._feed_head(data)
+    elif self.state == BODY:
+      self._feed_body(data)
+    else:
+      self.leftover += data
+
+  def _feed_head(self, data):
+    if not self._head_size:
+      # Tolerate stray CRLFs between pipelined requests
+      data = data.lstrip('\r\n')
+      if not data:
+        return
+
+    # Only the new data (plus the last few bytes received, to catch a terminator that
+    # straddles several reads) needs to be scanned
+    overlap = self._tail
+    position = (overlap + data).find(self.terminator)
+
+    if position == -1:
+      self._head.append(data)
+      self._head_size += len(data)
+      self._tail = (overlap + data)[-3:]
+      if self._head_size > self.max_header_size:
+        raise ParseError('431 Request Header Fields Too Large')
+      return
+
+    end = position - len(overlap) + len(self.terminator)
+    self._head.append(data[:end])
+    self._head_size += end
+
+    if self._head_size > self.max_header_size:
+      raise ParseError('431 Request Header Fields Too Large')
+
+    self._parse_head(''.join(self._head))
+    self._head = []
+    self.body = RequestBody(self.content_length, self.spool_threshold)
+    self.state = BODY
+
+    if self.content_length:
+      self._feed_body(data[end:])
+    else:
+      self.state = COMPLETE
+      self.leftover = data[end:]
+
+  def _parse_head(self, head):
+    lines = head[:-len(self.terminator)].split('\r\n')
+    environ = parse_request_line(lines[0])
+    environ.update(parse_headers(lines[1:]))
+
+    if 'HTTP_TRANSFER_ENCODING' in environ:
+      raise ParseError('411 Length Required')
+
+    if 'HTTP_CONTENT_LENGTH' in environ:
+      try:
+        self.content_length = int(environ['HTTP_CONTENT_LENGTH'])
+      except ValueError:
+        raise ParseError('400 Bad Request', "Invalid Content-Length.")
+      if self.content_length < 0:
+        raise ParseError('400 Bad Request', "Invalid Content-Length.")
+      if self.max_body_size is not None and self.content_length > self.max_body_size:
+        raise ParseError('413 Request Entity Too Large')
+      environ['CONTENT_LENGTH'] = environ['HTTP_CONTENT_LENGTH']
+
+    if 'HTTP_CONTENT_TYPE' in environ:
+      environ['CONTENT_TYPE'] = environ['HTTP_CONTENT_TYPE']
+
+    self.environ = environ
+
+  def _feed_body(self, data):
+    remaining = self.content_length - self.body_received
+
+    if len(data) >= remaining:
+      self.leftover = data[remaining:]
+      data = data[:remaining]
+      self.state = COMPLETE
+
+    if data:
+      self.body.write(data)
+      self.body_received += len(data)
@@ -0,0 +1,288 @@
+'''
+Readiness notification backends for the Frame servers. Each backend wraps one of the
+kernel's polling interfaces behind the same small API so that the event loop in
+:mod:`frame.server.http` can register a file descriptor once and then only be woken
+up when something actually happens on it.
+
+The best available backend is chosen by :func:`create_poller`; on Linux that is
+``epoll``, elsewhere ``poll`` and finally ``select`` as a last resort (which is still
+capped at ``FD_SETSIZE`` descriptors). The backend can be forced with the
+``config.http_server.poller`` directive::
+
+  frame.config.http_server.poller = 'poll'
+'''
+
+
+import select
+import errno
+import os
+import fcntl
+
+
+#: Interest/event flag: the descriptor is readable
+READ = 0x01
+
+#: Interest/event flag: the descriptor is writable
+WRITE = 0x04
+
+#: Event flag: the descriptor has hung up or is in an error state
+ERROR = 0x08
+
+
+def _interrupted(e):
+  return e.args and e.args[0] == errno.EINTR
+
+
+class Poller(object):
+  '''
+  The interface every readiness backend implements. Events are expressed as a bitmask of
+  :data:`READ`, :data:`WRITE` and :data:`ERROR`.
+  '''
+
+  name = None
+
+  def register(self, fd, events):
+    '''
+    Start watching a file descriptor.
+
+    :param fd: The file descriptor (an integer)
+    :param events: The events of interest
+    '''
+    raise NotImplementedError
+
+  def modify(self, fd, events):
+    '''
+    Change the events of interest for an already registered file descriptor.
+    '''
+    raise NotImplementedError
+
+  def unregister(self, fd):
+    '''
+    Stop watching a file descriptor. Unknown descriptors are silently ignored.
+    '''
+    raise NotImplementedError
+
+  def poll(self, timeout=None):
+    '''
+    Wait for events.
+
+    :param timeout: Maximum number of seconds to wait; ``None`` waits forever
+    :return: A list of ``(fd, events)`` tuples; empty if interrupted by a signal
+    '''
+    raise NotImplementedError
+
+  def close(self):
+    pass
+
+
+class EpollPoller(Poller):
+  '''
+  Linux ``epoll`` backend (level triggered).
+  '''
+
+  name = 'epoll'
+
+  def __init__(self):
+    self._epoll = select.epoll()
+
+  def _native(self, events):
+    native = 0
+    if events & READ:
+      native |= select.EPOLLIN | select.EPOLLPRI
+    if events & WRITE:
+      native |= select.EPOLLOUT
+    return native
+
+  def register(self, fd, events):
+    self._epoll.register(fd, self._native(events))
+
+  def modify(self, fd, events):
+    self._epoll.modify(fd, self._native(events))
+
+  def unregister(self, fd):
+    try:
+      self._epoll.unregister(fd)
+    except (IOError, OSError, ValueError):
+      pass
+
+  def poll(self, timeout=None):
+    try:
+      ready = self._epoll.poll(-1 if timeout is None else timeout)
+    except (IOError, OSError), e:
+      if _interrupted(e):
+        return []
+      raise
+
+    result = []
+    for fd, native in ready:
+      events = 0
+      if native & (select.EPOLLIN | select.EPOLLPRI):
+        events |= READ
+      if native & select.EPOLLOUT:
+        events |= WRITE
+      if native & (select.EPOLLERR | select.EPOLLHUP):
+        events |= ERROR
+      result.append((fd, events))
+    return result
+
+  def close(self):
+    self._epoll.close()
+
+
+class PollPoller(Poller):
+  '''
+  POSIX ``poll`` backend.
+  '''
+
+  name = 'poll'
+
+  def __init__(self):
+    self._poll = select.poll()
+
+  def _native(self, events):
+    native = 0
+    if events & READ:
+      native |= select.POLLIN | select.POLLPRI
+    if events & WRITE:
+      native |= select.POLLOUT
+    return native
+
+  def register(self, fd, events):
+    self._poll.register(fd, self._native(events))
+
+  def modify(self, fd, events):
+    self._poll.modify(fd, self._native(events))
+
+  def unregister(self, fd):
+    try:
+      self._poll.unregister(fd)
+    except KeyError:
+      pass
+
+  def poll(self, timeout=None):
+    try:
+      ready = self._poll.poll(None if timeout is None else timeout * 1000)
+    except select.error, e:
+      if _interrupted(e):
+        return []
+      raise
+
+    result = []
+    for fd, native in ready:
+      events = 0
+      if native & (select.POLLIN | select.POLLPRI):
+        events |= READ
+      if native & select.POLLOUT:
+        events |= WRITE
+      if native & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+        events |= ERROR
+      result.append((fd, events))
+    return result
+
+
+class SelectPoller(Poller):
+  '''
+  Portable ``select`` backend. The descriptor sets are maintained incrementally rather
+  than rebuilt for every call.
+  '''
+
+  name = 'select'
+
+  def __init__(self):
+    self._readers = set()
+    self._writers = set()
+
+  def register(self, fd, events):
+    if events & READ:
+      self._readers.add(fd)
+    if events & WRITE:
+      self._writers.add(fd)
+
+  def modify(self, fd, events):
+    self.unregister(fd)
+    self.register(fd, events)
+
+  def unregister(self, fd):
+    self._readers.discard(fd)
+    self._writers.discard(fd)
+
+  def poll(self, timeout=None):
+    try:
+      r_ready, w_ready, e_ready = select.select(
+        self._readers, self._writers, self._readers | self._writers, timeout)
+    except select.error, e:
+      if _interrupted(e):
+        return []
+      raise
+
+    events = {}
+    for fd in r_ready:
+      events[fd] = events.get(fd, 0) | READ
+    for fd in w_ready:
+      events[fd] = events.get(fd, 0) | WRITE
+    for fd in e_ready:
+      events[fd] = events.get(fd, 0) | ERROR
+    return events.items()
+
+
+#: Available backends, in order of preference
+pollers = [
+  ('epoll', EpollPoller, lambda: hasattr(select, 'epoll')),
+  ('poll', PollPoller, lambda: hasattr(select, 'poll')),
+  ('select', SelectPoller, lambda: True),
+]
+
+
+def create_poller(name='auto'):
+  '''
+  Instantiate a readiness backend.
+
+  :param name: One of ``'epoll'``, ``'poll'``, ``'select'`` or ``'auto'`` to pick the
+    best one available on this platform
+  :return: A :class:`Poller`
+  '''
+
+  for backend_name, backend, available in pollers:
+    if name in ('auto', backend_name):
+      if available():
+        return backend()
+      elif name != 'auto':
+        raise ValueError("Poller '%s' is not available on this platform" % name)
+
+  raise ValueError("Unknown poller '%s'" % name)
+
+
+class Waker(object):
+  '''
+  A self-pipe that lets other threads interrupt :meth:`Poller.poll`. Register
+  :meth:`fileno` for :data:`READ` and call :meth:`consume` when it becomes readable.
+  '''
+
+  def __init__(self):
+    self.reader, self.writer = os.pipe()
+    for fd in (self.reader, self.writer):
+      flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+      fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+  def fileno(self):
+    return self.reader
+
+  def wake(self):
+    try:
+      os.write(self.writer, 'x')
+    except OSError, e:
+      # A full pipe already guarantees a wakeup
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        raise
+
+  def consume(self):
+    try:
+      while os.read(self.reader, 4096):
+        pass
+    except OSError, e:
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        raise
+
+  def close(self):
+    os.close(self.reader)
+    os.close(self.writer)
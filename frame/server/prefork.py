@@ -0,0 +1,466 @@
+'''
+A pre-forking process supervisor for the Frame servers. The listening socket is bound
+once by the supervisor (the "master") and then N worker processes are forked, each of
+which runs its own event loop on the inherited socket. Since the application has
+already been prepared and preloaded (see :meth:`frame._app.App.preload`), the route
+table, templates and everything else loaded at startup are shared copy-on-write
+between the workers; ``SIGUSR2`` makes the supervisor log how much memory each worker
+actually shares with the others and how much is its own.
+
+Alternatively, with ``reuse_port=True`` every worker binds its own socket with
+``SO_REUSEPORT`` and the kernel balances new connections between them.
+
+The supervisor restarts workers that die and passes shutdown signals on to them. On
+``SIGQUIT``, and on ``SIGTERM`` unless ``config.http_server.graceful_shutdown`` is off,
+the workers finish the requests they are working on before exiting; that is also how
+the old workers retire when the code is reloaded (see :mod:`frame.server.handoff`).
+``SIGINT`` stops them right away.
+
+Workers can be recycled to contain memory growth: with
+``config.http_server.recycle_requests`` or ``recycle_rss`` set, a worker that has
+served that many requests or grown past that many bytes asks the supervisor to replace
+it, and drains once its successor has been forked.
+
+Unless ``config.http_server.shared_metrics`` is off, the workers publish their metrics
+in shared memory (see :class:`frame.server.metrics.SharedMetrics`): the metrics
+endpoint of any of them, and the supervisor's :attr:`Supervisor.metrics`, cover them
+all.
+
+The supervisor is normally started through :meth:`frame._app.App.start_http`::
+
+  frame.start_http(workers=4)
+'''
+
+
+import os
+import sys
+import signal
+import select
+import errno
+import fcntl
+import time
+import traceback
+import gc
+from frame import logger
+from frame._config import config
+import poller
+import modulemonitor
+import handoff
+from metrics import SharedMetrics, ServerMetrics, memory_usage
+
+
+class WorkerProcess(object):
+  '''
+  The supervisor's record of one forked worker.
+  '''
+
+  def __init__(self, pid):
+    self.pid = pid
+    self.started = time.time()
+
+    # Set once the worker has been replaced and is finishing its requests
+    self.retire_deadline = None
+
+    # Its slot in the shared metrics, if it has one
+    self.slot = None
+
+  def __repr__(self):
+    return "<WorkerProcess(%s)>" % self.pid
+
+
+class Supervisor(object):
+  def __init__(self, app, server_class, host='127.0.0.1', port=8080, processes=2,
+      reuse_port=False, listen=128, auto_reload=True, shutdown_timeout=None, **server_options):
+    '''
+    :param app: The WSGI application
+    :param server_class: The server to run in each worker, e.g.
+      :class:`frame.server.http.HTTPServer`
+    :param processes: Number of worker processes to keep running
+    :param reuse_port: Have each worker bind its own ``SO_REUSEPORT`` socket instead of
+      sharing the supervisor's
+    :param auto_reload: Run the :class:`frame.server.modulemonitor.ModuleMonitor` in the
+      supervisor
+    :param shutdown_timeout: Seconds to wait for workers to exit before killing them
+    :param server_options: Passed on to ``server_class``
+    '''
+
+    self.app = app
+    self.server_class = server_class
+    self.host = host
+    self.port = port
+    self.processes = processes
+    self.reuse_port = reuse_port
+    self.listen = listen
+    self.auto_reload = auto_reload
+    self.server_options = server_options
+
+    if shutdown_timeout is None:
+      shutdown_timeout = config.http_server.shutdown_timeout
+    self.shutdown_timeout = shutdown_timeout
+    self.reload_timeout = config.http_server.reload_timeout
+
+    self.socket = None
+    self.workers = {}
+    self.running = False
+
+    # Workers that reach their recycling limits write their pid to this pipe (see
+    # frame.server.http.HTTPServer.recycle)
+    self.recycle_reader = None
+    self.recycle_writer = None
+
+    # The workers' metrics, added up; see frame.server.metrics.SharedMetrics. In a
+    # worker, slot is the one it publishes its own in.
+    self.metrics = None
+    self.slot = None
+
+    # Set when the workers should finish their requests before exiting
+    self.retiring = False
+    self.master_pid = os.getpid()
+
+    # Set by SIGUSR2: log how much memory the workers share
+    self.report_memory = False
+
+    # Minimum delay between respawning workers that crash right after starting
+    self.respawn_delay = 1
+    self.last_respawn = 0
+
+  def bind_socket(self):
+    self.socket = handoff.inherited_socket()
+    if self.socket is not None:
+      return
+
+    self.socket = self.server_class.make_listener(self.host, self.port, self.listen,
+      **self.server_options)
+
+  def _handle_signal(self, signum, frame):
+    if signum == signal.SIGTERM and config.http_server.graceful_shutdown:
+      self.retiring = True
+      self.running = False
+    elif signum in (signal.SIGTERM, signal.SIGINT):
+      self.running = False
+    elif signum == signal.SIGQUIT:
+      self.retiring = True
+      self.running = False
+    elif signum == signal.SIGUSR2:
+      self.report_memory = True
+
+  def setup_signal_handlers(self):
+    # Signals are only used to interrupt the wait in run(); the handlers just set flags
+    self.waker = poller.Waker()
+    signal.set_wakeup_fd(self.waker.writer)
+
+    signal.signal(signal.SIGTERM, self._handle_signal)
+    signal.signal(signal.SIGINT, self._handle_signal)
+    signal.signal(signal.SIGQUIT, self._handle_signal)
+    signal.signal(signal.SIGCHLD, self._handle_signal)
+    signal.signal(signal.SIGUSR2, self._handle_signal)
+
+  def run(self):
+    if not self.reuse_port:
+      try:
+        self.bind_socket()
+      except EnvironmentError, e:
+        logger.log_error("Could not start server: %s" % e.args[1])
+        sys.exit(1)
+
+    self.setup_signal_handlers()
+
+    if config.http_server.shared_metrics:
+      # Room for a replacement for every worker while the old ones drain
+      self.metrics = SharedMetrics(ServerMetrics.fields(self.app), self.processes * 2)
+
+    self.recycle_reader, self.recycle_writer = os.pipe()
+    for fd in (self.recycle_reader, self.recycle_writer):
+      fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    fcntl.fcntl(self.recycle_reader, fcntl.F_SETFL,
+      fcntl.fcntl(self.recycle_reader, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    if self.auto_reload:
+      self.module_monitor = modulemonitor.ModuleMonitor(self)
+      self.module_monitor.start()
+
+    logger.log_info("Supervisor started; forking %s workers" % self.processes)
+    self.running = True
+
+    # The application was prepared before we got here and forking is quick; in the
+    # meantime connections wait in the shared socket's backlog
+    handoff.notify_ready()
+
+    while self.running:
+      self.reap_workers()
+      self.spawn_workers()
+      self.check_retiring_workers()
+      if self.report_memory:
+        self.report_memory = False
+        self.log_memory_report()
+      self.wait(1)
+
+    if self.retiring:
+      self.retire()
+    else:
+      self.stop(True)
+
+  def reload(self):
+    '''
+    Start a new generation (supervisor and workers) running the current code on the
+    same listening socket and retire this one once it is ready; see
+    :mod:`frame.server.handoff`. Called by the module monitor.
+
+    :return: Whether the new generation took over
+    '''
+    logger.log_info("Starting a new generation of workers...")
+    pid = handoff.spawn(None if self.reuse_port else self.socket, self.reload_timeout)
+    if pid is None:
+      logger.log_error("The new generation failed to start; carrying on")
+      return False
+
+    logger.log_info("Generation %s is ready; retiring the old workers" % pid)
+    self.retiring = True
+    self.running = False
+    self.waker.wake()
+    return True
+
+  def wait(self, timeout):
+    try:
+      ready = select.select([self.waker.fileno(), self.recycle_reader], [], [], timeout)[0]
+    except select.error, e:
+      if e.args[0] != errno.EINTR:
+        raise
+    else:
+      if self.waker.fileno() in ready:
+        self.waker.consume()
+      if self.recycle_reader in ready:
+        self.read_recycle_requests()
+
+  def read_recycle_requests(self):
+    try:
+      data = os.read(self.recycle_reader, 4096)
+    except OSError, e:
+      if e.errno not in (errno.EAGAIN, errno.EINTR):
+        raise
+      return
+
+    for pid in data.split():
+      self.recycle_worker(int(pid))
+
+  def recycle_worker(self, pid):
+    '''
+    Replace a worker: fork its successor, then let it finish its requests and exit
+    (for up to :attr:`shutdown_timeout` seconds).
+    '''
+    worker = self.workers.get(pid)
+    if worker is None or worker.retire_deadline is not None or not self.running:
+      return
+
+    worker.retire_deadline = time.time() + self.shutdown_timeout
+    self.spawn_worker()
+
+    try:
+      os.kill(pid, signal.SIGQUIT)
+    except OSError, e:
+      if e.errno != errno.ESRCH:
+        raise
+
+  def check_retiring_workers(self):
+    '''
+    Stop replaced workers that are still busy after their deadline.
+    '''
+    now = time.time()
+    for worker in self.workers.values():
+      if worker.retire_deadline is not None and worker.retire_deadline < now:
+        logger.log_warning("Worker %s did not finish its requests in time" % worker.pid)
+        worker.retire_deadline = float('inf')
+        try:
+          os.kill(worker.pid, signal.SIGINT)
+        except OSError:
+          pass
+
+  def active_workers(self):
+    '''
+    The number of workers that haven't been replaced.
+    '''
+    return sum(1 for i in self.workers.values() if i.retire_deadline is None)
+
+  def spawn_workers(self):
+    while self.active_workers() < self.processes and self.running:
+      now = time.time()
+      if now - self.last_respawn < self.respawn_delay:
+        return
+      self.spawn_worker()
+
+  def spawn_worker(self):
+    slot = self.metrics.claim() if self.metrics is not None else None
+    pid = os.fork()
+
+    if pid:
+      worker = self.workers[pid] = WorkerProcess(pid)
+      worker.slot = slot
+      return pid
+
+    self.slot = slot
+
+    # Worker process; never returns
+    exit_code = 0
+    try:
+      self.worker_main()
+    except SystemExit, e:
+      exit_code = e.code
+    except Exception:
+      logger.log_exception(traceback.format_exc(), True)
+      exit_code = 1
+    finally:
+      os._exit(exit_code or 0)
+
+  def worker_main(self):
+    signal.set_wakeup_fd(-1)
+    self.waker.close()
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+    os.close(self.recycle_reader)
+
+    # Full collections touch every object inherited from the supervisor, copying the
+    # pages they are on; raising the thresholds makes them rarer
+    if config.preload.gc_thresholds:
+      gc.set_threshold(*config.preload.gc_thresholds)
+
+    options = dict(self.server_options)
+    options.update({
+      'host': self.host,
+      'port': self.port,
+      'listen': self.listen,
+      'auto_reload': False,
+      'reuse_port': self.reuse_port,
+      'sock': self.socket,
+    })
+
+    server = self.server_class(self.app, **options)
+    server.on_recycle = self.request_recycle
+    if self.slot is not None:
+      server.metrics.share(self.metrics, self.slot)
+    server.setup_signal_handlers()
+    server.bind_socket()
+
+    logger.log_info("Worker %s ready" % os.getpid())
+    server.serve_forever()
+
+  def memory_report(self):
+    '''
+    How much memory each worker shares with the others and how much is its own; see
+    :func:`frame.server.metrics.memory_usage`. Preloading the application (see
+    :meth:`frame._app.App.preload`) is meant to keep the shared part large.
+
+    :return: A dictionary of ``{pid: usage}``
+    '''
+    report = {}
+    for pid in sorted(self.workers):
+      usage = memory_usage(pid)
+      if usage is not None:
+        report[pid] = usage
+    return report
+
+  def log_memory_report(self):
+    megabyte = 1048576.0
+    for pid, usage in sorted(self.memory_report().items()):
+      logger.log_info("Worker %s: %.1f MB resident, %.1f MB shared, %.1f MB private "
+        "(%.1f MB proportional)" % (pid, usage['rss'] / megabyte, usage['shared'] / megabyte,
+        usage['private'] / megabyte, usage['pss'] / megabyte))
+
+  def request_recycle(self, reason):
+    '''
+    Ask the supervisor to replace this worker; called in the worker.
+    '''
+    os.write(self.recycle_writer, '%s\n' % os.getpid())
+
+  def reap_workers(self):
+    '''
+    Collect any workers that have exited.
+    '''
+    while True:
+      try:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+      except OSError, e:
+        if e.errno == errno.ECHILD:
+          return
+        raise
+
+      if not pid:
+        return
+
+      worker = self.workers.pop(pid, None)
+      if worker is None:
+        continue
+
+      if worker.slot is not None:
+        self.metrics.release(worker.slot)
+
+      if worker.retire_deadline is not None:
+        logger.log_info("Worker %s retired" % pid)
+      elif self.running:
+        lifetime = time.time() - worker.started
+        logger.log_warning("Worker %s exited with status %s after %.1fs; restarting" % (
+          pid, status, lifetime))
+
+        if lifetime < self.respawn_delay:
+          self.last_respawn = time.time()
+
+  def kill_workers(self, signum):
+    for pid in self.workers.keys():
+      try:
+        os.kill(pid, signum)
+      except OSError, e:
+        if e.errno == errno.ESRCH:
+          self.workers.pop(pid, None)
+
+  def retire(self):
+    '''
+    Let every worker finish the requests it is working on and exit, then shut down.
+    Workers that are still busy after :attr:`shutdown_timeout` seconds are stopped by
+    :meth:`stop`.
+    '''
+    logger.log_info("Retiring %s workers..." % len(self.workers))
+    self.kill_workers(signal.SIGQUIT)
+
+    deadline = time.time() + self.shutdown_timeout
+    while self.workers and time.time() < deadline:
+      self.reap_workers()
+      time.sleep(0.05)
+
+    self.stop(True)
+
+  def stop(self, stop_monitor=False):
+    '''
+    Ask every worker to shut down, wait up to :attr:`shutdown_timeout` seconds for them
+    and kill whatever is left. Also releases the listening socket.
+    '''
+    logger.log_info("Stopping %s workers..." % len(self.workers))
+    self.running = False
+    # SIGINT rather than SIGTERM, which workers take as a request to drain
+    self.kill_workers(signal.SIGINT)
+
+    deadline = time.time() + self.shutdown_timeout
+    while self.workers and time.time() < deadline:
+      self.reap_workers()
+      time.sleep(0.05)
+
+    if self.workers:
+      logger.log_warning("Killing %s workers that did not exit in time" % len(self.workers))
+      self.kill_workers(signal.SIGKILL)
+      for pid in self.workers.keys():
+        try:
+          os.waitpid(pid, 0)
+        except OSError:
+          pass
+      self.workers.clear()
+
+    if self.socket is not None:
+      self.socket.close()
+      self.socket = None
+
+    if self.recycle_reader is not None:
+      os.close(self.recycle_reader)
+      os.close(self.recycle_writer)
+      self.recycle_reader = self.recycle_writer = None
+
+    if stop_monitor and self.auto_reload:
+      self.module_monitor.stop()
+      self.module_monitor.join()
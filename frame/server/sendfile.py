@@ -0,0 +1,50 @@
+'''
+Access to the ``sendfile(2)`` system call, which copies data from a file to a socket
+without it ever passing through Python. ``os.sendfile`` is used when the interpreter
+provides it; otherwise, on Linux, the C library's ``sendfile64`` is called through
+:mod:`ctypes`. On any other platform :data:`available` is ``False`` and the servers
+fall back to reading the file in Python.
+'''
+
+
+import os
+import sys
+
+
+sendfile = None
+
+
+if hasattr(os, 'sendfile'):
+  sendfile = os.sendfile
+
+elif sys.platform.startswith('linux'):
+  try:
+    import ctypes
+    import ctypes.util
+
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _sendfile64 = _libc.sendfile64
+  except (ImportError, OSError, AttributeError):
+    pass
+  else:
+    _sendfile64.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+      ctypes.c_size_t]
+    _sendfile64.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+      '''
+      Send up to ``count`` bytes of ``in_fd``, starting at ``offset``, to ``out_fd``.
+      Mirrors ``os.sendfile`` from Python 3.
+
+      :return: The number of bytes sent
+      '''
+      position = ctypes.c_int64(offset)
+      sent = _sendfile64(out_fd, in_fd, ctypes.byref(position), count)
+      if sent == -1:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+      return sent
+
+
+#: Whether or not :func:`sendfile` can be used on this platform
+available = sendfile is not None
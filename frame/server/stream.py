@@ -0,0 +1,174 @@
+'''
+Response bodies that are too large to buffer are handed to the event loop as a stream
+that it pulls from only as the client's socket drains. :class:`ResponseStream` is fed by
+the worker thread running the application, which blocks once :attr:`max_buffered`
+bytes are waiting to be written; :class:`IteratorStream` is used when the application
+runs inside the event loop and simply advances the iterator on demand.
+
+Both offer the same interface to :class:`frame.server.http.Connection`: :meth:`take`
+returns the chunks that are ready (an empty list meaning "nothing yet" and ``None``
+meaning "finished"), :attr:`failed` tells whether the application raised part way
+through and :meth:`close` abandons the response.
+'''
+
+
+from threading import Condition
+from collections import deque
+import traceback
+from frame import logger
+from frame.staticdispatcher import StaticFile
+
+
+def chunk_size(chunk):
+  # Files are sent straight from disk, so they don't count against the buffer
+  return 0 if isinstance(chunk, StaticFile) else len(chunk)
+
+
+class IteratorStream(object):
+  def __init__(self, iterator, close=None, max_buffered=65536):
+    '''
+    :param iterator: The rest of the application's response
+    :param close: The response's ``close`` method, if any
+    :param max_buffered: Pull at most this many bytes per call to :meth:`take`
+    '''
+    self.iterator = iterator
+    self._close = close
+    self.max_buffered = max_buffered
+    self.failed = False
+    self.finished = False
+
+  def take(self):
+    if self.finished:
+      return None
+
+    chunks = []
+    size = 0
+
+    try:
+      while size < self.max_buffered:
+        chunk = next(self.iterator)
+        if not isinstance(chunk, StaticFile):
+          chunk = str(chunk)
+        if not chunk:
+          # A flush point; send what we have
+          break
+        chunks.append(chunk)
+        size += chunk_size(chunk)
+    except StopIteration:
+      self.close()
+    except Exception:
+      logger.log_exception(traceback.format_exc())
+      self.failed = True
+      self.close()
+
+    if not chunks and self.finished:
+      return None
+    return chunks
+
+  def close(self):
+    if not self.finished:
+      self.finished = True
+      if self._close is not None:
+        self._close()
+
+
+class ResponseStream(object):
+  def __init__(self, iterator, close=None, notify=None, max_buffered=65536):
+    '''
+    :param iterator: The rest of the application's response
+    :param close: The response's ``close`` method, if any
+    :param notify: Called (from the worker thread) when chunks become available after
+      :meth:`take` came back empty
+    :param max_buffered: The worker blocks while this many bytes are waiting
+    '''
+    self.iterator = iterator
+    self._close = close
+    self.notify = notify
+    self.max_buffered = max_buffered
+    self.failed = False
+    self.finished = False
+    self.cancelled = False
+
+    self._chunks = deque()
+    self._buffered = 0
+    self._waiting = False
+    self._condition = Condition()
+
+  def produce(self):
+    '''
+    Run the application's iterator to completion. Called in the worker thread.
+    '''
+    try:
+      for chunk in self.iterator:
+        if not isinstance(chunk, StaticFile):
+          chunk = str(chunk)
+        if not self._put(chunk):
+          break
+    except Exception:
+      logger.log_exception(traceback.format_exc())
+      self.failed = True
+    finally:
+      try:
+        if self._close is not None:
+          self._close()
+      finally:
+        self._condition.acquire()
+        try:
+          self.finished = True
+          self._wake_consumer()
+        finally:
+          self._condition.release()
+
+  def _put(self, chunk):
+    self._condition.acquire()
+    try:
+      while self._buffered >= self.max_buffered and not self.cancelled:
+        self._condition.wait()
+
+      if self.cancelled:
+        return False
+
+      self._chunks.append(chunk)
+      self._buffered += chunk_size(chunk)
+      self._wake_consumer()
+      return True
+    finally:
+      self._condition.release()
+
+  def _wake_consumer(self):
+    # Must be called with the condition held
+    if self._waiting:
+      self._waiting = False
+      if self.notify is not None:
+        self.notify()
+
+  def take(self):
+    '''
+    Collect everything the worker has produced so far. Called by the event loop.
+    '''
+    self._condition.acquire()
+    try:
+      chunks = list(self._chunks)
+      self._chunks.clear()
+      self._buffered = 0
+      self._condition.notify_all()
+
+      if not chunks:
+        if self.finished:
+          return None
+        self._waiting = True
+
+      return chunks
+    finally:
+      self._condition.release()
+
+  def close(self):
+    '''
+    The connection went away; make the worker stop at the next chunk.
+    '''
+    self._condition.acquire()
+    try:
+      self.cancelled = True
+      self._condition.notify_all()
+    finally:
+      self._condition.release()
@@ -0,0 +1,87 @@
+'''
+A hashed timer wheel for the event loop. Scheduling and cancelling a timer are O(1)
+regardless of how many are pending, which matters when every open connection has an
+idle timeout; the price is that timers only fire with a granularity of
+:attr:`TimerWheel.resolution` seconds, which is plenty for timeouts.
+'''
+
+
+import time
+
+
+class Timer(object):
+  '''
+  A pending call; returned by :meth:`TimerWheel.schedule`.
+  '''
+
+  __slots__ = ('wheel', 'tick', 'callback', 'args', 'slot')
+
+  def __init__(self, wheel, tick, callback, args):
+    self.wheel = wheel
+    self.tick = tick
+    self.callback = callback
+    self.args = args
+    self.slot = None
+
+  def cancel(self):
+    if self.slot is not None:
+      self.slot.discard(self)
+      self.slot = None
+
+  @property
+  def active(self):
+    return self.slot is not None
+
+
+class TimerWheel(object):
+  def __init__(self, resolution=1.0, size=512, clock=time.time):
+    '''
+    :param resolution: Length of a tick, in seconds
+    :param size: Number of slots; timers further out than ``size`` ticks simply stay
+      in their slot for more than one turn of the wheel
+    :param clock: Returns the current time in seconds
+    '''
+    self.resolution = resolution
+    self.size = size
+    self.clock = clock
+    self.slots = [set() for i in xrange(size)]
+    self.current_tick = self._tick(clock())
+
+  def __len__(self):
+    return sum(len(i) for i in self.slots)
+
+  def _tick(self, when):
+    return int(when / self.resolution)
+
+  def schedule(self, delay, callback, *args):
+    '''
+    Call ``callback(*args)`` in (at least) ``delay`` seconds.
+
+    :return: A :class:`Timer`, which can be cancelled
+    '''
+    # Round up so that a timer never fires early
+    tick = max(self._tick(self.clock() + delay) + 1, self.current_tick + 1)
+    timer = Timer(self, tick, callback, args)
+    timer.slot = self.slots[tick % self.size]
+    timer.slot.add(timer)
+    return timer
+
+  def advance(self, now=None):
+    '''
+    Fire every timer that is due. Call this regularly from the event loop.
+    '''
+    target = self._tick(self.clock() if now is None else now)
+
+    # After a long stall there is no point going around the wheel more than once
+    start = max(self.current_tick + 1, target - self.size + 1)
+
+    for tick in xrange(start, target + 1):
+      slot = self.slots[tick % self.size]
+      expired = [i for i in slot if i.tick <= target]
+
+      for timer in expired:
+        if timer.slot is slot:
+          timer.cancel()
+          timer.callback(*timer.args)
+
+    self.current_tick = max(self.current_tick, target)
@@ -1,51 +1,313 @@
+'''
+The worker pool behind :class:`frame.server.http.HTTPServer`. Requests wait for a worker
+in priority classes (``config.priority.classes``, highest first), so that health
+checks, static files or cheap API calls needn't wait behind slow pages. Workers take
+from the classes in proportion to their weights (``'weighted'``, the default) or
+always from the highest class with work waiting (``'strict'``, which can starve the
+lower classes for as long as the higher ones are busy).
+
+Requests are sorted into classes by :class:`PriorityClassifier`: by a request header
+set by the proxy in front (``config.priority.header``), by the ``priority`` a route
+declares (see :meth:`frame._app.App.priority_class`), by the longest prefix in
+``config.priority.paths`` that matches whole path segments, or else into
+``config.priority.default``. The class is left in the environ as ``frame.priority``;
+the load shedder never sheds ``'high'``.
+'''
+
+
 import threading
+from collections import deque
 from frame._config import config
 
 try:
-	from Queue import Queue
+	from Queue import Full
 except ImportError:
-	from queue import Queue
+	from queue import Full
 
 
 class HTTPWorker(threading.Thread):
+	'''
+	A thread that pulls ``(callable, arg1, arg2, ...)`` items off of the queue and calls
+	them. A ``None`` item tells the worker to exit.
+	'''
+
 	def __init__(self, queue):
 		self.queue = queue
 		threading.Thread.__init__(self)
-		
+		self.daemon = True
+
+		# Only ever set by the worker itself, so it can be read without a lock
+		self.busy = False
+
 	def run(self):
 		while True:
 			item = self.queue.get()
 			if not item:
 				break
 			else:
-				connection, request = item
-				connection.handle_request(request)
-				self.queue.task_done()
+				self.busy = True
+				try:
+					item[0](*item[1:])
+				finally:
+					self.busy = False
+					self.queue.task_done()
 		self.queue.task_done()
-		
-	
+
+
+class PriorityClass(object):
+	'''
+	The requests of one priority class waiting for a worker, and its counters.
+	'''
+
+	__slots__ = ('name', 'weight', 'limit', 'items', 'credit', 'requests', 'rejected')
+
+	def __init__(self, name, weight, limit=None):
+		self.name = name
+		self.weight = weight
+		self.limit = limit
+		self.items = deque()
+
+		# How far the class is owed a turn; see ClassQueue.next_class()
+		self.credit = 0
+
+		self.requests = 0
+		self.rejected = 0
+
+
+class ClassQueue(object):
+	'''
+	A queue with the interface of :class:`Queue.Queue` that the workers use, holding
+	items in priority classes. At most ``max_size`` items (if not 0) wait in all, and at
+	most ``limits[name]`` in a class.
+	'''
+
+	def __init__(self, classes, max_size=0, scheduler='weighted', limits=None,
+			default=None):
+		'''
+		:param classes: A list of ``(name, weight)``, highest priority first
+		:param scheduler: ``'weighted'`` or ``'strict'``
+		:param default: The class of items queued without one (by default, the lowest)
+		'''
+		if scheduler not in ('weighted', 'strict'):
+			raise ValueError('Unknown priority scheduler: %r' % scheduler)
+
+		limits = limits or {}
+		self.classes = [PriorityClass(name, weight, limits.get(name))
+			for name, weight in classes]
+		self.by_name = dict((i.name, i) for i in self.classes)
+		self.default = self.by_name.get(default, self.classes[-1])
+		self.max_size = max_size
+		self.strict = scheduler == 'strict'
+
+		# Stop requests for the workers, served once no work is left waiting (as with a
+		# FIFO queue, where they come after everything queued before them)
+		self.control = deque()
+
+		self.size = 0
+		self.unfinished = 0
+
+		self.mutex = threading.Lock()
+		self.not_empty = threading.Condition(self.mutex)
+		self.all_tasks_done = threading.Condition(self.mutex)
+
+	def put_nowait(self, item, priority=None):
+		'''
+		Queue ``item`` in class ``priority`` (the default class, if there is no such
+		class).
+
+		:raises Queue.Full: If there is no room for it
+		'''
+		with self.mutex:
+			if item is None:
+				self.control.append(item)
+			else:
+				queue = self.by_name.get(priority, self.default)
+				if (self.max_size and self.size >= self.max_size) or \
+						(queue.limit is not None and len(queue.items) >= queue.limit):
+					queue.rejected += 1
+					raise Full
+				queue.items.append(item)
+				queue.requests += 1
+				self.size += 1
+
+			self.unfinished += 1
+			self.not_empty.notify()
+
+	def get(self):
+		with self.mutex:
+			while not self.size and not self.control:
+				self.not_empty.wait()
+
+			if not self.size:
+				return self.control.popleft()
+
+			queue = self.next_class()
+			self.size -= 1
+			item = queue.items.popleft()
+			if not queue.items:
+				# An idle class doesn't save up turns
+				queue.credit = 0
+			return item
+
+	def next_class(self):
+		'''
+		The class to take the next item from. Must be called with the lock held, with
+		items waiting.
+		'''
+		if self.strict:
+			for queue in self.classes:
+				if queue.items:
+					return queue
+
+		# Smooth weighted round-robin: every waiting class gains its weight, and the one
+		# with the most credit goes and gives up the total
+		best = None
+		total = 0
+		for queue in self.classes:
+			if queue.items:
+				queue.credit += queue.weight
+				total += queue.weight
+				if best is None or queue.credit > best.credit:
+					best = queue
+		best.credit -= total
+		return best
+
+	def task_done(self):
+		with self.mutex:
+			self.unfinished -= 1
+			if not self.unfinished:
+				self.all_tasks_done.notify_all()
+
+	def join(self):
+		with self.mutex:
+			while self.unfinished:
+				self.all_tasks_done.wait()
+
+	def full(self):
+		return bool(self.max_size) and self.size >= self.max_size
+
+	def qsize(self):
+		return self.size
+
+	def stats(self):
+		'''
+		:return: ``{name: (waiting, requests, rejected)}`` for every class
+		'''
+		with self.mutex:
+			return dict((i.name, (len(i.items), i.requests, i.rejected))
+				for i in self.classes)
+
+
 class HTTPQueue(object):
-	def __init__(self, server, num_workers=10):
+	'''
+	A bounded pool of :class:`HTTPWorker` threads. Work is handed to the pool with
+	:meth:`put`, which never blocks; when ``max_size`` items are already waiting, the
+	item is refused so that the caller can push back on the client instead. Options not
+	given default to ``config.priority``; see the module documentation.
+	'''
+
+	def __init__(self, server, num_workers=10, max_size=0, classes=None, scheduler=None,
+			limits=None):
 		self.server = server
 		self.num_workers = num_workers
-		
-		self.queue = Queue()
+		self.max_size = max_size
+
+		options = config.priority
+		self.queue = ClassQueue(options.classes if classes is None else classes, max_size,
+			options.scheduler if scheduler is None else scheduler,
+			options.limits if limits is None else limits, options.default)
 		self.workers = self.start_workers(num_workers)
-		
+
 	def start_workers(self, num_workers):
 		workers = []
-		
+
 		for w in xrange(num_workers):
 			worker = HTTPWorker(self.queue)
 			workers.append(worker)
 			worker.start()
-			
+
 		return workers
-		
+
 	def stop(self):
 		for w in self.workers:
-			self.queue.put(None)
+			self.queue.put_nowait(None)
 		self.queue.join()
-		
-	def put(self, *args):
-		self.queue.put(args)
\ No newline at end of file
+
+	def put(self, *args, **kwargs):
+		'''
+		Queue a call to ``args[0](*args[1:])``, in the priority class given as
+		``priority``.
+
+		:return: ``False`` if the queue (or the class) is full and the item was not queued
+		'''
+		try:
+			self.queue.put_nowait(args, kwargs.get('priority'))
+		except Full:
+			return False
+		return True
+
+	def full(self):
+		return self.queue.full()
+
+	def qsize(self):
+		return self.queue.qsize()
+
+	def stats(self):
+		'''
+		The waiting requests and counters of each priority class; see
+		:meth:`ClassQueue.stats`.
+		'''
+		return self.queue.stats()
+
+	def busy(self):
+		'''
+		The number of workers currently running an item.
+		'''
+		return sum(1 for i in self.workers if i.busy)
+
+
+class PriorityClassifier(object):
+	'''
+	Tells which priority class a request belongs in; see the module documentation.
+	Options not given default to ``config.priority``.
+	'''
+
+	def __init__(self, classes=None, default=None, header=None, paths=None, route=None):
+		'''
+		:param route: Called with the environ; returns the class the request's route
+		  declares, or ``None``
+		'''
+		options = config.priority
+		self.classes = frozenset(name for name, weight in
+			(options.classes if classes is None else classes))
+		self.default = options.default if default is None else default
+		self.header = options.header if header is None else header
+		self.route = route
+
+		paths = options.paths if paths is None else paths
+		for name in paths.values() + [self.default]:
+			if name not in self.classes:
+				raise ValueError('Unknown priority class: %r' % name)
+
+		# Longest first, so the most specific prefix wins; a prefix only matches whole
+		# path segments, so '/api' covers '/api/users' but not '/apiary'
+		self.paths = [(prefix, prefix.rstrip('/') + '/', name) for prefix, name in
+			sorted(paths.items(), key=lambda i: len(i[0]), reverse=True)]
+
+	def __call__(self, environ):
+		if self.header:
+			name = environ.get(self.header)
+			if name in self.classes:
+				return name
+
+		if self.route is not None:
+			name = self.route(environ)
+			if name in self.classes:
+				return name
+
+		path = environ.get('PATH_INFO', '')
+		for prefix, directory, name in self.paths:
+			if path == prefix or path.startswith(directory):
+				return name
+
+		return self.default
@@ -0,0 +1,74 @@
+'''
+Access to the ``writev(2)`` system call, which writes several buffers to a socket in
+one go without joining them first. ``os.writev`` is used when the interpreter provides
+it; otherwise the C library's ``writev`` is called through :mod:`ctypes`. Where neither
+is possible :data:`available` is ``False`` and the servers join the buffers instead.
+'''
+
+
+import os
+
+
+writev = None
+
+
+#: Maximum number of buffers passed to one call (well below any platform's IOV_MAX)
+max_buffers = 64
+
+
+if hasattr(os, 'writev'):
+  def writev(fd, buffers, offset=0):
+    '''
+    Write ``buffers`` (a list of strings) to ``fd``, skipping the first ``offset``
+    bytes of the first buffer.
+
+    :return: The number of bytes written
+    '''
+    buffers = list(buffers[:max_buffers])
+    if offset:
+      buffers[0] = memoryview(buffers[0])[offset:]
+    return os.writev(fd, buffers)
+
+else:
+  try:
+    import ctypes
+    import ctypes.util
+
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _writev = _libc.writev
+  except (ImportError, OSError, AttributeError):
+    pass
+  else:
+    class iovec(ctypes.Structure):
+      _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+    _writev.argtypes = [ctypes.c_int, ctypes.POINTER(iovec), ctypes.c_int]
+    _writev.restype = ctypes.c_ssize_t
+
+    def writev(fd, buffers, offset=0):
+      '''
+      Write ``buffers`` (a list of strings) to ``fd``, skipping the first ``offset``
+      bytes of the first buffer. The strings are passed to the kernel in place.
+
+      :return: The number of bytes written
+      '''
+      buffers = buffers[:max_buffers]
+      vectors = (iovec * len(buffers))()
+
+      for i, data in enumerate(buffers):
+        # c_char_p points at the string's own storage; no copy is made
+        vectors[i].iov_base = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value
+        vectors[i].iov_len = len(data)
+
+      vectors[0].iov_base += offset
+      vectors[0].iov_len -= offset
+
+      written = _writev(fd, vectors, len(buffers))
+      if written == -1:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+      return written
+
+
+#: Whether or not :func:`writev` can be used on this platform
+available = writev is not None
@@ -10,6 +10,56 @@ from response import Response
 from random import getrandbits
 
 
+class StaticFile(object):
+	'''
+	A response body that refers to a region of an open file rather than holding its
+	contents. Servers that know about it (the built-in HTTP server) hand the file
+	descriptor, offset and length straight to ``sendfile``; any other WSGI server simply
+	iterates over it and gets the data in :attr:`block_size` chunks.
+	'''
+
+	block_size = 65536
+
+	def __init__(self, f, offset=0, length=None):
+		'''
+		:param f: An open file object
+		:param offset: Where the region starts
+		:param length: How many bytes to send; defaults to the rest of the file
+		'''
+		self.file = f
+		self.offset = offset
+
+		if length is None:
+			f.seek(0, 2)
+			length = f.tell() - offset
+		self.length = length
+
+	def __len__(self):
+		return self.length
+
+	def __iter__(self):
+		self.file.seek(self.offset)
+		remaining = self.length
+
+		while remaining > 0:
+			data = self.file.read(min(self.block_size, remaining))
+			if not data:
+				break
+			remaining -= len(data)
+			yield data
+
+		self.close()
+
+	def __repr__(self):
+		return "<StaticFile(%s, %s, %s)>" % (self.file.name, self.offset, self.length)
+
+	def fileno(self):
+		return self.file.fileno()
+
+	def close(self):
+		self.file.close()
+
+
 class StaticDispatcher(object):
 	'''
 	Establishes mount points for static files and then checks if those mount points are
@@ -149,16 +199,34 @@ class StaticDispatcher(object):
 				first_run = False
 
 	def get_range(self, f, r):
+		'''
+		Resolve a single byte range specifier (``500-999``, ``500-`` or ``-500``) against
+		a file.
+
+		:return: A tuple of ``(start, end, file_length)`` where ``end`` is inclusive, or
+			``None`` if the range cannot be satisfied
+		'''
+		f.seek(0, 2)
+		file_length = f.tell()
+
 		range_match = self.range_pattern.match(r)
 		if range_match:
-			f.seek(0, 2)
-			start = range_match.group(1)
-			file_length = f.tell()
+			start = int(range_match.group(1))
 			if range_match.group(2) == '':
 				end = file_length - 1
 			else:
-				end = int(range_match.group(2))
-			return (start, end, file_length)
+				end = min(int(range_match.group(2)), file_length - 1)
+
+		else:
+			negative_match = self.negative_range_pattern.match(r)
+			if not negative_match:
+				return None
+			start = max(file_length + int(negative_match.group(1)), 0)
+			end = file_length - 1
+
+		if start > end:
+			return None
+		return (start, end, file_length)
 
 	def match(self, environ):
 		'''
@@ -210,15 +278,20 @@ class StaticDispatcher(object):
 
 									if len(ranges) == 1:
 										temp_range = self.get_range(file_obj, ranges[0])
+										if temp_range is None:
+											raise Error416
+										start, end, file_length = temp_range
 										headers['Content-Range'] = 'bytes %s-%s/%s' % temp_range
+										headers['Content-Length'] = str(end - start + 1)
+										response_body = StaticFile(file_obj, start, end - start + 1)
 									else:
 										headers['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary_string
-
-									response_body = self.read_file(file_obj, ranges, boundary_string)
+										response_body = self.read_file(file_obj, ranges, boundary_string)
 							else:
 								raise Error416
 						else:
-							response_body = self.read_file(open(file_path, 'r'))
+							response_body = StaticFile(open(file_path, 'rb'))
+							headers['Content-Length'] = str(len(response_body))
 
 					except EnvironmentError:
 						raise Error401
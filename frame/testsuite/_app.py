@@ -15,9 +15,17 @@ class TestApp(unittest.TestCase):
 				
 			def error(self):
 				return invalid_name
+
+			def report(self):
+				return 'slow report'
+
+			def task(self, priority):
+				return 'task %s' % priority
 				
 		frame.routes.connect('/string', 'root#string')
 		frame.routes.connect('/error', 'root#error')
+		frame.routes.connect('/report', 'root#report', priority='low')
+		frame.routes.connect('/tasks/{priority}', 'root#task')
 		
 	def start_response(self, status, headers):
 		self.status = status
@@ -45,3 +53,63 @@ class TestApp(unittest.TestCase):
 		assert self.status == '200 OK'
 		assert output == 'basic string output'
 		assert str(len(output)) == self.headers['Content-Length']
+
+	def test_expect_continue(self):
+		environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/string'}
+		self.assertEqual(frame.app.expect_continue(environ), None)
+
+		environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/missing'}
+		self.assertEqual(frame.app.expect_continue(environ), '404 Not Found')
+
+	def test_continue_hooks(self):
+		def hook(environ):
+			if environ.get('HTTP_AUTHORIZATION') != 'secret':
+				return '401 Unauthorized'
+
+		frame.app.continue_hooks.append(hook)
+		try:
+			environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/string'}
+			self.assertEqual(frame.app.expect_continue(environ), '401 Unauthorized')
+			environ['HTTP_AUTHORIZATION'] = 'secret'
+			self.assertEqual(frame.app.expect_continue(environ), None)
+		finally:
+			frame.app.continue_hooks.remove(hook)
+
+	def test_priority_class(self):
+		environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/report/'}
+		self.assertEqual(frame.app.priority_class(environ), 'low')
+		environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/string'}
+		self.assertEqual(frame.app.priority_class(environ), None)
+
+		# Not passed on to the action
+		environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/report'}
+		self.assertEqual(frame.app._dispatch(environ).body, 'slow report')
+
+		# URL variables of the same name are nothing to do with it
+		environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/tasks/high'}
+		self.assertEqual(frame.app.priority_class(environ), None)
+		self.assertEqual(frame.app._dispatch(environ).body, 'task high')
+
+	def test_metrics(self):
+		from frame.microcache import MicroCache
+
+		frame.app.micro_cache = MicroCache()
+		try:
+			self.assertEqual(frame.app.metrics()['cache'], {'hits': 0, 'misses': 0,
+				'coalesced': 0})
+		finally:
+			frame.app.micro_cache = None
+
+	def test_preload(self):
+		from frame._app import import_package
+
+		calls = []
+		frame.app.preload_hooks.append(calls.append)
+		try:
+			frame.app.preload()
+		finally:
+			frame.app.preload_hooks.remove(calls.append)
+
+		self.assertEqual(calls, [frame.app])
+		self.assertTrue(frame.app.routes.mapper._created_regs)
+		self.assertEqual(import_package('frame.extensions'), 3)
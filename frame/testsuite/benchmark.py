@@ -0,0 +1,60 @@
+import unittest
+from frame.benchmark import ResponseReader, LoadGenerator, Results
+from server import ServerTestCase
+
+
+class TestResponseReader(unittest.TestCase):
+	def test_content_length(self):
+		reader = ResponseReader()
+		self.assertFalse(reader.feed('HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nab'))
+		self.assertTrue(reader.feed('cde'))
+		self.assertEqual((reader.status, reader.size, reader.keep_alive), (200, 5, True))
+
+	def test_chunked(self):
+		reader = ResponseReader()
+		reader.feed('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n')
+		self.assertFalse(reader.complete)
+		self.assertTrue(reader.feed('2\r\nde\r\n0\r\n\r\n'))
+		self.assertEqual(reader.size, 5)
+
+	def test_close_delimited(self):
+		reader = ResponseReader()
+		reader.feed('HTTP/1.0 200 OK\r\n\r\nabc')
+		self.assertFalse(reader.complete)
+		self.assertFalse(reader.keep_alive)
+		self.assertTrue(reader.eof())
+		self.assertEqual(reader.size, 3)
+
+
+class TestLoadGenerator(ServerTestCase):
+	def test_keep_alive(self):
+		results = LoadGenerator('127.0.0.1', self.port, '/hello', concurrency=4).run(
+			requests=50)
+		self.assertEqual(results.requests, 50)
+		self.assertEqual(results.statuses, {200: 50})
+		self.assertEqual(results.errors, {})
+		self.assertEqual(self.server.metrics.connections_accepted.value, 4)
+
+	def test_no_keep_alive(self):
+		results = LoadGenerator('127.0.0.1', self.port, '/hello', concurrency=4,
+			keep_alive=False).run(duration=0.3)
+		self.assertTrue(results.requests > 0)
+		self.assertEqual(results.errors, {})
+		# One connection per request, plus those cut off by the end of the run
+		accepted = self.server.metrics.connections_accepted.value
+		self.assertTrue(results.requests <= accepted <= results.requests + 4)
+
+
+class TestResults(unittest.TestCase):
+	def test_summary(self):
+		results = Results()
+		results.latencies = [i / 100.0 for i in xrange(1, 101)]
+		results.statuses = {200: 99, 500: 1}
+		results.duration = 2.0
+
+		summary = results.summary()
+		self.assertEqual(summary['requests_per_second'], 50)
+		self.assertEqual(summary['errors'], 1)
+		self.assertEqual(summary['latency']['p50'], 0.5)
+		self.assertEqual(summary['latency']['p99'], 0.99)
+		self.assertEqual(summary['latency']['max'], 1.0)
@@ -0,0 +1,86 @@
+import unittest
+from frame.loadshedding import LoadShedder, parse_request_start
+
+
+class TestLoadShedder(unittest.TestCase):
+	def setUp(self):
+		self.now = 1400000000.0
+		self.shedder = LoadShedder(target=0.1, interval=1.0, retry_after=2,
+			header='HTTP_X_REQUEST_START', exempt_paths=['/health'], clock=lambda: self.now)
+
+	def request(self, waited, at=None, **extra):
+		if at is not None:
+			self.now = 1400000000.0 + at
+		environ = {'PATH_INFO': '/', 'frame.request_start': self.now - waited}
+		environ.update(extra)
+		return self.shedder.should_shed(environ)
+
+	def test_short_waits(self):
+		for i in range(100):
+			self.assertFalse(self.request(0.05, i * 0.1))
+		self.assertEqual(self.shedder.admitted, 100)
+
+	def test_burst(self):
+		# Long waits are tolerated for up to an interval
+		self.assertFalse(self.request(0.5, 0))
+		self.assertFalse(self.request(0.5, 0.9))
+		self.assertFalse(self.request(0.01, 1.0))
+		self.assertFalse(self.request(0.5, 1.5))
+
+	def test_shedding(self):
+		self.assertFalse(self.request(0.5, 0))
+		self.assertTrue(self.request(0.5, 1.0))
+		self.assertFalse(self.request(0.5, 1.5))
+		self.assertTrue(self.request(0.5, 2.0))
+
+		# More and more often
+		self.assertFalse(self.request(0.5, 2.6))
+		self.assertTrue(self.request(0.5, 2.75))
+		self.assertEqual(self.shedder.shed, 3)
+
+	def test_recovery(self):
+		self.request(0.5, 0)
+		self.assertTrue(self.request(0.5, 1.0))
+		self.assertFalse(self.request(0.05, 1.1))
+		self.assertFalse(self.shedder.dropping)
+
+		self.assertFalse(self.request(0.5, 1.2))
+		self.assertFalse(self.request(0.5, 2.1))
+
+	def test_exempt(self):
+		self.request(0.5, 0)
+		self.assertFalse(self.request(0.5, 1.0, **{'frame.priority': 'high'}))
+		self.assertFalse(self.request(0.5, 1.1, PATH_INFO='/health/db'))
+		self.assertTrue(self.request(0.5, 1.2, PATH_INFO='/healthy'))
+
+	def test_unknown_wait(self):
+		self.assertFalse(self.shedder.should_shed({'PATH_INFO': '/'}))
+		self.assertEqual(self.shedder.queue_time({}, self.now), None)
+
+	def test_request_start_header(self):
+		self.assertEqual(parse_request_start('t=1408621526.5'), 1408621526.5)
+		self.assertEqual(parse_request_start('1408621526500'), 1408621526.5)
+		self.assertEqual(parse_request_start('t=1408621526500000'), 1408621526.5)
+		self.assertEqual(parse_request_start('soon'), None)
+
+		environ = {'frame.request_start': self.now - 0.1,
+			'HTTP_X_REQUEST_START': 't=%.3f' % (self.now - 0.3)}
+		self.assertAlmostEqual(self.shedder.queue_time(environ, self.now), 0.3, 3)
+
+		# Only ever earlier than the server's own time, and not absurdly so
+		environ['HTTP_X_REQUEST_START'] = 't=%.3f' % (self.now + 5)
+		self.assertAlmostEqual(self.shedder.queue_time(environ, self.now), 0.1, 3)
+		environ['HTTP_X_REQUEST_START'] = 't=1'
+		self.assertAlmostEqual(self.shedder.queue_time(environ, self.now), 0.1, 3)
+
+	def test_reject(self):
+		result = {}
+
+		def start_response(status, headers, exc_info=None):
+			result['status'] = status
+			result['headers'] = dict(headers)
+
+		body = ''.join(self.shedder.reject(start_response))
+		self.assertEqual(result['status'], '503 Service Unavailable')
+		self.assertEqual(result['headers']['Retry-After'], '2')
+		self.assertEqual(result['headers']['Content-Length'], str(len(body)))
@@ -0,0 +1,136 @@
+import unittest
+import threading
+import time
+from frame.microcache import MicroCache
+
+
+class CountingApp(object):
+	def __init__(self, headers=(), body=('hello',), delay=0):
+		self.headers = list(headers)
+		self.body = list(body)
+		self.delay = delay
+		self.calls = 0
+
+	def __call__(self, environ, start_response):
+		self.calls += 1
+		time.sleep(self.delay)
+		start_response('200 OK', [('Content-Type', 'text/plain')] + self.headers)
+		return iter(self.body)
+
+
+class TestMicroCache(unittest.TestCase):
+	def setUp(self):
+		self.now = 1000.0
+		self.cache = MicroCache(ttl=1, clock=lambda: self.now)
+
+	def environ(self, path='/', **extra):
+		environ = {'REQUEST_METHOD': 'GET', 'HTTP_HOST': 'example.com', 'PATH_INFO': path,
+			'QUERY_STRING': ''}
+		environ.update(extra)
+		return environ
+
+	def request(self, app, environ=None):
+		result = {}
+
+		def start_response(status, headers, exc_info=None):
+			result['status'] = status
+			result['headers'] = dict(headers)
+
+		body = ''.join(self.cache(environ or self.environ(), start_response, app))
+		return result['status'], result['headers'], body
+
+	def test_hit(self):
+		app = CountingApp()
+		self.assertEqual(self.request(app)[2], 'hello')
+		status, headers, body = self.request(app)
+		self.assertEqual(body, 'hello')
+		self.assertEqual(headers['Age'], '0')
+		self.assertEqual(app.calls, 1)
+		self.assertEqual(self.cache.hits, 1)
+
+	def test_expiry(self):
+		app = CountingApp()
+		self.request(app)
+		self.now += 1
+		self.request(app)
+		self.assertEqual(app.calls, 2)
+
+	def test_key(self):
+		app = CountingApp()
+		self.request(app, self.environ('/a'))
+		self.request(app, self.environ('/b'))
+		self.request(app, self.environ('/a', QUERY_STRING='x=1'))
+		self.request(app, self.environ('/a', HTTP_HOST='other.com'))
+		self.request(app, self.environ('/a', HTTP_ACCEPT_ENCODING='gzip'))
+		self.assertEqual(app.calls, 5)
+
+	def test_bypass(self):
+		app = CountingApp()
+		for i in range(2):
+			self.request(app, self.environ(REQUEST_METHOD='POST'))
+			self.request(app, self.environ(HTTP_COOKIE='theme=dark; FrameSession=abc'))
+			self.request(app, self.environ(HTTP_AUTHORIZATION='Basic Zm9v'))
+		self.assertEqual(app.calls, 6)
+
+		# Other cookies don't matter
+		self.request(app, self.environ(HTTP_COOKIE='theme=dark'))
+		self.request(app, self.environ(HTTP_COOKIE='theme=dark'))
+		self.assertEqual(app.calls, 7)
+
+	def test_uncacheable(self):
+		for headers in ([('Set-Cookie', 'a=b')], [('Cache-Control', 'private')]):
+			app = CountingApp(headers)
+			self.cache.clear()
+			self.request(app)
+			self.request(app)
+			self.assertEqual(app.calls, 2)
+
+	def test_strip_cookies(self):
+		app = CountingApp([('Set-Cookie', 'FrameSession=abc; Path=/')])
+		status, headers, body = self.request(app)
+		self.assertIn('Set-Cookie', headers)
+
+		status, headers, body = self.request(app)
+		self.assertNotIn('Set-Cookie', headers)
+		self.assertEqual(app.calls, 1)
+
+	def test_streamed(self):
+		app = CountingApp(body=['top', '', 'bottom'])
+		self.assertEqual(self.request(app)[2], 'topbottom')
+		self.assertEqual(self.request(app)[2], 'topbottom')
+		self.assertEqual(app.calls, 2)
+
+	def test_too_large(self):
+		self.cache.max_body_size = 4
+		app = CountingApp(body=['abc', 'def'])
+		self.assertEqual(self.request(app)[2], 'abcdef')
+		self.request(app)
+		self.assertEqual(app.calls, 2)
+
+	def test_max_entries(self):
+		self.cache.max_entries = 2
+		app = CountingApp()
+		for path in ('/a', '/b', '/c'):
+			self.request(app, self.environ(path))
+		self.assertEqual(len(self.cache.entries), 2)
+
+		self.request(app, self.environ('/a'))
+		self.assertEqual(app.calls, 4)
+
+	def test_coalescing(self):
+		self.cache.clock = time.time
+		app = CountingApp(delay=0.2)
+		bodies = []
+
+		def client():
+			bodies.append(self.request(app)[2])
+
+		threads = [threading.Thread(target=client) for i in range(5)]
+		for i in threads:
+			i.start()
+		for i in threads:
+			i.join(5)
+
+		self.assertEqual(bodies, ['hello'] * 5)
+		self.assertEqual(app.calls, 1)
+		self.assertEqual(self.cache.coalesced, 4)
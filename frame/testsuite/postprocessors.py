@@ -1,5 +1,6 @@
 import unittest
 import zlib
+import os
 from StringIO import StringIO
 from request import _environ
 from response import Controller
@@ -22,6 +23,26 @@ class TestPostprocessors(unittest.TestCase):
 		assert self.response.headers['Content-Encoding'] == 'deflate'
 		assert self.response.headers['Content-Length'] == str(len(encoded_string))
 		
+	def test_deflate_static_file(self):
+		from tempfile import NamedTemporaryFile
+		from frame.staticdispatcher import StaticDispatcher, StaticFile
+
+		with NamedTemporaryFile() as f:
+			f.write('static file contents')
+			f.flush()
+			directory, name = os.path.split(f.name)
+
+			environ = dict(_environ, PATH_INFO='/static/%s' % name,
+				HTTP_ACCEPT_ENCODING='deflate')
+			request = app.request = Request(environ)
+			response = StaticDispatcher(app, {'/static': directory}).match(environ)
+			self.assertTrue(isinstance(response.body, StaticFile))
+
+			deflate(request, response)
+			self.assertNotIn('Content-Encoding', response.headers)
+			self.assertEqual(''.join(response.body), 'static file contents')
+			response.body.close()
+		
 	def test_handle_head_request(self):
 		environ = dict(_environ)
 		environ['REQUEST_METHOD'] = 'HEAD'
@@ -0,0 +1,1806 @@
+import unittest
+import socket
+import threading
+import re
+from tempfile import NamedTemporaryFile
+from frame.server import poller
+from frame.server.parser import RequestParser, ParseError
+from frame.server.body import RequestBody
+from frame.server.stream import ResponseStream
+from frame.server import writev
+from frame.server.worker import ClassQueue, PriorityClassifier
+from frame.server.http import chunked
+from frame.server.timers import TimerWheel
+from frame.server import handoff
+from frame.server import fastcgi
+from frame.server import inotify
+from frame.server.modulemonitor import ModuleMonitor
+from frame.server.metrics import Histogram, Meter, ServerMetrics, SharedMetrics, \
+	resident_memory, memory_usage
+import json
+import tempfile
+import shutil
+import os
+import sys
+import frame
+import time
+import signal
+from frame.staticdispatcher import StaticFile
+
+
+class TestPoller(unittest.TestCase):
+	def setUp(self):
+		self.a, self.b = socket.socketpair()
+
+	def tearDown(self):
+		self.a.close()
+		self.b.close()
+
+	def check_backend(self, name):
+		try:
+			p = poller.create_poller(name)
+		except ValueError:
+			self.skipTest("%s is not available" % name)
+
+		fd = self.a.fileno()
+		p.register(fd, poller.READ)
+		self.assertEqual(list(p.poll(0)), [])
+
+		self.b.send('ping')
+		self.assertEqual(list(p.poll(1)), [(fd, poller.READ)])
+
+		p.modify(fd, poller.WRITE)
+		self.assertEqual(list(p.poll(1)), [(fd, poller.WRITE)])
+
+		p.unregister(fd)
+		p.unregister(fd)
+		self.assertEqual(list(p.poll(0)), [])
+		p.close()
+
+	def test_epoll(self):
+		self.check_backend('epoll')
+
+	def test_poll(self):
+		self.check_backend('poll')
+
+	def test_select(self):
+		self.check_backend('select')
+
+	def test_auto(self):
+		self.check_backend('auto')
+
+	def test_unknown(self):
+		with self.assertRaises(ValueError):
+			poller.create_poller('carrier-pigeon')
+
+
+def simple_app(environ, start_response):
+	body = '%s %s' % (environ['REQUEST_METHOD'], environ['PATH_INFO'])
+	if environ['PATH_INFO'] == '/echo':
+		body = environ['wsgi.input'].read()
+	start_response('200 OK', [('Content-Type', 'text/plain')])
+	return [body]
+
+
+class ServerTestCase(unittest.TestCase):
+	'''
+	Runs a :class:`frame.server.http.HTTPServer` on an ephemeral port in a background
+	thread for the duration of each test.
+	'''
+
+	app = staticmethod(simple_app)
+	server_options = {}
+
+	def setUp(self):
+		from frame.server.http import HTTPServer
+
+		self.server = HTTPServer(self.app, host='127.0.0.1', port=0, auto_reload=False,
+			poll_interval=0.05, **self.server_options)
+		self.server.bind_socket()
+		self.port = self.server.socket.getsockname()[1]
+
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def tearDown(self):
+		self.server.stop()
+		self.thread.join(5)
+
+	def connect(self):
+		connection = socket.create_connection(('127.0.0.1', self.port))
+		connection.settimeout(5)
+		return connection
+
+	def read_response(self, connection, buffered=''):
+		'''
+		Reads one Content-Length delimited response; returns ``(head, body, leftover)``.
+		'''
+		data = buffered
+		while '\r\n\r\n' not in data:
+			data += connection.recv(4096)
+
+		head, body = data.split('\r\n\r\n', 1)
+		length = int(re.search('Content-Length: (\d+)', head).group(1))
+
+		while len(body) < length:
+			body += connection.recv(4096)
+
+		return head, body[:length], body[length:]
+
+	def read_all(self, connection):
+		data = ''
+		while True:
+			chunk = connection.recv(4096)
+			if not chunk:
+				return data
+			data += chunk
+
+
+class TestKeepAlive(ServerTestCase):
+	def test_persistent(self):
+		connection = self.connect()
+		for path in ('/one', '/two'):
+			connection.sendall('GET %s HTTP/1.1\r\nHost: test\r\n\r\n' % path)
+			head, body, leftover = self.read_response(connection)
+			self.assertEqual(body, 'GET %s' % path)
+			self.assertNotIn('Connection: close', head)
+		connection.close()
+
+	def test_pipelined(self):
+		connection = self.connect()
+		connection.sendall(
+			'GET /one HTTP/1.1\r\n\r\n'
+			'POST /echo HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello'
+			'GET /three HTTP/1.1\r\nConnection: close\r\n\r\n')
+
+		data = self.read_all(connection)
+		bodies = []
+		while data:
+			head, body, data = self.read_response(connection, data)
+			bodies.append(body)
+
+		self.assertEqual(bodies, ['GET /one', 'hello', 'GET /three'])
+
+	def test_head(self):
+		# The HEAD response is headers only, so the GET's response follows right after
+		connection = self.connect()
+		connection.sendall('HEAD /one HTTP/1.1\r\n\r\nGET /two HTTP/1.1\r\n\r\n')
+
+		data = ''
+		while data.count('\r\n\r\n') < 2 or not data.endswith('GET /two'):
+			data += connection.recv(4096)
+
+		head, rest = data.split('\r\n\r\n', 1)
+		self.assertTrue('Content-Length: 9' in head)
+		self.assertNotIn('Connection: close', head)
+		self.assertTrue(rest.startswith('HTTP/1.1 200 OK'))
+		self.assertEqual(self.read_response(connection, rest)[1], 'GET /two')
+		connection.close()
+
+	def test_http10_closes(self):
+		connection = self.connect()
+		connection.sendall('GET / HTTP/1.0\r\n\r\n')
+		data = self.read_all(connection)
+		self.assertIn('Connection: close', data)
+		self.assertTrue(data.endswith('GET /'))
+
+
+class TestInlineMode(TestKeepAlive):
+	server_options = {'num_workers': 0}
+
+
+class TestWorkerPool(ServerTestCase):
+	server_options = {'num_workers': 2}
+	release = threading.Event()
+
+	@staticmethod
+	def app(environ, start_response):
+		if environ['PATH_INFO'] == '/block':
+			TestWorkerPool.release.wait(5)
+		return simple_app(environ, start_response)
+
+	def test_slow_request_does_not_block_loop(self):
+		self.release.clear()
+		blocked = self.connect()
+		blocked.sendall('GET /block HTTP/1.1\r\n\r\n')
+
+		fast = self.connect()
+		fast.sendall('GET /fast HTTP/1.1\r\n\r\n')
+		head, body, leftover = self.read_response(fast)
+		self.assertEqual(body, 'GET /fast')
+
+		self.release.set()
+		head, body, leftover = self.read_response(blocked)
+		self.assertEqual(body, 'GET /block')
+
+
+class TestClassQueue(unittest.TestCase):
+	classes = [('high', 3), ('normal', 1)]
+
+	def fill(self, queue, **counts):
+		for name, count in counts.items():
+			for i in range(count):
+				queue.put_nowait(name, name)
+
+	def test_weighted(self):
+		queue = ClassQueue(self.classes)
+		self.fill(queue, high=6, normal=6)
+		self.assertEqual([queue.get() for i in range(8)],
+			['high', 'high', 'normal', 'high'] * 2)
+
+		# Once the higher class is empty, the rest go in order
+		self.assertEqual([queue.get() for i in range(4)], ['normal'] * 4)
+		self.assertEqual(queue.qsize(), 0)
+
+	def test_strict(self):
+		queue = ClassQueue(self.classes, scheduler='strict')
+		self.fill(queue, high=2, normal=2)
+		self.assertEqual([queue.get() for i in range(4)],
+			['high', 'high', 'normal', 'normal'])
+
+		self.assertRaises(ValueError, ClassQueue, self.classes, scheduler='lottery')
+
+	def test_limits(self):
+		from Queue import Full
+
+		queue = ClassQueue(self.classes, max_size=3, limits={'normal': 1})
+		queue.put_nowait('a', 'normal')
+		self.assertRaises(Full, queue.put_nowait, 'b', 'normal')
+		queue.put_nowait('c', 'high')
+		queue.put_nowait('d', 'high')
+		self.assertTrue(queue.full())
+		self.assertRaises(Full, queue.put_nowait, 'e', 'high')
+
+		self.assertEqual(queue.stats(), {'high': (2, 2, 1), 'normal': (1, 1, 1)})
+
+	def test_default(self):
+		queue = ClassQueue(self.classes, default='high')
+		queue.put_nowait('a')
+		queue.put_nowait('b', 'unknown')
+		self.assertEqual(queue.stats()['high'], (2, 2, 0))
+
+	def test_stop(self):
+		# Work queued before the stop request is still done
+		queue = ClassQueue(self.classes)
+		self.fill(queue, normal=1)
+		queue.put_nowait(None)
+		self.assertEqual(queue.get(), 'normal')
+
+		queue.task_done()
+		self.assertEqual(queue.get(), None)
+		queue.task_done()
+		queue.join()
+
+
+	def test_stop_with_work_queued(self):
+		from frame.server.worker import HTTPQueue
+
+		release = threading.Event()
+		done = []
+
+		def work(name):
+			release.wait(5)
+			done.append(name)
+
+		pool = HTTPQueue(None, 1, classes=self.classes)
+		pool.put(work, 'running')
+		time.sleep(0.1)
+		pool.put(work, 'queued', priority='normal')
+
+		stopper = threading.Thread(target=pool.stop)
+		stopper.start()
+		release.set()
+		stopper.join(3)
+
+		self.assertFalse(stopper.is_alive())
+		self.assertEqual(done, ['running', 'queued'])
+
+
+class TestPriorityClassifier(unittest.TestCase):
+	classes = [('high', 3), ('normal', 2), ('low', 1)]
+
+	def test_classify(self):
+		routes = {'/reports/monthly': 'high'}
+		classify = PriorityClassifier(self.classes, 'normal', 'HTTP_X_PRIORITY',
+			{'/health': 'high', '/reports': 'low', '/reports/summary': 'normal'},
+			lambda environ: routes.get(environ['PATH_INFO']))
+
+		for path, headers, name in (
+				('/', {}, 'normal'),
+				('/health/db', {}, 'high'),
+				('/health', {}, 'high'),
+				('/healthy', {}, 'normal'),
+				('/reports/2014', {}, 'low'),
+				('/reports/summary', {}, 'normal'),
+				('/reports/monthly', {}, 'high'),
+				('/reports/2014', {'HTTP_X_PRIORITY': 'high'}, 'high'),
+				('/reports/2014', {'HTTP_X_PRIORITY': 'urgent'}, 'low')):
+			environ = dict(headers, PATH_INFO=path)
+			self.assertEqual(classify(environ), name)
+
+	def test_unknown_class(self):
+		self.assertRaises(ValueError, PriorityClassifier, self.classes, 'normal',
+			paths={'/health': 'urgent'})
+
+
+class TestPriority(ServerTestCase):
+	server_options = {'num_workers': 1, 'metrics_path': '/_metrics',
+		'classify': PriorityClassifier(paths={'/health': 'high'})}
+	release = threading.Event()
+	served = []
+
+	@staticmethod
+	def app(environ, start_response):
+		if environ['PATH_INFO'] == '/block':
+			TestPriority.release.wait(5)
+		TestPriority.served.append((environ['PATH_INFO'], environ['frame.priority']))
+		return simple_app(environ, start_response)
+
+	def test_overtakes(self):
+		self.release.clear()
+		del self.served[:]
+
+		connections = []
+		for path in ('/block', '/report', '/report', '/health'):
+			connection = self.connect()
+			connection.sendall('GET %s HTTP/1.1\r\n\r\n' % path)
+			connections.append(connection)
+
+			# One at a time, so that they are queued in this order
+			deadline = time.time() + 5
+			while self.server.metrics.requests.count < len(connections) and \
+					time.time() < deadline:
+				time.sleep(0.01)
+
+		self.release.set()
+		for connection in connections:
+			self.read_response(connection)
+
+		self.assertEqual(self.served, [('/block', 'normal'), ('/health', 'high'),
+			('/report', 'normal'), ('/report', 'normal')])
+
+		connection = self.connect()
+		connection.sendall('GET /_metrics?format=json HTTP/1.1\r\n\r\n')
+		data = json.loads(self.read_response(connection)[1])
+		self.assertEqual(data['priority']['high'], {'queued': 0, 'requests': 1,
+			'rejected': 0})
+		self.assertEqual(data['priority']['normal']['requests'], 3)
+
+		connection.sendall('GET /_metrics HTTP/1.1\r\n\r\n')
+		body = self.read_response(connection)[1]
+		self.assertTrue('frame_priority_requests_total{class="high"} 1\n' in body)
+		self.assertTrue('frame_priority_queue_depth{class="low"} 0\n' in body)
+
+
+class TestSendfile(ServerTestCase):
+	data = ''.join(chr(i % 256) for i in xrange(300000))
+
+	def app(self, environ, start_response):
+		f = NamedTemporaryFile()
+		f.write(self.data)
+		f.flush()
+
+		body = StaticFile(open(f.name, 'rb'), 1000, 250000)
+		start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+		return [body if environ['frame.sendfile'] else ''.join(body)]
+
+	def test_file_body(self):
+		connection = self.connect()
+		connection.sendall('GET /file HTTP/1.1\r\n\r\n')
+		head, body, leftover = self.read_response(connection)
+		self.assertIn('Content-Length: 250000', head)
+		self.assertEqual(body, self.data[1000:251000])
+
+
+class TestFileWrapper(ServerTestCase):
+	data = TestSendfile.data
+
+	def app(self, environ, start_response):
+		if environ['PATH_INFO'] == '/file':
+			f = NamedTemporaryFile()
+			f.write(self.data)
+			f.seek(1000)
+		else:
+			from StringIO import StringIO
+			f = StringIO(self.data[:5000])
+
+		start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+		return environ['wsgi.file_wrapper'](f, 4096)
+
+	def test_file(self):
+		connection = self.connect()
+		connection.sendall('GET /file HTTP/1.1\r\n\r\n')
+		head, body, leftover = self.read_response(connection)
+		self.assertIn('Content-Length: 299000', head)
+		self.assertEqual(body, self.data[1000:])
+
+	def test_file_like(self):
+		connection = self.connect()
+		connection.sendall('GET /other HTTP/1.1\r\n\r\n')
+		head, body, leftover = self.read_response(connection)
+		self.assertEqual(body, self.data[:5000])
+
+
+class TestTimeouts(ServerTestCase):
+	server_options = {'header_timeout': 0.3, 'keep_alive_timeout': 0.3, 'body_timeout': 0.3}
+
+	def test_idle_connection(self):
+		connection = self.connect()
+		start = time.time()
+		self.assertEqual(self.read_all(connection), '')
+		self.assertTrue(0.25 < time.time() - start < 2)
+
+	def test_slow_headers(self):
+		connection = self.connect()
+		connection.sendall('GET / HTTP/1.1\r\n')
+		time.sleep(0.2)
+		connection.sendall('X-Slow: 1\r\n')
+		self.assertTrue(self.read_all(connection).startswith('HTTP/1.1 408 '))
+
+	def test_keep_alive(self):
+		connection = self.connect()
+		connection.sendall('GET / HTTP/1.1\r\n\r\n')
+		head, body, leftover = self.read_response(connection)
+		self.assertEqual(self.read_all(connection), leftover)
+
+	def test_body(self):
+		connection = self.connect()
+		connection.sendall('POST /echo HTTP/1.1\r\nContent-Length: 100\r\n\r\n0123')
+		start = time.time()
+		for i in xrange(3):
+			# Trickling the body in keeps the connection alive
+			time.sleep(0.15)
+			connection.sendall('45')
+		self.assertEqual(self.read_all(connection), '')
+		self.assertTrue(time.time() - start > 0.6)
+
+
+class TestConnectionLimits(ServerTestCase):
+	server_options = {'max_connections': 2, 'max_requests': 2}
+
+	def test_max_connections(self):
+		first, second, third = self.connect(), self.connect(), self.connect()
+		third.sendall('GET /third HTTP/1.1\r\n\r\n')
+		third.settimeout(0.3)
+		self.assertRaises(socket.timeout, third.recv, 4096)
+
+		first.close()
+		third.settimeout(2)
+		head, body, leftover = self.read_response(third)
+		self.assertEqual(body, 'GET /third')
+
+	def test_max_requests(self):
+		connection = self.connect()
+		connection.sendall('GET /1 HTTP/1.1\r\n\r\n')
+		head, body, leftover = self.read_response(connection)
+		self.assertFalse('Connection: close' in head)
+
+		connection.sendall('GET /2 HTTP/1.1\r\n\r\n')
+		head, body, leftover = self.read_response(connection, leftover)
+		self.assertTrue('Connection: close' in head)
+
+
+def slow_app(environ, start_response):
+	time.sleep(0.3)
+	return simple_app(environ, start_response)
+
+
+class TestRetire(ServerTestCase):
+	app = staticmethod(slow_app)
+
+	def test_finishes_requests(self):
+		busy, idle = self.connect(), self.connect()
+		busy.sendall('GET /busy HTTP/1.1\r\n\r\n')
+		time.sleep(0.1)
+
+		self.server.retire()
+		head, body, leftover = self.read_response(busy)
+		self.assertEqual(body, 'GET /busy')
+		self.assertTrue('Connection: close' in head)
+		self.assertEqual(self.read_all(idle), '')
+
+		self.thread.join(2)
+		self.assertFalse(self.thread.is_alive())
+		self.assertRaises(socket.error, socket.create_connection, ('127.0.0.1', self.port))
+
+	def test_deadline(self):
+		connection = self.connect()
+		connection.sendall('GET /busy HTTP/1.1\r\n\r\n')
+		time.sleep(0.1)
+
+		self.server.retire(0.05)
+		self.assertEqual(self.read_all(connection), '')
+
+		self.thread.join(2)
+		self.assertEqual(self.server.metrics.aborted.value, 1)
+
+	def test_report(self):
+		connections = [self.connect() for i in range(2)]
+		for i in connections:
+			i.sendall('GET /busy HTTP/1.1\r\n\r\n')
+		time.sleep(0.1)
+
+		self.server.retire()
+		for i in connections:
+			self.assertEqual(self.read_response(i)[1], 'GET /busy')
+
+		self.thread.join(2)
+		data = self.server.metrics.snapshot()['requests']
+		self.assertEqual((data['drained'], data['aborted']), (2, 0))
+
+	def test_sigterm(self):
+		connection = self.connect()
+		connection.sendall('GET /busy HTTP/1.1\r\n\r\n')
+		time.sleep(0.1)
+
+		self.server._handle_signal(signal.SIGTERM, None)
+		self.assertEqual(self.read_response(connection)[1], 'GET /busy')
+
+	def test_second_sigterm(self):
+		connection = self.connect()
+		connection.sendall('GET /busy HTTP/1.1\r\n\r\n')
+		time.sleep(0.1)
+
+		self.server._handle_signal(signal.SIGTERM, None)
+		self.server._handle_signal(signal.SIGTERM, None)
+		self.assertEqual(self.read_all(connection), '')
+
+
+class TestRecycle(ServerTestCase):
+	server_options = {'recycle_requests': 3, 'recycle_jitter': 0}
+
+	def setUp(self):
+		ServerTestCase.setUp(self)
+		self.reasons = []
+		self.server.on_recycle = self.reasons.append
+
+	def wait_for_recycle(self):
+		deadline = time.time() + 3
+		while not self.reasons and time.time() < deadline:
+			time.sleep(0.05)
+		return self.reasons
+
+	def test_requests(self):
+		connection = self.connect()
+		for i in range(3):
+			connection.sendall('GET / HTTP/1.1\r\n\r\n')
+			self.read_response(connection)
+
+		self.assertEqual(self.wait_for_recycle(), ['served 3 requests'])
+		self.assertTrue(self.server.recycling)
+
+	def test_memory(self):
+		if resident_memory() is None:
+			self.skipTest("No /proc")
+
+		self.server.recycle_requests = None
+		self.server.recycle_rss = 1
+		self.assertIn('memory', self.wait_for_recycle()[0])
+
+	def test_memory_usage(self):
+		usage = memory_usage()
+		if usage is None:
+			self.skipTest("No /proc")
+
+		self.assertTrue(usage['rss'] > 0)
+		self.assertTrue(usage['shared'] + usage['private'] <= usage['rss'] + 4096)
+
+	def test_reload(self):
+		# Without a supervisor, a new generation is started like a code reload does; the
+		# loop must keep serving while it starts
+		spawned = []
+
+		def spawn(sock, timeout):
+			spawned.append(time.time())
+			time.sleep(1)
+			return 12345
+
+		self.server.on_recycle = None
+		original, handoff.spawn = handoff.spawn, spawn
+		try:
+			connection = self.connect()
+			for i in range(3):
+				connection.sendall('GET / HTTP/1.1\r\n\r\n')
+				self.read_response(connection)
+
+			deadline = time.time() + 3
+			while not spawned and time.time() < deadline:
+				time.sleep(0.01)
+			self.assertTrue(spawned)
+
+			start = time.time()
+			connection.sendall('GET / HTTP/1.1\r\n\r\n')
+			head, body, leftover = self.read_response(connection)
+			self.assertEqual(body, 'GET /')
+			self.assertTrue(time.time() - start < 0.5)
+
+			# Retired once the new generation is ready
+			self.thread.join(5)
+			self.assertFalse(self.thread.is_alive())
+			self.assertTrue(time.time() - spawned[0] >= 1)
+		finally:
+			handoff.spawn = original
+
+	def test_jittered(self):
+		from frame.server.http import jittered
+
+		self.assertEqual(jittered(None, 0.1), None)
+		self.assertEqual(jittered(1000, 0), 1000)
+		for i in range(20):
+			self.assertTrue(900 <= jittered(1000, 0.1) <= 1000)
+
+
+class TestHandoff(unittest.TestCase):
+	# Stands in for the new generation: serves one connection on the inherited socket
+	script = '''
+from frame.server import handoff
+from frame.server import inotify
+from frame.server.modulemonitor import ModuleMonitor
+from frame.server.metrics import Histogram, Meter
+import json
+import tempfile
+import shutil
+sock = handoff.inherited_socket()
+handoff.notify_ready()
+connection, addr = sock.accept()
+connection.sendall('new generation')
+connection.close()
+'''
+
+	def setUp(self):
+		from frame.server.http import make_socket
+
+		self.socket = make_socket()
+		self.socket.bind(('127.0.0.1', 0))
+		self.socket.listen(5)
+		self.port = self.socket.getsockname()[1]
+
+		self.argv = sys.argv
+		self.pythonpath = os.environ.get('PYTHONPATH')
+		self.file = NamedTemporaryFile(suffix='.py')
+		sys.argv = [self.file.name]
+		os.environ['PYTHONPATH'] = os.path.dirname(os.path.dirname(frame.__file__))
+
+	def tearDown(self):
+		sys.argv = self.argv
+		if self.pythonpath is None:
+			del(os.environ['PYTHONPATH'])
+		else:
+			os.environ['PYTHONPATH'] = self.pythonpath
+		self.file.close()
+		self.socket.close()
+
+	def write_script(self, script):
+		self.file.write(script)
+		self.file.flush()
+
+	def test_spawn(self):
+		self.write_script(self.script)
+		pid = handoff.spawn(self.socket, 10)
+		self.assertTrue(pid)
+
+		# The old generation lets go; the new one still answers on the same port
+		self.socket.close()
+		connection = socket.create_connection(('127.0.0.1', self.port), 5)
+		self.assertEqual(connection.recv(4096), 'new generation')
+		os.waitpid(pid, 0)
+
+	def test_failed_start(self):
+		self.write_script('raise SystemExit(1)')
+		self.assertEqual(handoff.spawn(self.socket, 10), None)
+
+	def test_timeout(self):
+		self.write_script('import time; time.sleep(10)')
+		start = time.time()
+		self.assertEqual(handoff.spawn(self.socket, 0.3), None)
+		self.assertTrue(time.time() - start < 5)
+
+
+class TestSupervisor(unittest.TestCase):
+	# Answers every request with the pid of the worker that served it
+	script = '''
+import os
+import frame
+
+frame.config.logger.driver = 'null'
+
+class Pid(frame.Controller):
+	def index(self):
+		return str(os.getpid())
+
+frame.routes.connect('/', 'pid#index')
+frame.app.start_http(port=%d, workers=2, auto_reload=False)
+'''
+
+	def setUp(self):
+		import subprocess
+
+		# The supervisor binds the socket itself, so find it a free port
+		probe = socket.socket()
+		probe.bind(('127.0.0.1', 0))
+		self.port = probe.getsockname()[1]
+		probe.close()
+
+		self.file = NamedTemporaryFile(suffix='.py')
+		self.file.write(self.script % self.port)
+		self.file.flush()
+
+		env = dict(os.environ)
+		env['PYTHONPATH'] = os.path.dirname(os.path.dirname(frame.__file__))
+		self.process = subprocess.Popen([sys.executable, self.file.name], env=env)
+
+	def tearDown(self):
+		if self.process.poll() is None:
+			self.process.kill()
+			self.process.wait()
+		self.file.close()
+
+	def get_pid(self):
+		connection = socket.create_connection(('127.0.0.1', self.port), 5)
+		connection.sendall('GET / HTTP/1.0\r\n\r\n')
+		data = ''
+		while True:
+			chunk = connection.recv(4096)
+			if not chunk:
+				break
+			data += chunk
+		connection.close()
+		return int(data.split('\r\n\r\n', 1)[1])
+
+	def wait_for_workers(self, count, exclude=()):
+		'''
+		Send requests until ``count`` different workers, none of them in ``exclude``,
+		have answered.
+		'''
+		pids = set()
+		deadline = time.time() + 20
+		while len(pids) < count:
+			self.assertTrue(time.time() < deadline, 'only saw workers %s' % sorted(pids))
+			try:
+				pid = self.get_pid()
+			except socket.error:
+				time.sleep(0.1)
+				continue
+			if pid not in exclude:
+				pids.add(pid)
+		return pids
+
+	def is_running(self, pid):
+		try:
+			os.kill(pid, 0)
+		except OSError:
+			return False
+		return True
+
+	def test_workers(self):
+		# Requests are spread across the workers
+		pids = self.wait_for_workers(2)
+		self.assertNotIn(self.process.pid, pids)
+
+		# A worker that dies is replaced
+		dead = pids.pop()
+		os.kill(dead, signal.SIGKILL)
+		replacement = self.wait_for_workers(1, exclude=(dead,) + tuple(pids)).pop()
+		self.assertFalse(self.is_running(dead))
+		pids.add(replacement)
+
+		# SIGTERM stops the supervisor and every worker
+		self.process.send_signal(signal.SIGTERM)
+		deadline = time.time() + 20
+		while self.process.poll() is None and time.time() < deadline:
+			time.sleep(0.05)
+		self.assertEqual(self.process.returncode, 0)
+
+		while any(self.is_running(i) for i in pids) and time.time() < deadline:
+			time.sleep(0.05)
+		self.assertEqual([i for i in pids if self.is_running(i)], [])
+
+
+class ReloadRecorder(object):
+	def __init__(self):
+		self.reloads = []
+
+	def reload(self):
+		self.reloads.append(time.time())
+		return True
+
+
+class TestModuleMonitor(unittest.TestCase):
+	watcher = 'poll'
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 'monitored_module.py')
+		self.write('value = 1\n')
+
+		sys.path.insert(0, self.directory)
+		import monitored_module
+
+		self.server = ReloadRecorder()
+		self.monitor = ModuleMonitor(self.server, interval=0.05, watcher=self.watcher,
+			debounce=0.3)
+
+	def tearDown(self):
+		if self.monitor.ident is not None:
+			self.monitor.stop()
+			self.monitor.join(5)
+		sys.path.remove(self.directory)
+		del(sys.modules['monitored_module'])
+		shutil.rmtree(self.directory)
+
+	def write(self, data, name='monitored_module.py'):
+		path = os.path.join(self.directory, name)
+		with open(path, 'w') as f:
+			f.write(data)
+
+		# Make the change visible even with coarse modification times
+		mtime = time.time() + len(data)
+		os.utime(path, (mtime, mtime))
+
+	def test_application_files(self):
+		files = self.monitor.application_files()
+		self.assertTrue(self.path in files)
+		self.assertFalse(os.path.abspath(os.__file__).rstrip('c') in files)
+
+	def test_debounce(self):
+		self.monitor.start()
+		time.sleep(0.2)
+
+		start = time.time()
+		for i in xrange(4):
+			self.write('value = %s\n' % ('x' * i))
+			time.sleep(0.1)
+
+		self.monitor.join(5)
+		self.assertEqual(len(self.server.reloads), 1)
+		self.assertTrue(self.server.reloads[0] - start > 0.6)
+
+	def test_ignored(self):
+		self.monitor.start()
+		time.sleep(0.2)
+		self.write('junk', '.monitored_module.py.swp')
+		self.write('junk', 'monitored_module.pyc')
+		time.sleep(0.5)
+		self.assertEqual(self.server.reloads, [])
+
+
+@unittest.skipIf(not inotify.available, "inotify is not available")
+class TestModuleMonitorInotify(TestModuleMonitor):
+	watcher = 'inotify'
+
+	def test_watched(self):
+		self.monitor.start_watching()
+		self.assertTrue(self.directory in self.monitor.watched)
+		self.assertEqual(self.monitor.changes(0), set())
+
+		self.write('value = 2\n')
+		self.assertEqual(self.monitor.changes(1), set([self.path]))
+		self.monitor.stop_watching()
+
+
+class TestMetrics(ServerTestCase):
+	server_options = {'metrics_path': '/_metrics'}
+
+	def test_json(self):
+		connection = self.connect()
+		for path in ('/one', '/two'):
+			connection.sendall('GET %s HTTP/1.1\r\n\r\n' % path)
+			head, body, leftover = self.read_response(connection)
+
+		connection.sendall('GET /_metrics?format=json HTTP/1.1\r\n\r\n')
+		head, body, leftover = self.read_response(connection)
+		self.assertTrue('Content-Type: application/json' in head)
+
+		data = json.loads(body)
+		self.assertEqual(data['connections']['accepted'], 1)
+		self.assertEqual(data['connections']['active'], 1)
+		self.assertEqual(data['requests']['total'], 3)
+		self.assertEqual(data['responses']['2xx'], 2)
+		self.assertEqual(data['workers']['total'], 10)
+		self.assertTrue(data['bytes']['in'] > 0)
+		self.assertTrue(data['bytes']['out'] > 0)
+
+		for phase in ('queued', 'app', 'writing', 'total'):
+			timing = data['timings'][phase]
+			self.assertEqual(timing['count'], 2)
+			self.assertEqual(timing['buckets'][-1], ['+Inf', 2])
+
+	def test_text(self):
+		connection = self.connect()
+		connection.sendall('GET / HTTP/1.1\r\n\r\n')
+		self.read_response(connection)
+		connection.sendall('GET /_metrics HTTP/1.1\r\n\r\n')
+		head, body, leftover = self.read_response(connection)
+
+		self.assertTrue('Content-Type: text/plain' in head)
+		self.assertTrue('frame_requests_total 2\n' in body)
+		self.assertTrue('frame_responses_total{status="2xx"} 1\n' in body)
+		self.assertTrue('frame_request_duration_seconds_count{phase="app"} 1\n' in body)
+
+	def test_python_api(self):
+		connection = self.connect()
+		connection.sendall('GET /_metrics HTTP/1.1\r\n\r\n')
+		self.read_response(connection)
+		self.assertEqual(self.server.metrics.snapshot()['requests']['total'], 1)
+
+
+class TestSharedMetrics(ServerTestCase):
+	server_options = {'metrics_path': '/_metrics'}
+
+	def setUp(self):
+		ServerTestCase.setUp(self)
+		self.shared = SharedMetrics(ServerMetrics.fields(self.app), 3)
+		self.server.metrics.share(self.shared, self.shared.claim())
+
+	def values(self, **figures):
+		values = [0] * len(self.shared.fields)
+		for name, value in figures.items():
+			values[self.shared.fields.index(tuple(name.split('__')))] = value
+		return values
+
+	def test_aggregate(self):
+		slot = self.shared.claim()
+		self.shared.write(slot, 1234, time.time(), self.values(requests__total=5,
+			responses__2xx=4, connections__active=2))
+
+		connection = self.connect()
+		connection.sendall('GET /_metrics?format=json HTTP/1.1\r\n\r\n')
+		data = json.loads(self.read_response(connection)[1])
+		self.assertEqual(data['processes'], 2)
+		self.assertEqual(data['requests']['total'], 6)
+		self.assertEqual(data['responses'], {'2xx': 4})
+		self.assertEqual(data['connections']['active'], 3)
+
+		connection.sendall('GET /_metrics?format=json&scope=process HTTP/1.1\r\n\r\n')
+		data = json.loads(self.read_response(connection)[1])
+		self.assertEqual(data['requests']['total'], 2)
+		self.assertNotIn('processes', data)
+
+	def test_release(self):
+		slot = self.shared.claim()
+		self.shared.write(slot, 1234, time.time(), self.values(requests__total=5,
+			connections__active=2))
+		self.shared.release(slot)
+
+		self.server.metrics.publish()
+		data = self.shared.snapshot()
+		self.assertEqual(data['processes'], 1)
+		self.assertEqual(data['requests']['total'], 5)
+		self.assertEqual(data['connections']['active'], 0)
+		self.assertIn(slot, self.shared.free)
+
+	def test_killed_while_writing(self):
+		import struct
+
+		slot = self.shared.claim()
+		self.shared.write(slot, 1234, time.time(), self.values(requests__total=5))
+
+		# As left by a process killed in the middle of a write
+		offset = slot * self.shared.record.size
+		struct.pack_into('=Q', self.shared.memory, offset, 3)
+
+		start = time.time()
+		self.assertEqual(self.shared.read(slot)[0], 0)
+		self.assertTrue(time.time() - start < 1)
+
+		self.shared.release(slot)
+		self.assertEqual(self.shared.read(0)[2][self.shared.fields.index(
+			('requests', 'total'))], 5)
+
+		# Usable again by the next process
+		self.shared.write(slot, 5678, time.time(), self.values(requests__total=1))
+		self.assertEqual(self.shared.read(slot)[0], 5678)
+
+	def test_fork(self):
+		slot = self.shared.claim()
+		pid = os.fork()
+		if not pid:
+			self.shared.publish(slot, time.time(), self.values(requests__total=7))
+			os._exit(0)
+		os.waitpid(pid, 0)
+
+		self.assertEqual(self.shared.read(slot)[0], pid)
+		self.assertEqual(self.shared.snapshot()['requests']['total'], 7)
+
+
+class TestHistogram(unittest.TestCase):
+	def test_buckets(self):
+		histogram = Histogram((0.1, 1))
+		for value in (0.05, 0.1, 0.5, 2, 3):
+			histogram.observe(value)
+
+		snapshot = histogram.snapshot()
+		self.assertEqual(snapshot['count'], 5)
+		self.assertAlmostEqual(snapshot['sum'], 5.65)
+		self.assertEqual(snapshot['buckets'], [[0.1, 2], [1, 3], ['+Inf', 5]])
+
+	def test_meter(self):
+		now = [100.0]
+		meter = Meter(window=5, clock=lambda: now[0])
+		for second in xrange(10):
+			now[0] = 100 + second
+			meter.mark(2)
+
+		# The current second isn't over yet, so it doesn't count
+		self.assertEqual(meter.count, 20)
+		self.assertEqual(meter.rate(), 2.0)
+
+		now[0] = 200
+		self.assertEqual(meter.rate(), 0.0)
+
+
+class TestTimerWheel(unittest.TestCase):
+	def setUp(self):
+		self.now = 100.0
+		self.wheel = TimerWheel(resolution=1.0, size=8, clock=lambda: self.now)
+		self.fired = []
+
+	def test_fires_in_order(self):
+		for delay in (5, 1, 3):
+			self.wheel.schedule(delay, self.fired.append, delay)
+
+		for i in xrange(7):
+			self.now += 1
+			self.wheel.advance()
+		self.assertEqual(self.fired, [1, 3, 5])
+
+	def test_never_early(self):
+		self.now = 100.9
+		self.wheel.schedule(1, self.fired.append, 'x')
+		self.now = 101.5
+		self.wheel.advance()
+		self.assertEqual(self.fired, [])
+		self.now = 102.0
+		self.wheel.advance()
+		self.assertEqual(self.fired, ['x'])
+
+	def test_longer_than_wheel(self):
+		self.wheel.schedule(20, self.fired.append, 'x')
+		self.now += 10
+		self.wheel.advance()
+		self.assertEqual(self.fired, [])
+		self.now += 11
+		self.wheel.advance()
+		self.assertEqual(self.fired, ['x'])
+
+	def test_cancel(self):
+		timer = self.wheel.schedule(1, self.fired.append, 'x')
+		timer.cancel()
+		self.assertFalse(timer.active)
+		self.now += 5
+		self.wheel.advance()
+		self.assertEqual(self.fired, [])
+		self.assertEqual(len(self.wheel), 0)
+
+
+class TestRequestParser(unittest.TestCase):
+	def feed_bytes(self, parser, data):
+		for i in data:
+			parser.feed(i)
+
+	def test_byte_at_a_time(self):
+		parser = RequestParser()
+		self.feed_bytes(parser, 'POST /a/b?x=1 HTTP/1.1\r\nContent-Length: 3\r\nX-A: 1\r\n\r\nabcGET')
+
+		self.assertTrue(parser.complete)
+		self.assertEqual(parser.body.read(), 'abc')
+		self.assertEqual(parser.leftover, 'GET')
+		self.assertEqual(parser.environ['REQUEST_METHOD'], 'POST')
+		self.assertEqual(parser.environ['PATH_INFO'], '/a/b')
+		self.assertEqual(parser.environ['QUERY_STRING'], 'x=1')
+		self.assertEqual(parser.environ['SERVER_PROTOCOL'], 'HTTP/1.1')
+		self.assertEqual(parser.environ['CONTENT_LENGTH'], '3')
+		self.assertEqual(parser.environ['HTTP_X_A'], '1')
+
+	def test_pipelined(self):
+		parser = RequestParser()
+		parser.feed('\r\nGET /one HTTP/1.1\r\n\r\nGET /two HTTP/1.1\r\n\r\n')
+		self.assertTrue(parser.complete)
+		self.assertEqual(parser.environ['PATH_INFO'], '/one')
+
+		second = RequestParser()
+		second.feed(parser.leftover)
+		self.assertTrue(second.complete)
+		self.assertEqual(second.environ['PATH_INFO'], '/two')
+
+	def test_repeated_and_folded_headers(self):
+		parser = RequestParser()
+		parser.feed('GET / HTTP/1.1\r\nAccept: a\r\nAccept: b\r\nX-Long: one\r\n two\r\n\r\n')
+		self.assertEqual(parser.environ['HTTP_ACCEPT'], 'a, b')
+		self.assertEqual(parser.environ['HTTP_X_LONG'], 'one two')
+
+	def test_incomplete(self):
+		parser = RequestParser()
+		parser.feed('GET / HTTP/1.1\r\nHost: x\r\n\r')
+		self.assertFalse(parser.headers_complete)
+		parser.feed('\n')
+		self.assertTrue(parser.complete)
+
+	def test_errors(self):
+		for request, status in (
+				('garbage\r\n\r\n', '400 Bad Request'),
+				('GET / HTTP/1.1\r\nno colon\r\n\r\n', '400 Bad Request'),
+				('POST / HTTP/1.1\r\nContent-Length: x\r\n\r\n', '400 Bad Request'),
+				('POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n', '411 Length Required')):
+			with self.assertRaises(ParseError) as context:
+				RequestParser().feed(request)
+			self.assertEqual(context.exception.status, status)
+
+	def test_header_limit(self):
+		parser = RequestParser(max_header_size=100)
+		with self.assertRaises(ParseError) as context:
+			parser.feed('GET / HTTP/1.1\r\nX-Big: %s' % ('x' * 200))
+		self.assertEqual(context.exception.status, '431 Request Header Fields Too Large')
+
+	def test_body_limit(self):
+		parser = RequestParser(max_body_size=10)
+		with self.assertRaises(ParseError) as context:
+			parser.feed('POST / HTTP/1.1\r\nContent-Length: 11\r\n\r\n')
+		self.assertEqual(context.exception.status, '413 Request Entity Too Large')
+
+
+class TestParseErrors(ServerTestCase):
+	server_options = {'max_header_size': 1024, 'max_body_size': 1024}
+
+	def test_header_too_large(self):
+		connection = self.connect()
+		connection.sendall('GET / HTTP/1.1\r\nX-Big: %s\r\n\r\n' % ('x' * 2048))
+		data = self.read_all(connection)
+		self.assertTrue(data.startswith('HTTP/1.1 431 '))
+
+	def test_body_too_large(self):
+		connection = self.connect()
+		connection.sendall('POST /echo HTTP/1.1\r\nContent-Length: 4096\r\n\r\n')
+		data = self.read_all(connection)
+		self.assertTrue(data.startswith('HTTP/1.1 413 '))
+
+
+def refuse_forbidden(environ):
+	if environ['PATH_INFO'] == '/forbidden':
+		return '403 Forbidden'
+
+
+class TestExpectContinue(ServerTestCase):
+	server_options = {'max_body_size': 1024, 'expect_continue': refuse_forbidden}
+
+	def send_head(self, connection, path, length=10, expect='100-continue'):
+		connection.sendall('POST %s HTTP/1.1\r\nContent-Length: %s\r\nExpect: %s\r\n\r\n' % (
+			path, length, expect))
+
+	def test_continue(self):
+		connection = self.connect()
+		self.send_head(connection, '/echo')
+		self.assertEqual(connection.recv(4096), 'HTTP/1.1 100 Continue\r\n\r\n')
+
+		connection.sendall('0123456789')
+		head, body, leftover = self.read_response(connection)
+		self.assertTrue(head.startswith('HTTP/1.1 200 '))
+		self.assertEqual(body, '0123456789')
+
+		# The next request on the connection is checked afresh
+		self.send_head(connection, '/echo', 3)
+		self.assertEqual(connection.recv(4096), 'HTTP/1.1 100 Continue\r\n\r\n')
+		connection.sendall('abc')
+		head, body, leftover = self.read_response(connection)
+		self.assertEqual(body, 'abc')
+
+	def test_body_sent_anyway(self):
+		connection = self.connect()
+		connection.sendall('POST /echo HTTP/1.1\r\nContent-Length: 3\r\n'
+			'Expect: 100-continue\r\n\r\nabc')
+		head, body, leftover = self.read_response(connection)
+		self.assertTrue(head.startswith('HTTP/1.1 200 '))
+		self.assertEqual(body, 'abc')
+
+	def test_refused(self):
+		connection = self.connect()
+		self.send_head(connection, '/forbidden')
+		data = self.read_all(connection)
+		self.assertTrue(data.startswith('HTTP/1.1 403 '))
+		self.assertNotIn('100 Continue', data)
+
+	def test_too_large(self):
+		connection = self.connect()
+		self.send_head(connection, '/echo', 4096)
+		data = self.read_all(connection)
+		self.assertTrue(data.startswith('HTTP/1.1 413 '))
+		self.assertNotIn('100 Continue', data)
+
+	def test_unknown_expectation(self):
+		connection = self.connect()
+		self.send_head(connection, '/echo', expect='something-else')
+		data = self.read_all(connection)
+		self.assertTrue(data.startswith('HTTP/1.1 417 '))
+
+
+class TestRequestBody(unittest.TestCase):
+	def test_read_while_receiving(self):
+		body = RequestBody(10)
+		result = []
+		reader = threading.Thread(target=lambda: result.append(body.read()))
+		reader.start()
+
+		body.write('01234')
+		body.write('56789')
+		reader.join(1)
+		self.assertEqual(result, ['0123456789'])
+
+	def test_readline(self):
+		body = RequestBody(13)
+		body.write('one\ntwo\nthree')
+		self.assertEqual(body.readline(), 'one\n')
+		self.assertEqual(list(body), ['two\n', 'three'])
+
+	def test_spool(self):
+		body = RequestBody(100, spool_threshold=10)
+		body.write('x' * 100)
+		self.assertTrue(body._file._rolled)
+		self.assertEqual(body.read(50), 'x' * 50)
+		body.close()
+
+	def test_abort(self):
+		body = RequestBody(10)
+		body.write('01234')
+		body.abort()
+		self.assertRaises(IOError, body.read)
+
+
+class TestStreamedUpload(ServerTestCase):
+	server_options = {'num_workers': 2, 'spool_threshold': 16}
+
+	def test_app_starts_before_body_arrives(self):
+		connection = self.connect()
+		connection.sendall('POST /echo HTTP/1.1\r\nContent-Length: 10\r\n\r\n01234')
+		connection.sendall('56789')
+		head, body, leftover = self.read_response(connection)
+		self.assertEqual(body, '0123456789')
+
+		# The connection is still usable afterwards
+		connection.sendall('GET /again HTTP/1.1\r\n\r\n')
+		head, body, leftover = self.read_response(connection, leftover)
+		self.assertEqual(body, 'GET /again')
+
+
+class TestStreamedResponse(ServerTestCase):
+	server_options = {'buffer_size': 1024}
+
+	def setUp(self):
+		self.flushed = threading.Event()
+		ServerTestCase.setUp(self)
+
+	def app(self, environ, start_response):
+		start_response('200 OK', [('Content-Type', 'text/plain')])
+		if environ['PATH_INFO'] == '/small':
+			yield 'small'
+		elif environ['PATH_INFO'] == '/flush':
+			yield 'head'
+			yield frame.flush
+			self.flushed.wait(2)
+			yield 'tail'
+		else:
+			for i in xrange(1000):
+				yield '%04d\n' % i
+
+	def read_chunked(self, connection):
+		'''
+		Reads one chunked response; returns ``(head, body)``.
+		'''
+		data = ''
+		while '\r\n\r\n' not in data:
+			data += connection.recv(4096)
+		head, data = data.split('\r\n\r\n', 1)
+		self.assertTrue('Transfer-Encoding: chunked' in head)
+
+		body = ''
+		while True:
+			while '\r\n' not in data:
+				data += connection.recv(4096)
+			size, data = data.split('\r\n', 1)
+			size = int(size, 16)
+			while len(data) < size + 2:
+				data += connection.recv(4096)
+			body += data[:size]
+			data = data[size + 2:]
+			if not size:
+				return head, body
+
+	def test_head_is_not_chunked(self):
+		connection = self.connect()
+		connection.sendall('HEAD /large HTTP/1.1\r\n\r\nGET /small HTTP/1.1\r\n\r\n')
+
+		data = ''
+		while not data.endswith('small'):
+			data += connection.recv(4096)
+
+		head, rest = data.split('\r\n\r\n', 1)
+		self.assertNotIn('Transfer-Encoding', head)
+		self.assertNotIn('Connection: close', head)
+		self.assertEqual(self.read_response(connection, rest)[1], 'small')
+
+	def test_small_response_is_buffered(self):
+		connection = self.connect()
+		connection.sendall('GET /small HTTP/1.1\r\n\r\n')
+		head, body, leftover = self.read_response(connection)
+		self.assertTrue('Content-Length: 5' in head)
+		self.assertEqual(body, 'small')
+
+	def test_large_response_is_chunked(self):
+		connection = self.connect()
+		for i in xrange(2):
+			connection.sendall('GET / HTTP/1.1\r\n\r\n')
+			head, body = self.read_chunked(connection)
+			self.assertEqual(body, ''.join('%04d\n' % i for i in xrange(1000)))
+
+	def test_http10_is_not_chunked(self):
+		connection = self.connect()
+		connection.sendall('GET / HTTP/1.0\r\n\r\n')
+		head, body = self.read_all(connection).split('\r\n\r\n', 1)
+		self.assertFalse('Content-Length' in head or 'chunked' in head)
+		self.assertEqual(body, ''.join('%04d\n' % i for i in xrange(1000)))
+
+	def test_flush(self):
+		connection = self.connect()
+		connection.sendall('GET /flush HTTP/1.1\r\n\r\n')
+
+		# The head arrives before the application carries on
+		data = ''
+		while not data.endswith('4\r\nhead\r\n'):
+			data += connection.recv(4096)
+		self.flushed.set()
+
+		while not data.endswith('0\r\n\r\n'):
+			data += connection.recv(4096)
+		self.assertTrue(data.endswith('4\r\nhead\r\n4\r\ntail\r\n0\r\n\r\n'))
+
+class TestStreamedResponseInline(TestStreamedResponse):
+	server_options = {'buffer_size': 1024, 'num_workers': 0}
+
+
+class FastCGIClient(object):
+	'''
+	Just enough of a web server to talk to :class:`frame.server.fastcgi.FastCGIServer`.
+	'''
+
+	def __init__(self, connection):
+		self.connection = connection
+		self.data = ''
+
+	def send(self, record_type, request_id, content=''):
+		self.connection.sendall(''.join(fastcgi.encode_record(record_type, request_id,
+			content)))
+
+	def begin(self, request_id, params, body='', keep_conn=True, role=fastcgi.FCGI_RESPONDER):
+		self.send(fastcgi.FCGI_BEGIN_REQUEST, request_id, fastcgi.begin_request_body.pack(
+			role, fastcgi.FCGI_KEEP_CONN if keep_conn else 0))
+		params = dict({'REQUEST_METHOD': 'GET', 'CONTENT_LENGTH': str(len(body))}, **params)
+		self.send(fastcgi.FCGI_PARAMS, request_id, fastcgi.encode_params(params.items()))
+		self.send(fastcgi.FCGI_PARAMS, request_id)
+
+	def request(self, request_id, params, body='', keep_conn=True):
+		self.begin(request_id, params, body, keep_conn)
+		if body:
+			self.send(fastcgi.FCGI_STDIN, request_id, body)
+		self.send(fastcgi.FCGI_STDIN, request_id)
+
+	def read_record(self):
+		while len(self.data) < 8:
+			chunk = self.connection.recv(65536)
+			if not chunk:
+				return None
+			self.data += chunk
+
+		version, record_type, request_id, length, padding = fastcgi.header.unpack_from(self.data)
+		while len(self.data) < 8 + length + padding:
+			self.data += self.connection.recv(65536)
+
+		content = self.data[8:8 + length]
+		self.data = self.data[8 + length + padding:]
+		return record_type, request_id, content
+
+	def read_responses(self, count=1):
+		'''
+		Read records until ``count`` requests have ended; returns a dictionary of
+		``request_id: (stdout, protocol_status)``.
+		'''
+		output = {}
+		ended = {}
+		while len(ended) < count:
+			record_type, request_id, content = self.read_record()
+			if record_type == fastcgi.FCGI_STDOUT:
+				output[request_id] = output.get(request_id, '') + content
+			elif record_type == fastcgi.FCGI_END_REQUEST:
+				ended[request_id] = (output.get(request_id, ''),
+					fastcgi.end_request_body.unpack(content)[1])
+		return ended
+
+
+class TestFastCGI(unittest.TestCase):
+	server_options = {}
+
+	def app(self, environ, start_response):
+		start_response('200 OK', [('Content-Type', 'text/plain')])
+		if environ['PATH_INFO'] == '/echo':
+			return [environ['wsgi.input'].read()]
+		if environ['PATH_INFO'] == '/large':
+			return ('%04d\n' % i for i in xrange(20000))
+		return ['%s %s?%s' % (environ['REQUEST_METHOD'], environ['PATH_INFO'],
+			environ['QUERY_STRING'])]
+
+	def setUp(self):
+		from frame.server.fastcgi import FastCGIServer
+
+		self.server = FastCGIServer(self.app, host='127.0.0.1', port=0, poll_interval=0.05,
+			buffer_size=1024, **self.server_options)
+		self.server.bind_socket()
+		self.address = self.server.socket.getsockname()
+
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def tearDown(self):
+		self.server.stop()
+		self.thread.join(5)
+
+	def connect(self):
+		family = socket.AF_UNIX if isinstance(self.address, str) else socket.AF_INET
+		connection = socket.socket(family, socket.SOCK_STREAM)
+		connection.settimeout(5)
+		connection.connect(self.address)
+		return FastCGIClient(connection)
+
+	def test_request(self):
+		client = self.connect()
+		client.request(1, {'REQUEST_URI': '/hello?a=b'})
+		stdout, status = client.read_responses()[1]
+		self.assertEqual(status, fastcgi.FCGI_REQUEST_COMPLETE)
+		self.assertTrue(stdout.startswith('Status: 200 OK\r\n'))
+		self.assertTrue(stdout.endswith('\r\n\r\nGET /hello?a=b'))
+
+	def test_body(self):
+		client = self.connect()
+		client.begin(1, {'PATH_INFO': '/echo', 'REQUEST_METHOD': 'POST'}, 'x' * 100000)
+		for i in xrange(0, 100000, 30000):
+			client.send(fastcgi.FCGI_STDIN, 1, 'x' * min(30000, 100000 - i))
+		client.send(fastcgi.FCGI_STDIN, 1)
+		stdout, status = client.read_responses()[1]
+		self.assertTrue(stdout.endswith('\r\n\r\n' + 'x' * 100000))
+
+	def test_keep_conn(self):
+		client = self.connect()
+		for i in (1, 2, 1):
+			client.request(i, {'PATH_INFO': '/again'})
+			self.assertIn(i, client.read_responses())
+
+		client.request(3, {'PATH_INFO': '/last'}, keep_conn=False)
+		client.read_responses()
+		self.assertEqual(client.read_record(), None)
+
+	def test_multiplexed(self):
+		client = self.connect()
+		client.begin(1, {'PATH_INFO': '/echo', 'REQUEST_METHOD': 'POST'}, 'one')
+		client.request(2, {'PATH_INFO': '/two'})
+		client.send(fastcgi.FCGI_STDIN, 1, 'one')
+		client.send(fastcgi.FCGI_STDIN, 1)
+
+		responses = client.read_responses(2)
+		self.assertTrue(responses[1][0].endswith('one'))
+		self.assertTrue(responses[2][0].endswith('GET /two?'))
+
+	def test_streamed(self):
+		client = self.connect()
+		client.request(1, {'PATH_INFO': '/large'})
+		stdout, status = client.read_responses()[1]
+		head, body = stdout.split('\r\n\r\n', 1)
+		self.assertEqual(body, ''.join('%04d\n' % i for i in xrange(20000)))
+
+	def test_abort(self):
+		client = self.connect()
+		client.begin(1, {'PATH_INFO': '/echo', 'REQUEST_METHOD': 'POST'}, 'unsent')
+		client.send(fastcgi.FCGI_ABORT_REQUEST, 1)
+		self.assertIn(1, client.read_responses())
+
+		# The connection carries on
+		client.request(2, {'PATH_INFO': '/after'})
+		self.assertTrue(client.read_responses()[2][0].endswith('GET /after?'))
+
+	def test_unknown_role(self):
+		client = self.connect()
+		client.begin(1, {}, role=3)
+		self.assertEqual(client.read_responses()[1], ('', fastcgi.FCGI_UNKNOWN_ROLE))
+
+	def test_get_values(self):
+		client = self.connect()
+		client.send(fastcgi.FCGI_GET_VALUES, 0, fastcgi.encode_params([
+			('FCGI_MPXS_CONNS', ''), ('FCGI_UNHEARD_OF', '')]))
+		record_type, request_id, content = client.read_record()
+		self.assertEqual(record_type, fastcgi.FCGI_GET_VALUES_RESULT)
+		self.assertEqual(fastcgi.decode_params(content), {'FCGI_MPXS_CONNS': '1'})
+
+	def test_too_large(self):
+		self.server.max_body_size = 10
+		client = self.connect()
+		client.request(1, {'PATH_INFO': '/echo'}, 'x' * 20)
+		stdout, status = client.read_responses()[1]
+		self.assertTrue(stdout.startswith('Status: 413 '))
+
+
+class TestFastCGIInline(TestFastCGI):
+	server_options = {'num_workers': 0}
+
+
+class TestFastCGIUnixSocket(TestFastCGI):
+	def setUp(self):
+		from frame.server.fastcgi import FastCGIServer
+
+		self.directory = tempfile.mkdtemp()
+		path = os.path.join(self.directory, 'fcgi.sock')
+		self.server = FastCGIServer(self.app, path=path, poll_interval=0.05, buffer_size=1024)
+		self.server.bind_socket()
+		self.address = path
+
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def tearDown(self):
+		TestFastCGI.tearDown(self)
+		shutil.rmtree(self.directory)
+
+
+class TestRecordParser(unittest.TestCase):
+	def test_split_records(self):
+		data = ''.join(fastcgi.encode_record(fastcgi.FCGI_STDIN, 1, 'abc') +
+			fastcgi.encode_record(fastcgi.FCGI_STDIN, 1))
+		parser = fastcgi.RecordParser()
+
+		records = []
+		for i in data:
+			records.extend(parser.feed(i))
+		self.assertEqual(records, [(fastcgi.FCGI_STDIN, 1, 'abc'), (fastcgi.FCGI_STDIN, 1, '')])
+		self.assertFalse(parser.started)
+
+	def test_bad_version(self):
+		with self.assertRaises(fastcgi.ProtocolError):
+			fastcgi.RecordParser().feed('\x02' + '\0' * 7)
+
+	def test_params(self):
+		params = [('SHORT', 'x'), ('LONG', 'y' * 300)]
+		self.assertEqual(fastcgi.decode_params(fastcgi.encode_params(params)), dict(params))
+		with self.assertRaises(fastcgi.ProtocolError):
+			fastcgi.decode_params(fastcgi.encode_params(params)[:-1])
+
+
+class TestChunked(unittest.TestCase):
+	def test_chunked(self):
+		with NamedTemporaryFile() as temp:
+			temp.write('abc')
+			temp.flush()
+			f = StaticFile(open(temp.name, 'rb'))
+			self.assertEqual(chunked(['ab', 'c', f, '', 'd']),
+				['3\r\n', 'ab', 'c', '\r\n', '3\r\n', f, '\r\n', '1\r\n', 'd', '\r\n'])
+			f.close()
+
+
+class TestResponseStream(unittest.TestCase):
+	def test_backpressure(self):
+		produced = []
+
+		def body():
+			for i in xrange(10):
+				produced.append(i)
+				yield 'x' * 10
+
+		stream = ResponseStream(body(), max_buffered=20)
+		worker = threading.Thread(target=stream.produce)
+		worker.start()
+		worker.join(0.2)
+
+		# The worker waits for the first two chunks to be taken
+		self.assertTrue(worker.is_alive())
+		self.assertEqual(len(produced), 3)
+
+		chunks = []
+		while True:
+			taken = stream.take()
+			if taken is None:
+				break
+			chunks.extend(taken)
+		worker.join(1)
+		self.assertEqual(len(chunks), 10)
+
+	def test_cancel(self):
+		stream = ResponseStream(iter(['x'] * 10), max_buffered=1)
+		worker = threading.Thread(target=stream.produce)
+		worker.start()
+		stream.close()
+		worker.join(1)
+		self.assertFalse(worker.is_alive())
+		self.assertTrue(stream.finished)
+
+
+class TestWritev(unittest.TestCase):
+	def test_writev(self):
+		if not writev.available:
+			self.skipTest("writev() is not available")
+
+		a, b = socket.socketpair()
+		try:
+			self.assertEqual(writev.writev(a.fileno(), ['abc', 'def', 'ghi'], 1), 8)
+			self.assertEqual(b.recv(100), 'bcdefghi')
+		finally:
+			a.close()
+			b.close()
+
+
+try:
+	import trollius
+	from trollius import From, Return
+except ImportError:
+	trollius = None
+
+
+@unittest.skipIf(trollius is None, "trollius is not installed")
+class TestAsyncServer(unittest.TestCase):
+	def setUp(self):
+		from routes.mapper import Mapper
+		from frame.server.asyncio_http import AsyncHTTPServer
+
+		frame.config.logger.driver = 'null'
+		frame.app._prep_start()
+		frame.routes.mapper = Mapper()
+
+		class AsyncRoot(frame.Controller):
+			@trollius.coroutine
+			def slow(self, x):
+				yield From(trollius.sleep(0.3))
+				raise Return('slow %s' % self.request.headers.path_info)
+
+			def blocking(self, x):
+				time.sleep(0.3)
+				return 'blocking %s' % self.request.headers.path_info
+
+			def fast(self):
+				return 'fast'
+
+			def counted(self):
+				calls.append(1)
+				return 'counted %s' % len(calls)
+
+		calls = self.calls = []
+		frame.routes.connect('/slow/{x}', 'asyncroot#slow')
+		frame.routes.connect('/blocking/{x}', 'asyncroot#blocking')
+		frame.routes.connect('/fast', 'asyncroot#fast')
+		frame.routes.connect('/counted', 'asyncroot#counted')
+
+		self.server = AsyncHTTPServer(frame.app, host='127.0.0.1', port=0, auto_reload=False,
+			num_workers=4)
+		self.server.bind_socket()
+		self.port = self.server.socket.getsockname()[1]
+
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def tearDown(self):
+		self.server.stop()
+		self.thread.join(5)
+
+	def get(self, path, results):
+		connection = socket.create_connection(('127.0.0.1', self.port), 5)
+		connection.sendall('GET %s HTTP/1.0\r\n\r\n' % path)
+		data = ''
+		while True:
+			chunk = connection.recv(4096)
+			if not chunk:
+				break
+			data += chunk
+		connection.close()
+		results[path] = data.split('\r\n\r\n', 1)[1]
+
+	def get_concurrently(self, paths):
+		results = {}
+		threads = [threading.Thread(target=self.get, args=(i, results)) for i in paths]
+		start = time.time()
+		for i in threads:
+			i.start()
+		for i in threads:
+			i.join(5)
+		return results, time.time() - start
+
+	def test_coroutine_actions(self):
+		paths = ['/slow/%s' % i for i in xrange(10)]
+		results, elapsed = self.get_concurrently(paths)
+
+		# Every task sees its own request, and they all waited at the same time
+		self.assertEqual(results, dict((i, 'slow %s' % i) for i in paths))
+		self.assertTrue(elapsed < 2)
+
+	def test_sync_actions_run_in_pool(self):
+		paths = ['/blocking/1', '/blocking/2', '/fast']
+		results, elapsed = self.get_concurrently(paths)
+		self.assertEqual(results, {
+			'/blocking/1': 'blocking /blocking/1',
+			'/blocking/2': 'blocking /blocking/2',
+			'/fast': 'fast'})
+		self.assertTrue(elapsed < 0.6)
+
+	def test_shedding_and_caching(self):
+		from frame.loadshedding import LoadShedder
+		from frame.microcache import MicroCache
+
+		frame.app.micro_cache = MicroCache(ttl=60)
+		try:
+			results = {}
+			self.get('/counted', results)
+			self.get('/counted', results)
+			self.assertEqual(results['/counted'], 'counted 1')
+			self.assertEqual(self.calls, [1])
+
+			frame.app.load_shedder = LoadShedder(retry_after=3)
+			frame.app.load_shedder.should_shed = lambda environ: True
+			self.get('/fast', results)
+			self.assertEqual(results['/fast'], '<h1>503 Service Unavailable</h1>')
+		finally:
+			frame.app.micro_cache = None
+			frame.app.load_shedder = None
+
+	def test_cancelled(self):
+		# A cancelled request (e.g., the client went away) doesn't leave its data behind
+		def cancel():
+			for i in self.server.connections:
+				if i.task is not None:
+					i.task.cancel()
+
+		for path in ('/slow/1', '/blocking/1'):
+			connection = socket.create_connection(('127.0.0.1', self.port), 5)
+			connection.sendall('GET %s HTTP/1.0\r\n\r\n' % path)
+			time.sleep(0.1)
+			self.server.loop.call_soon_threadsafe(cancel)
+			connection.close()
+
+		def leftovers():
+			# Other tests leave data behind for the main thread; only tasks matter here
+			return [i for i in frame.app.thread_data._data if isinstance(i, trollius.Task)]
+
+		deadline = time.time() + 3
+		while leftovers() and time.time() < deadline:
+			time.sleep(0.05)
+		self.assertEqual(leftovers(), [])
+
+	def test_keep_alive(self):
+		connection = socket.create_connection(('127.0.0.1', self.port), 5)
+		connection.sendall('GET /fast HTTP/1.1\r\n\r\nGET /slow/1 HTTP/1.1\r\n\r\n')
+		data = ''
+		while not data.endswith('slow /slow/1'):
+			data += connection.recv(4096)
+		self.assertEqual(data.count('HTTP/1.1 200'), 2)
+		connection.close()
+
+	def test_head(self):
+		connection = socket.create_connection(('127.0.0.1', self.port), 5)
+		connection.sendall('HEAD /fast HTTP/1.1\r\n\r\nGET /slow/1 HTTP/1.1\r\n\r\n')
+		data = ''
+		while not data.endswith('slow /slow/1'):
+			data += connection.recv(4096)
+		head, rest = data.split('\r\n\r\n', 1)
+		self.assertTrue(rest.startswith('HTTP/1.1 200'))
+		self.assertNotIn('fast', rest)
+		connection.close()
+
+	def test_head_drops_body(self):
+		# Apps other than frame's own may still hand back a body for HEAD
+		from frame.server.asyncio_http import HTTPProtocol
+
+		class Transport(object):
+			def writelines(self, data):
+				self.data = ''.join(data)
+
+		protocol = HTTPProtocol(self.server)
+		protocol.transport = Transport()
+		self.assertTrue(protocol.send_response('200 OK', [], ['body'], True, 'HTTP/1.1',
+			True))
+		head, rest = protocol.transport.data.split('\r\n\r\n', 1)
+		self.assertTrue('Content-Length: 4' in head)
+		self.assertEqual(rest, '')
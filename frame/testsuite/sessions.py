@@ -46,6 +46,16 @@ class TestSession(unittest.TestCase):
 		
 		# Assert that session data was indeed saved
 		assert session['stuff'] == 'a test'
+
+	def test_session_counters(self):
+		created, hits = self.session_interface.created.value, self.session_interface.hits.value
+		session = self.session_interface.load_current()
+		session.commit()
+		self.assertEqual(self.session_interface.created.value, created + 1)
+
+		app.request.cookies['FrameSession'] = session._key
+		self.session_interface.load_current()
+		self.assertEqual(self.session_interface.hits.value, hits + 1)
 		
 		
 class TestMemorySession(TestSession):
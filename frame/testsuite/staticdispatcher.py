@@ -1,8 +1,9 @@
 import unittest
 import os
 from tempfile import NamedTemporaryFile
-from frame.staticdispatcher import StaticDispatcher
+from frame.staticdispatcher import StaticDispatcher, StaticFile
 from frame._app import app
+from frame._config import config
 from frame.errors import Error404, Error401
 
 
@@ -39,6 +40,20 @@ class TestStaticDispatcher(unittest.TestCase):
 		assert all(i in response.headers for i in required_headers)
 		assert self.file_data == ''.join(response.body)
 		
+	def test_static_file(self):
+		with open(self.temp_file.name, 'rb') as f:
+			body = StaticFile(f, 5, 10)
+			self.assertEqual(len(body), 10)
+			self.assertEqual(''.join(body), self.file_data[5:15])
+
+	def test_get_range(self):
+		length = len(self.file_data)
+		with open(self.temp_file.name, 'rb') as f:
+			self.assertEqual(self.static_map.get_range(f, '5-9'), (5, 9, length))
+			self.assertEqual(self.static_map.get_range(f, '5-'), (5, length - 1, length))
+			self.assertEqual(self.static_map.get_range(f, '-5'), (length - 5, length - 1, length))
+			self.assertEqual(self.static_map.get_range(f, '%s-' % length), None)
+
 	def test_not_found(self):
 		environ = {
 			'PATH_INFO': '/static/not_found_file.something.txt.asdfsd'
@@ -46,3 +61,56 @@ class TestStaticDispatcher(unittest.TestCase):
 		
 		with self.assertRaises(Error404):
 			match = self.static_map.match(environ)
+
+
+class Wrapper(object):
+	def __init__(self, filelike, block_size):
+		self.filelike = filelike
+		self.block_size = block_size
+
+
+class TestFileWrapper(unittest.TestCase):
+	def setUp(self):
+		self.temp_file = NamedTemporaryFile(delete=False)
+		self.file_data = 'abcdefghijklmnopqrstuvwxyz'
+		self.temp_file.write(self.file_data)
+		self.temp_file.close()
+
+		config.logger.driver = 'null'
+		app._prep_start()
+		app.thread_data.clean()
+		self.dir_name, self.file_name = os.path.split(self.temp_file.name)
+		app.static_map['/wrapped'] = self.dir_name
+
+	def tearDown(self):
+		del(app.static_map.static_map['/wrapped'])
+		os.remove(self.temp_file.name)
+
+	def start_response(self, status, headers):
+		self.status = status
+		self.headers = dict(headers)
+
+	def call(self, **environ):
+		environ.update({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/wrapped/%s' % self.file_name})
+		return app(environ, self.start_response)
+
+	def test_wrapped(self):
+		result = self.call(**{'wsgi.file_wrapper': Wrapper})
+		self.assertTrue(isinstance(result, Wrapper))
+		self.assertEqual(result.filelike.read(), self.file_data)
+		self.assertEqual(self.status, '200 OK')
+		self.assertEqual(self.headers['Content-Length'], '26')
+
+	def test_range_to_end(self):
+		result = self.call(HTTP_RANGE='bytes=20-', **{'wsgi.file_wrapper': Wrapper})
+		self.assertTrue(isinstance(result, Wrapper))
+		self.assertEqual(result.filelike.read(), 'uvwxyz')
+		self.assertEqual(self.status, '206 Partial Content')
+
+	def test_partial_range(self):
+		# A wrapper would send the rest of the file, so the range is read instead
+		result = self.call(HTTP_RANGE='bytes=5-9', **{'wsgi.file_wrapper': Wrapper})
+		self.assertEqual(''.join(result), 'fghij')
+
+	def test_no_wrapper(self):
+		self.assertEqual(''.join(self.call()), self.file_data)
@@ -2,7 +2,7 @@ import sys
 sys.path.insert(1, '../../')
 
 from util import SimpleUtilTests
-from staticdispatcher import TestStaticDispatcher
+from staticdispatcher import TestStaticDispatcher, TestFileWrapper as TestStaticFileWrapper
 from sessions import TestMemorySession, TestFileSession, TestMemcacheSession
 from response import TestResponse
 from request import TestRequest
@@ -10,4 +10,15 @@ from preprocessors import TestPreprocessors
 from postprocessors import TestPostprocessors
 from dotdict import TestDotDict
 from _routes import TestConnect, TestResource
-from _app import TestApp
\ No newline at end of file
+from _app import TestApp
+from server import TestPoller, TestKeepAlive, TestInlineMode, TestWorkerPool, \
+	TestClassQueue, TestPriorityClassifier, TestPriority, \
+	TestSendfile, TestRequestParser, TestParseErrors, TestRequestBody, TestStreamedUpload, \
+	TestStreamedResponse, TestStreamedResponseInline, TestChunked, TestResponseStream, TestWritev, \
+	TestAsyncServer, TestTimeouts, TestConnectionLimits, TestTimerWheel, TestRetire, TestRecycle, TestHandoff, TestSupervisor, \
+	TestModuleMonitor, TestModuleMonitorInotify, TestMetrics, TestSharedMetrics, TestHistogram, TestFileWrapper, TestExpectContinue, \
+	TestFastCGI, TestFastCGIInline, TestFastCGIUnixSocket, TestRecordParser
+from threaddata import TestThreadData
+from microcache import TestMicroCache
+from loadshedding import TestLoadShedder
+from benchmark import TestResponseReader, TestLoadGenerator, TestResults
\ No newline at end of file
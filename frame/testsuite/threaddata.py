@@ -0,0 +1,47 @@
+import unittest
+import threading
+from frame import threaddata
+from frame.threaddata import ThreadData
+
+
+class TestThreadData(unittest.TestCase):
+	def test_threads(self):
+		data = ThreadData()
+		data['x'] = 'main'
+		result = []
+
+		def other():
+			data['x'] = 'other'
+			result.append(data['x'])
+
+		thread = threading.Thread(target=other)
+		thread.start()
+		thread.join()
+
+		self.assertEqual(result, ['other'])
+		self.assertEqual(data['x'], 'main')
+
+	def test_bind(self):
+		data = ThreadData()
+		context = object()
+
+		with threaddata.bind(context):
+			data['x'] = 'bound'
+
+		self.assertFalse(threading.current_thread() in data._data)
+		with threaddata.bind(context):
+			self.assertEqual(data['x'], 'bound')
+			data.clean()
+		self.assertEqual(data._data, {})
+
+	def test_context_provider(self):
+		data = ThreadData()
+		context = object()
+		provider = lambda: context
+
+		threaddata.context_providers.append(provider)
+		try:
+			data['x'] = 'provided'
+			self.assertTrue(context in data._data)
+		finally:
+			threaddata.context_providers.remove(provider)
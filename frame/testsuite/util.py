@@ -49,6 +49,29 @@ class SimpleUtilTests(unittest.TestCase):
 		data = util.parse_query_string(query_string)
 		
 		self.assertEqual(data, hard_coded_data)
+
+	def test_atomic_counter(self):
+		import threading
+
+		counter = util.AtomicCounter()
+		errors = []
+
+		def work():
+			for i in xrange(1000):
+				counter.inc()
+				value = counter.value
+				if value < 1 or value > 4000:
+					errors.append(value)
+
+		threads = [threading.Thread(target=work) for i in range(4)]
+		for i in threads:
+			i.start()
+		for i in threads:
+			i.join(10)
+
+		self.assertEqual(errors, [])
+		self.assertEqual(counter.value, 4000)
+		self.assertEqual(counter.value, 4000)
 		
 
 if __name__ == '__main__':
@@ -3,7 +3,46 @@ Created on Aug 10, 2013
 
 @author: countach74
 '''
-from threading import current_thread, RLock
+from threading import current_thread, RLock, local
+import contextlib
+
+
+#: Callables that return the identity of the current unit of work when it is not simply
+#: the current thread (e.g., the running task of an asyncio event loop), or ``None``
+context_providers = []
+
+_bound = local()
+
+
+def current_context():
+  '''
+  The key :class:`ThreadData` stores data under: the context bound with :func:`bind`,
+  else whatever a context provider reports, else the current thread.
+  '''
+  context = getattr(_bound, 'context', None)
+  if context is not None:
+    return context
+
+  for provider in context_providers:
+    context = provider()
+    if context is not None:
+      return context
+
+  return current_thread()
+
+
+@contextlib.contextmanager
+def bind(context):
+  '''
+  Have the current thread act on behalf of another context, e.g. when synchronous work
+  for an asyncio task is handed off to a thread pool.
+  '''
+  previous = getattr(_bound, 'context', None)
+  _bound.context = context
+  try:
+    yield
+  finally:
+    _bound.context = previous
 
 
 class ThreadData(object):
@@ -13,30 +52,30 @@ class ThreadData(object):
     
   def __setitem__(self, key, value):
     self._lock.acquire()
-    thread = current_thread()
-    if thread not in self._data:
-      self._data[thread] = {}
-    self._data[thread][key] = value
+    context = current_context()
+    if context not in self._data:
+      self._data[context] = {}
+    self._data[context][key] = value
     self._lock.release()
     
   def __getitem__(self, key):
-    thread = current_thread()
-    return self._data[thread][key]
+    context = current_context()
+    return self._data[context][key]
   
   def __delitem__(self, key):
     del(self[key])
   
   def __contains__(self, key):
-    thread = current_thread()
-    return key in self._data[thread]
+    context = current_context()
+    return key in self._data[context]
   
   def update(self, data):
     self._lock.acquire()
-    thread = current_thread()
-    self._data[thread].update(data)
+    context = current_context()
+    self._data[context].update(data)
     self._lock.release()
   
   def clean(self):
-    thread = current_thread()
-    if thread in self._data:
-      del(self._data[thread])
\ No newline at end of file
+    context = current_context()
+    if context in self._data:
+      del(self._data[context])
\ No newline at end of file
@@ -6,10 +6,11 @@ are used internally by Frame; some are designed to be used by web developers.
 
 import re
 import types
-from threading import RLock
+from threading import RLock, Lock
 import time
 import datetime
 import json
+import itertools
 from _config import config
 
 
@@ -169,6 +170,29 @@ class FileLogger(object):
       self.lock.release()
       
       
+class AtomicCounter(object):
+  '''
+  A counter that several threads can increment without a lock: advancing an
+  :func:`itertools.count` is a single step under the GIL. Reading it takes two steps,
+  so reads (which are rare) do take a lock.
+  '''
+
+  def __init__(self):
+    self._increments = itertools.count()
+    self._reads = itertools.count()
+    self._read_lock = Lock()
+
+  def inc(self):
+    next(self._increments)
+
+  @property
+  def value(self):
+    # Every read advances both counts by one, so the difference is the increments; two
+    # reads interleaving would each be off by one
+    with self._read_lock:
+      return next(self._increments) - next(self._reads)
+
+
 class Singleton(object):
   """
   A simple mixin to make a class behave like a Singleton.
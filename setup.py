@@ -28,7 +28,8 @@ setup(
     ]
   },
   extras_require={
-    'templates': ['jinja2']
+    'templates': ['jinja2'],
+    'async': ['trollius']
   },
   package_data={
     'frame': [